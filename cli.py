@@ -3,14 +3,14 @@ import os
 import argparse
 from dotenv import load_dotenv
 import log
-from openai_llm import OpenAI
+from openai_llm import OpenAI, RoutedLLM
 from qanything_utils import QAnythingHandler
 from deep_research import DeepSearch
 
 def setup_agent():
     """Initialize DeepSearch agent with environment variables."""
     load_dotenv()
-    llm = OpenAI(model=os.getenv("OPENAI_MODEL_NAME"))
+    llm = RoutedLLM.from_env(OpenAI(model=os.getenv("OPENAI_MODEL_NAME")))
     qhandler = QAnythingHandler(
         server_url=os.getenv("QANYTHING_SERVER_URL"),
         user_id=os.getenv("QANYTHING_USER_ID")
@@ -100,6 +100,7 @@ def main():
     }
 
     answer, docs, tokens = agent.query(args.query, **kwargs)
+    agent.wait_for_background_ingest() # Background ingestions would be lost when the process exits
 
     print("\n=== Answer ===")
     print(answer)
@@ -17,16 +17,21 @@ Description:
 
 import asyncio
 import os
-from abc import ABC
-from typing import Any, List, Tuple, Dict
+import re
+from abc import ABC, abstractmethod
+from typing import Any, List, Optional, Tuple, Dict, Union
 import time
 import tempfile
 import shutil
+import threading
+import concurrent.futures
 
+import numpy as np
 
-from openai_llm import BaseLLM
-from qanything_utils import QAnythingHandler, split_pdf_and_update_file_to_qanything
-from firecrawl_utils import firecrawl_search, firecrawl_scrape
+
+from openai_llm import BaseLLM, ChatResponse, ThinkStreamFilter, UsageLedger
+from qanything_utils import QAnythingHandler, AsyncQAnythingHandler, IngestionManifest, KnowledgeBasePins, NearDuplicateIndex, hash_file, hash_markdown
+from firecrawl_utils import firecrawl_search, firecrawl_scrape, firecrawl_scrape_many, firecrawl_batch_scrape_async, canonicalize_url, MarkdownCleaner
 
 import log
 
@@ -63,6 +68,16 @@ Retrieved Chunk: {retrieved_chunk}
 Is the chunk helpful in answering the any of the questions?
 """
 
+BATCH_RERANK_PROMPT = """Based on the query questions and the retrieved chunks, determine for each chunk whether it is helpful in answering any of the query questions.
+
+Query Questions: {query}
+
+Retrieved Chunks:
+{retrieved_chunks}
+
+Return a python list of str with exactly {num_chunks} elements, one per chunk in the same order, each being "YES" or "NO", without any other information.
+"""
+
 REFLECT_PROMPT = """Determine whether additional search queries are needed based on the original query, previous sub queries, and all retrieved document chunks. If further research is required, provide a Python list of up to 3 search queries. If no further research is required, return an empty list.
 
 If the original query is to write a report, then you prefer to generate some further queries, instead return an empty list.
@@ -175,6 +190,261 @@ def sort_and_limit_results(results: List[RetrievalResult], max_count: int) -> Li
     return sorted_results[:max_count]
 
 
+async def timed_achat(llm: BaseLLM, messages: List[Dict], phase: str, usage_ledger: Optional[UsageLedger] = None) -> ChatResponse:
+    """Calls the model serving `phase` and records the call in `usage_ledger` (if given) under `phase`."""
+    role_llm = llm.for_role(phase)
+    start_time = time.time()
+    chat_response = await role_llm.achat(messages)
+    if usage_ledger is not None:
+        usage_ledger.record(phase, chat_response, time.time() - start_time, model=getattr(role_llm, "model", None))
+    return chat_response
+
+
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+|[\u4e00-\u9fff]+")
+
+
+def lexical_tokenize(text: str) -> List[str]:
+    """Lowercased word tokens; CJK runs are split into character bigrams (unigram if a single character)."""
+    tokens = []
+    for match in _TOKEN_PATTERN.findall((text or "").lower()):
+        if "\u4e00" <= match[0] <= "\u9fff":
+            if len(match) == 1:
+                tokens.append(match)
+            else:
+                tokens.extend(match[i:i + 2] for i in range(len(match) - 1))
+        else:
+            tokens.append(match)
+    return tokens
+
+
+def bm25_scores(query_texts: List[str], doc_texts: List[str], k1: float = 1.5, b: float = 0.75) -> np.ndarray:
+    """
+    Scores each document against the union of the query terms with BM25.
+    IDF is computed over `doc_texts`, so scores are comparable within one call only.
+    """
+    if not doc_texts:
+        return np.zeros(0)
+    query_terms = sorted({term for text in query_texts for term in lexical_tokenize(text)})
+    if not query_terms:
+        return np.zeros(len(doc_texts))
+    term_index = {term: i for i, term in enumerate(query_terms)}
+
+    # docs x query_terms term-frequency matrix
+    tf = np.zeros((len(doc_texts), len(query_terms)), dtype=np.float32)
+    doc_lengths = np.zeros(len(doc_texts), dtype=np.float32)
+    for row, text in enumerate(doc_texts):
+        tokens = lexical_tokenize(text)
+        doc_lengths[row] = len(tokens)
+        for token in tokens:
+            col = term_index.get(token)
+            if col is not None:
+                tf[row, col] += 1
+
+    num_docs = len(doc_texts)
+    df = np.count_nonzero(tf, axis=0)
+    idf = np.log(1.0 + (num_docs - df + 0.5) / (df + 0.5))
+    avg_length = max(float(doc_lengths.mean()), 1.0)
+    norm = k1 * (1.0 - b + b * doc_lengths / avg_length)
+    return ((tf * (k1 + 1.0)) / (tf + norm[:, None]) * idf).sum(axis=1)
+
+
+def chunk_markdown(text: str, chunk_size: int = 800, overlap: int = 100) -> List[str]:
+    """
+    Splits markdown into chunks of at most `chunk_size` characters, packing whole paragraphs where possible.
+    Paragraphs longer than `chunk_size` are cut into windows overlapping by `overlap` characters.
+    """
+    chunks = []
+    current = ""
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if len(paragraph) > chunk_size:
+            if current:
+                chunks.append(current)
+                current = ""
+            step = max(1, chunk_size - overlap)
+            for start in range(0, len(paragraph), step):
+                chunks.append(paragraph[start:start + chunk_size])
+                if start + chunk_size >= len(paragraph):
+                    break
+        elif current and len(current) + 2 + len(paragraph) > chunk_size:
+            chunks.append(current)
+            current = paragraph
+        else:
+            current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class BaseReranker(ABC):
+    """
+    Decides which retrieved chunks are relevant to a query.
+    """
+    @abstractmethod
+    async def rerank(
+        self,
+        query: str,
+        sub_queries_context: List[str],
+        docs: List[dict],
+        usage_ledger: Optional[UsageLedger] = None,
+    ) -> Tuple[List[bool], int]:
+        """Returns one verdict per doc (in order) and the LLM tokens consumed."""
+        pass
+
+
+class LLMReranker(BaseReranker):
+    """
+    Asks the LLM for a YES/NO verdict on each chunk, either one call per chunk
+    ("per_chunk") or one listwise call for all chunks ("batch").
+    """
+    def __init__(self, llm: BaseLLM, mode: str = "per_chunk"):
+        self.llm = llm
+        self.mode = mode
+
+    async def rerank(self, query, sub_queries_context, docs, usage_ledger=None):
+        if not docs:
+            return [], 0
+        total_tokens_consumed = 0
+        if self.mode == "batch":
+            verdicts, batch_tokens = await self._rerank_batch(query, sub_queries_context, docs, usage_ledger)
+            total_tokens_consumed += batch_tokens
+            if verdicts is not None:
+                return verdicts, total_tokens_consumed
+            log.color_print(f"<search_qanything_warn> Batch rerank output could not be parsed for query '{query}'. Falling back to per-chunk rerank.</search_qanything_warn>\n")
+        verdicts, per_chunk_tokens = await self._rerank_per_chunk(query, sub_queries_context, docs, usage_ledger)
+        return verdicts, total_tokens_consumed + per_chunk_tokens
+
+    async def _rerank_per_chunk(self, query, sub_queries_context, docs, usage_ledger) -> Tuple[List[bool], int]:
+        # Judge all candidate chunks concurrently; the LLM client bounds the in-flight requests.
+        rerank_responses = await asyncio.gather(*[
+            timed_achat(self.llm, [
+                {
+                    "role": "user",
+                    "content": RERANK_PROMPT.format(
+                        query=[query] + sub_queries_context,
+                        retrieved_chunk=f"<chunk>{doc.get('content', '')}</chunk>",
+                    ),
+                }
+            ], "rerank", usage_ledger)
+            for doc in docs
+        ])
+        verdicts = []
+        total_tokens_consumed = 0
+        for chat_response_rerank in rerank_responses:
+            total_tokens_consumed += chat_response_rerank.total_tokens
+            rerank_decision = self.llm.remove_think(chat_response_rerank.content).strip().upper()
+            verdicts.append("YES" in rerank_decision and "NO" not in rerank_decision)
+        return verdicts, total_tokens_consumed
+
+    async def _rerank_batch(self, query, sub_queries_context, docs, usage_ledger) -> Tuple[Optional[List[bool]], int]:
+        """Judges all chunks in a single LLM call. Returns (None, tokens) if the verdict list cannot be parsed."""
+        retrieved_chunks = "\n".join(
+            f"<chunk_{i}>{doc.get('content', '')}</chunk_{i}>" for i, doc in enumerate(docs)
+        )
+        chat_response = await timed_achat(self.llm, [
+            {
+                "role": "user",
+                "content": BATCH_RERANK_PROMPT.format(
+                    query=[query] + sub_queries_context,
+                    retrieved_chunks=retrieved_chunks,
+                    num_chunks=len(docs),
+                ),
+            }
+        ], "rerank", usage_ledger)
+        response_content = self.llm.remove_think(chat_response.content)
+        try:
+            parsed = self.llm.literal_eval(response_content)
+        except (ValueError, SyntaxError) as e:
+            log.color_print(f"<error>Error parsing batch rerank verdicts: {e} Content: {response_content}</error>\n")
+            return None, chat_response.total_tokens
+
+        if not isinstance(parsed, (list, tuple)) or len(parsed) != len(docs):
+            return None, chat_response.total_tokens
+        verdicts = []
+        for item in parsed:
+            if isinstance(item, bool):
+                verdicts.append(item)
+            elif isinstance(item, str) and item.strip().upper() in ("YES", "NO"):
+                verdicts.append(item.strip().upper() == "YES")
+            else:
+                return None, chat_response.total_tokens
+        return verdicts, chat_response.total_tokens
+
+
+class LexicalReranker(BaseReranker):
+    """
+    In-process BM25 judge, no network calls. A chunk is accepted when it shares terms
+    with the queries and scores at least `min_relative_score` of the best chunk.
+    """
+    def __init__(self, min_relative_score: float = 0.2):
+        self.min_relative_score = min_relative_score
+
+    async def rerank(self, query, sub_queries_context, docs, usage_ledger=None):
+        if not docs:
+            return [], 0
+        scores = bm25_scores([query] + sub_queries_context, [doc.get('content', '') for doc in docs])
+        best_score = float(scores.max())
+        if best_score <= 0:
+            return [False] * len(docs), 0
+        verdicts = (scores > 0) & (scores >= self.min_relative_score * best_score)
+        return verdicts.tolist(), 0
+
+
+class CascadeReranker(BaseReranker):
+    """
+    Runs a cheap first stage and only sends the chunks it accepts to the second stage.
+    """
+    def __init__(self, first_stage: BaseReranker, second_stage: BaseReranker):
+        self.first_stage = first_stage
+        self.second_stage = second_stage
+
+    async def rerank(self, query, sub_queries_context, docs, usage_ledger=None):
+        if not docs:
+            return [], 0
+        first_verdicts, first_tokens = await self.first_stage.rerank(query, sub_queries_context, docs, usage_ledger)
+        survivors = [i for i, keep in enumerate(first_verdicts) if keep]
+        log.color_print(f"<rerank_cascade> First stage kept {len(survivors)}/{len(docs)} chunk(s) for query '{query}'.</rerank_cascade>\n")
+        verdicts = [False] * len(docs)
+        if not survivors:
+            return verdicts, first_tokens
+        second_verdicts, second_tokens = await self.second_stage.rerank(
+            query, sub_queries_context, [docs[i] for i in survivors], usage_ledger
+        )
+        for i, keep in zip(survivors, second_verdicts):
+            verdicts[i] = keep
+        return verdicts, first_tokens + second_tokens
+
+
+def build_reranker(name: str, llm: BaseLLM, rerank_mode: str = "per_chunk") -> BaseReranker:
+    """Builds a reranker by name: "llm", "lexical" or "cascade" (lexical pruning, then LLM)."""
+    if name == "llm":
+        return LLMReranker(llm, mode=rerank_mode)
+    if name == "lexical":
+        return LexicalReranker()
+    if name == "cascade":
+        return CascadeReranker(LexicalReranker(), LLMReranker(llm, mode=rerank_mode))
+    raise ValueError(f"Unknown reranker: {name}")
+
+
+_background_loop = None
+_background_loop_lock = threading.Lock()
+
+
+def get_background_loop() -> asyncio.AbstractEventLoop:
+    """
+    Returns the event loop, run by a daemon thread, on which background ingestions of all queries run.
+    Unlike the loop of a query, it outlives the query, so queries return without waiting for them.
+    """
+    global _background_loop
+    with _background_loop_lock:
+        if _background_loop is None:
+            _background_loop = asyncio.new_event_loop()
+            threading.Thread(target=_background_loop.run_forever, name="deep-search-background", daemon=True).start()
+    return _background_loop
+
+
 def describe_class(description):
     def decorator(cls):
         cls.__description__ = description
@@ -211,13 +481,30 @@ class DeepSearch(RAGAgent):
         max_iter: int = 3,
         search_internet: bool = False,
         max_qanything_chunks_to_rerank: int = 5, 
+        rerank_mode: str = "per_chunk", # "per_chunk" or "batch"
+        reranker: Union[str, BaseReranker] = "llm", # "llm", "lexical", "cascade" or a BaseReranker instance
         max_firecrawl_qanything_chunks_to_process: int = 10, 
         min_qanything_results_before_web_search: int = 2, 
         max_chunks_for_summary: int = 25, 
+        token_budget: int = None,
+        token_budget_summary_reserve: float = 0.2, # Share of the budget kept for the final summary
+        async_qanything_handler: Optional[AsyncQAnythingHandler] = None, # Built from qanything_handler if not given
+        ingestion_manifest: Optional[IngestionManifest] = None, # Skips uploads of content already indexed by earlier jobs
+        kb_pins: Optional[KnowledgeBasePins] = None, # Keeps the reused KBs of earlier jobs from being emptied while searched
+        firecrawl_max_workers: int = 8, # Concurrent scrapes of the direct `urls`
+        firecrawl_batch_scrape: bool = False, # Scrape the direct `urls` with one Firecrawl batch scrape job instead
+        web_results_mode: str = "qanything", # "qanything" (upload, index, then search) or "local" (rank the pages in memory)
+        background_web_ingest: bool = True, # In "local" mode, still ingest the pages into QAnything in the background
+        background_ingest_kb_id: Optional[str] = None, # Persistent KB receiving the background ingestions (default: the query's KB)
+        clean_scraped_markdown: bool = True, # Strip boilerplate from scraped pages before they are ranked or uploaded
+        max_page_chars: int = 50000, # Cap of a cleaned page, keeping the blocks most relevant to the query (0 = no cap)
+        speculative_web_search: bool = False, # Start each sub-query's Firecrawl search together with its QAnything search
+        max_speculative_web_searches: int = 10, # Cap on speculative Firecrawl searches per query
         **kwargs,
     ):
         self.llm = llm
         self.qanything_handler = qanything_handler
+        self.async_qanything_handler = async_qanything_handler or AsyncQAnythingHandler.from_handler(qanything_handler)
         self.qanything_kb_ids = qanything_kb_ids
         self.max_iter = max_iter
         self.search_internet = search_internet
@@ -225,19 +512,176 @@ class DeepSearch(RAGAgent):
 
         # Store new parameters
         self.max_qanything_chunks_to_rerank = max_qanything_chunks_to_rerank
+        self.rerank_mode = rerank_mode
+        self.reranker = build_reranker(reranker, llm, rerank_mode) if isinstance(reranker, str) else reranker
         self.max_firecrawl_qanything_chunks_to_process = max_firecrawl_qanything_chunks_to_process
         self.min_qanything_results_before_web_search = min_qanything_results_before_web_search
         self.max_chunks_for_summary = max_chunks_for_summary
+        self.token_budget = token_budget
+        self.token_budget_summary_reserve = token_budget_summary_reserve
+        self.usage_ledger = UsageLedger(token_budget)
+        self.ingestion_manifest = ingestion_manifest
+        # Files of earlier jobs' KBs holding content this query would otherwise re-upload, by KB ID.
+        # Those KBs are searched too, but only chunks of these files are used from them.
+        self.reused_kb_files: Dict[str, set] = {}
+        self.kb_pins = kb_pins
+        self._pinned_kb_ids = set() # Reused KBs pinned by the current query
+        self.on_upload_progress = None # Optional callback(file, bytes_sent, file_size) for uploads to QAnything
+        self.firecrawl_max_workers = firecrawl_max_workers
+        self.firecrawl_batch_scrape = firecrawl_batch_scrape
+        if web_results_mode not in ("qanything", "local"):
+            raise ValueError(f"Unknown web_results_mode: {web_results_mode}")
+        self.web_results_mode = web_results_mode
+        self.background_web_ingest = background_web_ingest
+        self.background_ingest_kb_id = background_ingest_kb_id
+        self._background_ingestions = set() # concurrent.futures.Future of the ingestions running on get_background_loop()
+        self.near_duplicates = NearDuplicateIndex() # Content fingerprints of the pages seen by the current query
+        self.clean_scraped_markdown = clean_scraped_markdown
+        self.max_page_chars = max_page_chars
+        self.markdown_cleaner = MarkdownCleaner(max_chars=max_page_chars) # Counts the bytes removed in the current query
+        self.speculative_web_search = speculative_web_search
+        self.max_speculative_web_searches = max_speculative_web_searches
+        self.speculation_stats = self._new_speculation_stats()
 
         if firecrawl_scrape is None:
              log.color_print("<warning> 'firecrawl_scrape' function was not imported. Direct URL processing via 'urls' parameter will be skipped if attempted. 'firecrawl_search' for web queries is available.</warning>\n")
 
 
-    def _generate_sub_queries(self, original_query: str) -> Tuple[List[str], int]:
-        chat_response = self.llm.chat(
-            messages=[
+    async def _achat(self, messages: List[Dict], phase: str) -> ChatResponse:
+        """Calls the LLM and records the call in the usage ledger under `phase`."""
+        return await timed_achat(self.llm, messages, phase, self.usage_ledger)
+
+    def _search_kb_ids(self, kb_ids: List[str]) -> List[str]:
+        """`kb_ids` plus the KBs whose content was reused through the ingestion manifest."""
+        return kb_ids + [kb_id for kb_id in self.reused_kb_files if kb_id not in kb_ids]
+
+    def _reuse_indexed_file(self, content_hash: str, entry: Dict[str, Any], kb_id: str) -> bool:
+        """
+        Makes the content of a manifest entry searchable from this query instead of uploading it to `kb_id`.
+        Returns False if the entry does not tell which files hold the content, or if its KB is being emptied,
+        in which case it is uploaded again.
+        """
+        if entry["kb_id"] == kb_id:
+            return True
+        file_ids = {file_id for file_id in (entry.get("file_id") or "").split(",") if file_id}
+        if not file_ids:
+            return False
+        if self.kb_pins is not None and entry["kb_id"] not in self._pinned_kb_ids:
+            if not self.kb_pins.pin(entry["kb_id"]):
+                return False
+            # The KB may have been recycled between the lookup and the pin
+            current = self.ingestion_manifest.lookup(content_hash)
+            if current is None or current["kb_id"] != entry["kb_id"]:
+                self.kb_pins.unpin(entry["kb_id"])
+                return False
+            self._pinned_kb_ids.add(entry["kb_id"])
+        self.reused_kb_files.setdefault(entry["kb_id"], set()).update(file_ids)
+        return True
+
+    def _release_kb_pins(self):
+        """Unpins the reused KBs, so the jobs owning them can recycle them."""
+        for pinned_kb_id in self._pinned_kb_ids:
+            self.kb_pins.unpin(pinned_kb_id)
+        self._pinned_kb_ids = set()
+
+    def _drop_foreign_chunks(self, docs: List[dict], own_kb_ids: List[str]) -> List[dict]:
+        """Drops QAnything chunks of reused KBs that do not belong to the reused files."""
+        return [
+            doc for doc in docs
+            if doc.get("kb_id") in own_kb_ids
+            or doc.get("kb_id") not in self.reused_kb_files
+            or doc.get("file_id") in self.reused_kb_files[doc.get("kb_id")]
+        ]
+
+    async def _ingest_files(
+        self,
+        file_paths: List[str],
+        kb_id: str,
+        mode: str = "strong",
+        chunk_size: int = 800,
+        content_hashes: Optional[Dict[str, str]] = None,
+        sources: Optional[Dict[str, str]] = None,
+        background: bool = False,
+    ) -> Dict[str, Optional[str]]:
+        """
+        Uploads and indexes `file_paths`, skipping content the ingestion manifest has already seen indexed.
+        `content_hashes` may give precomputed hashes (e.g. of normalized scraped markdown); other files are
+        hashed from their bytes. Returns the status of each file, None if its upload failed.
+        Background ingestions, which the query does not search, skip indexed content without reusing it
+        and do not report upload progress.
+        """
+        progress_callback = None if background else self.on_upload_progress
+        if self.ingestion_manifest is None:
+            return await self.async_qanything_handler.ingest_files(
+                file_paths, kb_id=kb_id, mode=mode, chunk_size=chunk_size, progress_callback=progress_callback
+            )
+
+        content_hashes = dict(content_hashes or {})
+        sources = sources or {}
+        statuses = {}
+        paths_to_upload = []
+        for file_path in file_paths:
+            if file_path not in content_hashes:
+                content_hashes[file_path] = await asyncio.to_thread(hash_file, file_path)
+            entry = self.ingestion_manifest.lookup(content_hashes[file_path])
+            if entry is None or not (background or self._reuse_indexed_file(content_hashes[file_path], entry, kb_id)):
+                paths_to_upload.append(file_path)
+                continue
+            log.color_print(f"<ingest_dedup> {sources.get(file_path, file_path)} is already indexed in KB {entry['kb_id']}. Skipping upload.</ingest_dedup>\n")
+            statuses[file_path] = "green"
+
+        def record(file_path, file_id, status):
+            self.ingestion_manifest.record(content_hashes[file_path], kb_id, file_id, status, source=sources.get(file_path, file_path))
+
+        if paths_to_upload:
+            statuses.update(await self.async_qanything_handler.ingest_files(
+                paths_to_upload, kb_id=kb_id, mode=mode, chunk_size=chunk_size, callback=record,
+                progress_callback=progress_callback,
+            ))
+        return statuses
+
+    async def _scrape_urls(self, urls: List[str], scrape_options: Dict):
+        """
+        Scrapes `urls` concurrently and yields (url, firecrawl response) as each page arrives, either from
+        a Firecrawl batch scrape job or from up to `firecrawl_max_workers` single-page scrapes.
+        """
+        if self.firecrawl_batch_scrape:
+            async for url, result in firecrawl_batch_scrape_async(urls, scrape_options=scrape_options):
+                yield url, result
+            return
+        results = firecrawl_scrape_many(urls, scrape_options=scrape_options, max_workers=self.firecrawl_max_workers)
+        results_lock = threading.Lock() # After a cancellation, a next() may still run in its worker thread
+
+        def next_result():
+            with results_lock:
+                return next(results, None)
+
+        def close_results():
+            with results_lock:
+                results.close()
+
+        try:
+            while True:
+                item = await asyncio.to_thread(next_result)
+                if item is None:
+                    break
+                yield item
+        finally:
+            # Closed in a worker thread, without blocking the event loop on a running next()
+            asyncio.get_running_loop().run_in_executor(None, close_results)
+
+    def _budget_nearly_exhausted(self) -> bool:
+        """True when only the summary reserve of the token budget is left."""
+        if not self.token_budget:
+            return False
+        return self.usage_ledger.total_tokens >= self.token_budget * (1 - self.token_budget_summary_reserve)
+
+    async def _generate_sub_queries(self, original_query: str) -> Tuple[List[str], int]:
+        chat_response = await self._achat(
+            [
                 {"role": "user", "content": SUB_QUERY_PROMPT.format(original_query=original_query)}
-            ]
+            ],
+            phase="sub_query",
         )
         response_content = self.llm.remove_think(chat_response.content)
         try:
@@ -255,38 +699,29 @@ class DeepSearch(RAGAgent):
             log.color_print(f"<search_qanything_warn> No QAnything KB IDs provided for query: {query}. Skipping QAnything search.</search_qanything_warn>\n")
             return [], 0
 
-        log.color_print(f"<search_qanything> Searching QAnything for: [{query}] in KBs: {self.qanything_kb_ids}...</search_qanything>\n")
+        kb_ids = self._search_kb_ids(self.qanything_kb_ids)
+        log.color_print(f"<search_qanything> Searching QAnything for: [{query}] in KBs: {kb_ids}...</search_qanything>\n")
 
-        qa_response = self.qanything_handler.chat(
+        qa_response = await self.async_qanything_handler.chat(
             question=query,
-            kb_ids=self.qanything_kb_ids,
+            kb_ids=kb_ids,
             only_need_search_results=True,
         )
 
         if qa_response.get("code") == 200 and "source_documents" in qa_response:
-            source_documents = qa_response["source_documents"]
+            source_documents = self._drop_foreign_chunks(qa_response["source_documents"], self.qanything_kb_ids)
             log.color_print(f"<search_qanything> Found {len(source_documents)} potential chunks from QAnything for query '{query}'.</search_qanything>\n")
 
             docs_to_rerank = sorted(source_documents, key=lambda d: float(d.get('score', 0.0)), reverse=True)
             docs_to_rerank = docs_to_rerank[:self.max_qanything_chunks_to_rerank]
             log.color_print(f"<search_qanything> Reranking top {len(docs_to_rerank)} chunks (max_qanything_chunks_to_rerank={self.max_qanything_chunks_to_rerank})...</search_qanything>\n")
 
+            verdicts, rerank_tokens = await self.reranker.rerank(query, sub_queries_context, docs_to_rerank, self.usage_ledger)
+            total_tokens_consumed += rerank_tokens
+
             accepted_chunk_count = 0
-            for doc in docs_to_rerank: # Iterate over the limited and sorted list
-                rerank_messages = [
-                    {
-                        "role": "user",
-                        "content": RERANK_PROMPT.format(
-                            query=[query] + sub_queries_context,
-                            retrieved_chunk=f"<chunk>{doc.get('content', '')}</chunk>",
-                        ),
-                    }
-                ]
-                chat_response_rerank = self.llm.chat(rerank_messages)
-                total_tokens_consumed += chat_response_rerank.total_tokens
-                rerank_decision = self.llm.remove_think(chat_response_rerank.content).strip().upper()
-
-                if "YES" in rerank_decision and "NO" not in rerank_decision:
+            for doc, is_relevant in zip(docs_to_rerank, verdicts): # Iterate over the limited and sorted list
+                if is_relevant:
                     retrieved_for_query.append(
                         RetrievalResult(
                             text=doc.get('content', ''),
@@ -311,93 +746,106 @@ class DeepSearch(RAGAgent):
 
         return retrieved_for_query, total_tokens_consumed
 
+    @staticmethod
+    def _new_speculation_stats() -> Dict[str, int]:
+        # started = used + wasted; cancelled counts the wasted searches still running when they were dropped
+        return {"started": 0, "used": 0, "wasted": 0, "cancelled": 0, "skipped_by_cap": 0}
+
+    async def _fetch_web_pages(self, query: str, **kwargs) -> List[dict]:
+        """Runs the Firecrawl search for `query` in a worker thread and returns the result pages."""
+        try:
+            scrape_opts = {"formats": ["markdown"]}
+            if 'max_web_search_results' in kwargs:
+                max_web_search_results = kwargs['max_web_search_results']
+            else:
+                max_web_search_results = 5
+            fc_response = await asyncio.to_thread(
+                firecrawl_search, query=query, limit=max_web_search_results, scrape_options=scrape_opts # Limit search results to reduce processing
+            )
+        except Exception as e:
+            log.color_print(f"<search_firecrawl_error> Firecrawl search error: {e}</search_firecrawl_error>\n")
+            return []
+        return fc_response.get("data", []) or []
+
+    def _start_speculative_web_searches(self, queries: List[str], **kwargs) -> Dict[str, asyncio.Task]:
+        """
+        Starts the Firecrawl search of each query before its QAnything results are known, up to
+        `max_speculative_web_searches` per query run. Only the search is speculative: pages are
+        cleaned, deduplicated and uploaded once the web results are known to be needed.
+        """
+        tasks = {}
+        for s_query in queries:
+            if self.speculation_stats["started"] >= self.max_speculative_web_searches:
+                self.speculation_stats["skipped_by_cap"] += 1
+                continue
+            self.speculation_stats["started"] += 1
+            tasks[s_query] = asyncio.create_task(self._fetch_web_pages(s_query, **kwargs))
+        return tasks
+
+    def _discard_speculative_web_search(self, s_query: str, task: asyncio.Task) -> None:
+        self.speculation_stats["wasted"] += 1
+        if not task.done():
+            # The worker thread finishes on its own, its result is just not used
+            self.speculation_stats["cancelled"] += 1
+            task.cancel()
+        log.color_print(f"<speculative_web_search> Dropped speculative web search for '{s_query}'.</speculative_web_search>\n")
+
     async def _search_and_rerank_firecrawl(
         self,
         query: str,
         sub_queries_context: List[str],
-        processed_urls_in_session: set,
+        processed_urls_in_session: Dict[str, asyncio.Future],
         upload_mode: str = "strong",
         chunk_size: int = 800,
+        prefetched_pages: Optional[asyncio.Task] = None, # Speculative Firecrawl search already started for `query`
         **kwargs
     ) -> Tuple[List[RetrievalResult], int]:
         retrieved_for_query: List[RetrievalResult] = []
         total_tokens_consumed = 0
 
-        if not self.qanything_kb_ids:
+        local_mode = self.web_results_mode == "local"
+        if not self.qanything_kb_ids and not local_mode:
             log.color_print(f"<search_firecrawl_warn> No QAnything KB IDs configured. Cannot upload Firecrawl results. Skipping web search for '{query}'.</search_firecrawl_warn>\n")
+            if prefetched_pages is not None:
+                self._discard_speculative_web_search(query, prefetched_pages)
             return [], 0
-        target_kb_id = self.qanything_kb_ids[0]
-
-        log.color_print(f"<search_firecrawl> Web searching via Firecrawl for: [{query}] and uploading to KB {target_kb_id}...</search_firecrawl>\n")
-        try:
-            scrape_opts = {"formats": ["markdown"]}
-            if 'max_web_search_results' in kwargs:
-                max_web_search_results = kwargs['max_web_search_results']
-            else:
-                max_web_search_results = 5
-            fc_response = firecrawl_search(query=query, limit=max_web_search_results, scrape_options=scrape_opts) # Limit search results to reduce processing
-        except Exception as e:
-            log.color_print(f"<search_firecrawl_error> Firecrawl search error: {e}</search_firecrawl_error>\n")
-            return [], 0
+        target_kb_id = self.qanything_kb_ids[0] if self.qanything_kb_ids else None
 
-        pages = fc_response.get("data", []) or []
+        if local_mode:
+            log.color_print(f"<search_firecrawl> Web searching via Firecrawl for: [{query}] and ranking the pages locally...</search_firecrawl>\n")
+        else:
+            log.color_print(f"<search_firecrawl> Web searching via Firecrawl for: [{query}] and uploading to KB {target_kb_id}...</search_firecrawl>\n")
+        if prefetched_pages is not None:
+            self.speculation_stats["used"] += 1
+            pages = await prefetched_pages
+        else:
+            pages = await self._fetch_web_pages(query, **kwargs)
         if not pages:
             log.color_print(f"<search_firecrawl> Firecrawl returned no results for query: '{query}'</search_firecrawl>\n")
             return [], 0
+        if self.clean_scraped_markdown:
+            pages = await asyncio.to_thread(self._clean_pages, pages, query) # Regex cleaning of large pages is CPU-bound
+        pages = await asyncio.to_thread(self._drop_duplicate_pages, pages, query) # SimHash is CPU-bound
 
-        temp_dir = tempfile.mkdtemp(prefix="firecrawl_search_")
-        newly_uploaded_urls_this_call = set()
+        if local_mode:
+            retrieved_for_query = self._rank_web_pages_locally(query, pages, chunk_size)
+            log.color_print(f"<search_firecrawl> Ranked {len(retrieved_for_query)} chunk(s) locally from {len(pages)} Firecrawl page(s) for query '{query}'.</search_firecrawl>\n")
+            ingest_kb_id = self.background_ingest_kb_id or target_kb_id
+            if ingest_kb_id and self.background_web_ingest:
+                self._ingest_web_pages_in_background(query, pages, ingest_kb_id, upload_mode, chunk_size, processed_urls_in_session)
+            return retrieved_for_query, total_tokens_consumed
 
-        for page in pages:
-            url = page.get("url", "")
-            if not url:
-                log.color_print(f"<search_firecrawl_warn> Firecrawl result for query '{query}' missing URL. Skipping.</search_firecrawl_warn>\n")
-                continue
-
-            if url in processed_urls_in_session:
-                log.color_print(f"<search_firecrawl_skip_upload> Content for URL '{url}' (from web search for '{query}') was already processed and uploaded in this session. Skipping re-upload.</search_firecrawl_skip_upload>\n")
-                continue
-
-            content = page.get("markdown") or page.get("content")
-            if not content:
-                log.color_print(f"<search_firecrawl_warn> No content/markdown for URL {url} from query '{query}'. Skipping.</search_firecrawl_warn>\n")
-                continue
-
-            safe_name = "".join(c if c.isalnum() else "_" for c in url.replace("https://", "").replace("http://", ""))[:100]
-            md_path = os.path.join(temp_dir, f"{safe_name}.md")
-
-            with open(md_path, "w", encoding="utf-8") as f:
-                f.write(f"# Content from web search: {query}\n## Source URL: {url}\n\n{content}")
+        indexed_urls = await self._ingest_web_pages(query, pages, target_kb_id, upload_mode, chunk_size, processed_urls_in_session)
 
-            try:
-                upload_resp = self.qanything_handler.upload_file(
-                    file=md_path,
-                    kb_id=target_kb_id,
-                    mode=upload_mode,
-                    chunk_size=chunk_size
-                )
-                file_id = upload_resp["data"][0]["file_id"]
-                status = self.qanything_handler.wait_status_to_end(target_kb_id, file_id)
-                if status != "green":
-                    log.color_print(f"<search_firecrawl_error> QAnything indexing failed for Firecrawl result: {md_path} (URL: {url})</search_firecrawl_error>\n")
-                    continue
-                else:
-                    log.color_print(f"<search_firecrawl> QAnything indexed Firecrawl result successfully: {md_path} (URL: {url})</search_firecrawl>\n")
-                    processed_urls_in_session.add(url)
-                    newly_uploaded_urls_this_call.add(url)
-            except Exception as e:
-                log.color_print(f"<search_firecrawl_error> QAnything upload error for Firecrawl result (URL: {url}): {e}</search_firecrawl_error>\n")
-                continue
-
-        if newly_uploaded_urls_this_call or any(page.get("url") in processed_urls_in_session for page_data in pages if page_data.get("url")):
+        if indexed_urls:
             try:
                 prompt_ctx = ""
                 if sub_queries_context:
                     prompt_ctx = ("以下是针对该查询拆分出的子问题，\n"
                                   "请结合它们来优化检索：\n- " + "\n- ".join(sub_queries_context))
-                qa_resp = self.qanything_handler.chat(
+                qa_resp = await self.async_qanything_handler.chat(
                     question=query,
-                    kb_ids=[target_kb_id],
+                    kb_ids=self._search_kb_ids([target_kb_id]),
                     only_need_search_results=True,
                     custom_prompt=prompt_ctx,
                     networking=False,
@@ -405,7 +853,7 @@ class DeepSearch(RAGAgent):
                 )
                 if qa_resp.get("code") == 200 and "source_documents" in qa_resp:
                     # MODIFICATION: Sort by score and limit before adding to results
-                    source_docs_firecrawl = qa_resp["source_documents"]
+                    source_docs_firecrawl = self._drop_foreign_chunks(qa_resp["source_documents"], [target_kb_id])
                     docs_to_process = sorted(source_docs_firecrawl, key=lambda d: float(d.get('score', 0.0)), reverse=True)
                     docs_to_process = docs_to_process[:self.max_firecrawl_qanything_chunks_to_process]
                     log.color_print(f"<search_firecrawl> Processing top {len(docs_to_process)} chunks from QAnything for Firecrawl content (max_firecrawl_qanything_chunks_to_process={self.max_firecrawl_qanything_chunks_to_process}).</search_firecrawl>\n")
@@ -447,15 +895,244 @@ class DeepSearch(RAGAgent):
             except Exception as e:
                 log.color_print(f"<search_firecrawl_error> QAnything retrieval error for query '{query}' after Firecrawl uploads: {e}</search_firecrawl_error>\n")
 
+        return retrieved_for_query, total_tokens_consumed # total_tokens_consumed for LLM reranking not applicable here
+
+    def _clean_page(self, page: dict, query: str) -> dict:
+        """Returns a copy of the Firecrawl page with its markdown cleaned by the markdown cleaner."""
+        content = page.get("markdown") or page.get("content")
+        if not content or not page.get("url"):
+            return page
+        cleaned = self.markdown_cleaner.clean(content, query=query, page_key=canonicalize_url(page["url"]))
+        return {**page, "markdown": cleaned, "content": cleaned}
+
+    def _clean_pages(self, pages: List[dict], query: str) -> List[dict]:
+        """Cleans the markdown of the Firecrawl pages of one search, see _clean_page."""
+        return [self._clean_page(page, query) for page in pages]
+
+    def _is_near_duplicate(self, url: str, content: str, context: str) -> bool:
+        """
+        True if `content` nearly matches a page seen earlier in this query under another canonical URL
+        (a mirror, tracking-parameter variant or syndicated copy). Otherwise the page is remembered.
+        """
+        canonical_url = canonicalize_url(url)
+        duplicate_of = self.near_duplicates.add(canonical_url, content)
+        if duplicate_of is None or duplicate_of == canonical_url:
+            return False
+        log.color_print(f"<dedup_near_duplicate> {url} ({context}) nearly duplicates {duplicate_of}. Skipping.</dedup_near_duplicate>\n")
+        return True
+
+    def _drop_duplicate_pages(self, pages: List[dict], query: str) -> List[dict]:
+        """Drops Firecrawl pages that repeat an earlier result's canonical URL or nearly duplicate another page."""
+        kept = []
+        canonical_urls = set()
+        for page in pages:
+            url = page.get("url")
+            content = page.get("markdown") or page.get("content")
+            if not url or not content:
+                kept.append(page) # Reported when the pages are processed
+                continue
+            canonical_url = canonicalize_url(url)
+            if canonical_url in canonical_urls or self._is_near_duplicate(url, content, f"web search for '{query}'"):
+                continue
+            canonical_urls.add(canonical_url)
+            kept.append(page)
+        return kept
+
+    def _ingest_web_pages_in_background(
+        self,
+        query: str,
+        pages: List[dict],
+        kb_id: str,
+        upload_mode: str,
+        chunk_size: int,
+        processed_urls_in_session: Dict[str, asyncio.Future],
+    ):
+        """
+        Ingests the Firecrawl pages not yet processed in this session into `kb_id` on get_background_loop(),
+        without waiting for it. `kb_id` stays pinned until the ingestion ends, so its job's KB is not recycled under it;
+        nothing is ingested if it is already being emptied or deleted.
+        """
+        pages = [page for page in pages if page.get("url") and canonicalize_url(page["url"]) not in processed_urls_in_session]
+        if not pages:
+            return
+        if self.kb_pins is not None and not self.kb_pins.pin(kb_id):
+            log.color_print(f"<search_firecrawl> KB {kb_id} is being reclaimed, skipping background ingestion of Firecrawl results of '{query}'.</search_firecrawl>\n")
+            return
+        loop = asyncio.get_running_loop()
+        claims = {}
+        for page in pages:
+            claims[canonicalize_url(page["url"])] = processed_urls_in_session[canonicalize_url(page["url"])] = loop.create_future()
+
+        def resolve_claims(indexed_urls):
+            for canonical_url, claim in claims.items():
+                if not claim.done():
+                    claim.set_result(canonical_url in indexed_urls)
+
+        def done(future):
+            self._background_ingestions.discard(future)
+            if self.kb_pins is not None:
+                self.kb_pins.unpin(kb_id)
+            indexed_urls = set()
+            if future.cancelled():
+                pass
+            elif future.exception() is not None:
+                log.color_print(f"<search_firecrawl_error> Background ingestion of Firecrawl results of '{query}' failed: {future.exception()}</search_firecrawl_error>\n")
+            else:
+                indexed_urls = {canonicalize_url(url) for url in future.result()}
+            try:
+                loop.call_soon_threadsafe(resolve_claims, indexed_urls)
+            except RuntimeError:
+                pass # The query already ended
+
+        future = asyncio.run_coroutine_threadsafe(
+            self._ingest_web_pages(query, pages, kb_id, upload_mode, chunk_size, {}, background=True),
+            get_background_loop(),
+        )
+        self._background_ingestions.add(future)
+        future.add_done_callback(done)
+
+    def wait_for_background_ingest(self, timeout: Optional[float] = None) -> bool:
+        """
+        Blocks until the background ingestions started by this agent end, e.g. before a short-lived process exits.
+        Returns False if some are still running after `timeout` seconds.
+        """
+        _, not_done = concurrent.futures.wait(list(self._background_ingestions), timeout=timeout)
+        return not not_done
+
+    async def _ingest_web_pages(
+        self,
+        query: str,
+        pages: List[dict],
+        kb_id: str,
+        upload_mode: str,
+        chunk_size: int,
+        processed_urls_in_session: Dict[str, asyncio.Future],
+        background: bool = False,
+    ) -> set:
+        """
+        Writes the Firecrawl pages not yet processed in this session to markdown files and ingests them into `kb_id`.
+        Each URL is claimed in `processed_urls_in_session` with a future resolving to whether it got indexed, and
+        pages claimed by concurrent sub-queries are awaited instead of uploaded again. Returns the URLs of `pages`
+        indexed in this session, once they are searchable.
+        """
+        temp_dir = tempfile.mkdtemp(prefix="firecrawl_search_")
+        indexed_urls = set()
+        md_path_to_url = {}
+        md_path_to_hash = {}
+        claims = {} # md_path -> future of this call's claim on its URL
+        awaited_claims = {} # URL -> future of a concurrent sub-query's claim
+
+        for page in pages:
+            url = page.get("url", "")
+            if not url:
+                log.color_print(f"<search_firecrawl_warn> Firecrawl result for query '{query}' missing URL. Skipping.</search_firecrawl_warn>\n")
+                continue
+
+            if canonicalize_url(url) in processed_urls_in_session:
+                log.color_print(f"<search_firecrawl_skip_upload> Content for URL '{url}' (from web search for '{query}') was already processed and uploaded in this session. Skipping re-upload.</search_firecrawl_skip_upload>\n")
+                awaited_claims[url] = processed_urls_in_session[canonicalize_url(url)]
+                continue
+
+            content = page.get("markdown") or page.get("content")
+            if not content:
+                log.color_print(f"<search_firecrawl_warn> No content/markdown for URL {url} from query '{query}'. Skipping.</search_firecrawl_warn>\n")
+                continue
+
+            safe_name = "".join(c if c.isalnum() else "_" for c in url.replace("https://", "").replace("http://", ""))[:100]
+            md_path = os.path.join(temp_dir, f"{safe_name}.md")
+
+            with open(md_path, "w", encoding="utf-8") as f:
+                f.write(f"# Content from web search: {query}\n## Source URL: {url}\n\n{content}")
+            md_path_to_url[md_path] = url
+            md_path_to_hash[md_path] = hash_markdown(content)
+            # Claimed now so concurrent sub-queries wait for this upload instead of uploading the same page again
+            claims[md_path] = processed_urls_in_session[canonicalize_url(url)] = asyncio.get_running_loop().create_future()
+
+        statuses = {}
+        try:
+            if md_path_to_url:
+                statuses = await self._ingest_files(
+                    list(md_path_to_url),
+                    kb_id=kb_id,
+                    mode=upload_mode,
+                    chunk_size=chunk_size,
+                    content_hashes=md_path_to_hash,
+                    sources=md_path_to_url,
+                    background=background,
+                )
+        except Exception as e:
+            log.color_print(f"<search_firecrawl_error> QAnything upload error for Firecrawl results of '{query}': {e}</search_firecrawl_error>\n")
+        finally:
+            # Always resolve the claims, or concurrent sub-queries would wait forever
+            for md_path, url in md_path_to_url.items():
+                indexed = statuses.get(md_path) == "green"
+                if not indexed and processed_urls_in_session.get(canonicalize_url(url)) is claims[md_path]:
+                    del processed_urls_in_session[canonicalize_url(url)] # Later sub-queries may upload it again
+                if not claims[md_path].done():
+                    claims[md_path].set_result(indexed)
+
+        for md_path, url in md_path_to_url.items():
+            status = statuses.get(md_path)
+            if status is None:
+                log.color_print(f"<search_firecrawl_error> QAnything upload error for Firecrawl result (URL: {url})</search_firecrawl_error>\n")
+            elif status != "green":
+                log.color_print(f"<search_firecrawl_error> QAnything indexing failed for Firecrawl result: {md_path} (URL: {url})</search_firecrawl_error>\n")
+            else:
+                log.color_print(f"<search_firecrawl> QAnything indexed Firecrawl result successfully: {md_path} (URL: {url})</search_firecrawl>\n")
+                indexed_urls.add(url)
+
+        if awaited_claims:
+            # Pages uploaded by concurrent sub-queries are searchable only once they are indexed
+            indexed = await asyncio.gather(*awaited_claims.values(), return_exceptions=True)
+            indexed_urls.update(url for url, is_indexed in zip(awaited_claims, indexed) if is_indexed is True)
+
         try:
             if os.path.exists(temp_dir):
                 shutil.rmtree(temp_dir)
         except Exception as e:
             log.color_print(f"<search_firecrawl_cleanup_error> Error removing temp Firecrawl dir {temp_dir}: {e}</search_firecrawl_cleanup_error>\n")
-
-        return retrieved_for_query, total_tokens_consumed # total_tokens_consumed for LLM reranking not applicable here
-
-    def _generate_gap_queries(
+        return indexed_urls
+
+    def _rank_web_pages_locally(self, query: str, pages: List[dict], chunk_size: int) -> List[RetrievalResult]:
+        """
+        Chunks the Firecrawl pages in memory and returns the best `max_firecrawl_qanything_chunks_to_process`
+        chunks by BM25 against `query`, referenced by their exact page URL. Scores are scaled to (0, 1]
+        so they sort alongside QAnything scores.
+        """
+        chunk_texts: List[str] = []
+        chunk_pages: List[dict] = []
+        for page in pages:
+            content = page.get("markdown") or page.get("content")
+            if not page.get("url") or not content:
+                continue
+            for chunk in chunk_markdown(content, chunk_size):
+                chunk_texts.append(chunk)
+                chunk_pages.append(page)
+        if not chunk_texts:
+            return []
+
+        scores = bm25_scores([query], chunk_texts)
+        best_score = float(scores.max())
+        if best_score <= 0:
+            return []
+        results = []
+        for i in np.argsort(-scores, kind="stable")[:self.max_firecrawl_qanything_chunks_to_process]:
+            if scores[i] <= 0:
+                break
+            page = chunk_pages[i]
+            results.append(RetrievalResult(
+                text=chunk_texts[i],
+                reference=page["url"],
+                score=float(scores[i]) / best_score,
+                metadata={
+                    "source": "firecrawl_web_search_local",
+                    "orig_query": query,
+                    "title": page.get("title") or (page.get("metadata") or {}).get("title", ""),
+                },
+            ))
+        return results
+
+    async def _generate_gap_queries(
         self, original_query: str, all_sub_queries: List[str], all_chunks: List[RetrievalResult]
     ) -> Tuple[List[str], int]:
         if len(all_chunks) > 0:
@@ -470,7 +1147,7 @@ class DeepSearch(RAGAgent):
             mini_questions=all_sub_queries,
             mini_chunk_str=mini_chunk_str,
         )
-        chat_response = self.llm.chat([{"role": "user", "content": reflect_prompt_content}])
+        chat_response = await self._achat([{"role": "user", "content": reflect_prompt_content}], phase="reflect")
         response_content = self.llm.remove_think(chat_response.content)
         try:
             return self.llm.literal_eval(response_content), chat_response.total_tokens
@@ -489,6 +1166,8 @@ class DeepSearch(RAGAgent):
         output_split_path_base = "./temp_qanything_uploads"
         os.makedirs(output_split_path_base, exist_ok=True)
         temp_split_dir = tempfile.mkdtemp(dir=output_split_path_base)
+        direct_upload_paths = []
+        split_pdf_tasks = []
 
         for file_path in file_paths:
             if not os.path.exists(file_path):
@@ -499,33 +1178,31 @@ class DeepSearch(RAGAgent):
             try:
                 if file_path.lower().endswith(".pdf") and num_split_pdf > 0:
                     log.color_print(f"<qanything_upload> Splitting PDF {file_path} into {num_split_pdf}-page chunks and uploading.</qanything_upload>\n")
-                    split_pdf_and_update_file_to_qanything(
-                        pdf_file=file_path,
-                        output_path=temp_split_dir,
-                        qanything_handler=self.qanything_handler,
-                        kb_id=kb_id,
-                        num_split=num_split_pdf
-                    )
-                    log.color_print(f"<qanything_upload> Finished splitting and uploading PDF: {file_path}</qanything_upload>\n")
+                    split_pdf_tasks.append(self._split_and_upload_pdf(file_path, temp_split_dir, kb_id, num_split_pdf))
                 else:
                     log.color_print(f"<qanything_upload> Directly uploading file: {file_path} (QAnything chunk_size: {chunk_size_qa})</qanything_upload>\n")
-                    upload_resp = self.qanything_handler.upload_file(
-                        file=file_path,
-                        kb_id=kb_id,
-                        mode="strong",
-                        chunk_size=chunk_size_qa
-                    )
-                    if upload_resp.get("code") == 200 and upload_resp.get("data"):
-                        file_id = upload_resp["data"][0]["file_id"]
-                        status = self.qanything_handler.wait_status_to_end(kb_id, file_id)
-                        if status == "green":
-                            log.color_print(f"<qanything_upload> QAnything indexed successfully: {file_path}</qanything_upload>\n")
-                        else:
-                            log.color_print(f"<qanything_upload_error> QAnything indexing FAILED for: {file_path} (status: {status})</qanything_upload_error>\n")
-                    else:
-                        log.color_print(f"<qanything_upload_error> QAnything upload FAILED for: {file_path}. Response: {upload_resp}</qanything_upload_error>\n")
+                    direct_upload_paths.append(file_path)
             except Exception as e:
                 log.color_print(f"<qanything_upload_exception> Error processing file {file_path}: {e}</qanything_upload_exception>\n")
+
+        # Direct uploads go out in multi-file batches while the PDFs are being split and uploaded
+        ingest_results = await asyncio.gather(
+            self._ingest_files(direct_upload_paths, kb_id=kb_id, mode="strong", chunk_size=chunk_size_qa),
+            *split_pdf_tasks,
+            return_exceptions=True,
+        )
+        statuses = ingest_results[0]
+        if isinstance(statuses, Exception):
+            log.color_print(f"<qanything_upload_exception> Error uploading files {direct_upload_paths}: {statuses}</qanything_upload_exception>\n")
+            statuses = {}
+        for file_path in direct_upload_paths:
+            status = statuses.get(file_path)
+            if status == "green":
+                log.color_print(f"<qanything_upload> QAnything indexed successfully: {file_path}</qanything_upload>\n")
+            elif status is None:
+                log.color_print(f"<qanything_upload_error> QAnything upload FAILED for: {file_path}</qanything_upload_error>\n")
+            else:
+                log.color_print(f"<qanything_upload_error> QAnything indexing FAILED for: {file_path} (status: {status})</qanything_upload_error>\n")
         try:
             if os.path.exists(temp_split_dir):
                  shutil.rmtree(temp_split_dir)
@@ -533,6 +1210,32 @@ class DeepSearch(RAGAgent):
             log.color_print(f"<qanything_upload_cleanup_error> Error removing temp upload directory {temp_split_dir}: {e}</qanything_upload_cleanup_error>\n")
 
 
+    async def _split_and_upload_pdf(self, file_path: str, output_path: str, kb_id: str, num_split_pdf: int):
+        try:
+            content_hash = None
+            if self.ingestion_manifest is not None:
+                content_hash = await asyncio.to_thread(hash_file, file_path)
+                entry = self.ingestion_manifest.lookup(content_hash)
+                if entry is not None and self._reuse_indexed_file(content_hash, entry, kb_id):
+                    log.color_print(f"<ingest_dedup> {file_path} is already indexed in KB {entry['kb_id']}. Skipping split and upload.</ingest_dedup>\n")
+                    return
+            part_file_ids = []
+            statuses = await self.async_qanything_handler.ingest_pdf(
+                file_path,
+                kb_id=kb_id,
+                output_path=output_path,
+                num_split=num_split_pdf,
+                callback=lambda part_path, file_id, status: part_file_ids.append(file_id),
+                progress_callback=self.on_upload_progress,
+            )
+            if content_hash is not None:
+                # The parts are indexed as separate files, the entry lists all of them
+                status = "green" if statuses and all(status == "green" for status in statuses) else "red"
+                self.ingestion_manifest.record(content_hash, kb_id, ",".join(part_file_ids), status, source=file_path)
+            log.color_print(f"<qanything_upload> Finished splitting and uploading PDF: {file_path}</qanything_upload>\n")
+        except Exception as e:
+            log.color_print(f"<qanything_upload_exception> Error processing file {file_path}: {e}</qanything_upload_exception>\n")
+
     def retrieve(self, original_query: str, **kwargs) -> Tuple[List[RetrievalResult], int, dict]:
         files = kwargs.pop("files", None)
         urls = kwargs.pop("urls", None)
@@ -540,7 +1243,7 @@ class DeepSearch(RAGAgent):
         qanything_upload_num_split_pdf = kwargs.pop("qanything_upload_num_split_pdf", 0)
         qanything_upload_chunk_size = kwargs.pop("qanything_upload_chunk_size", 800)
 
-        return asyncio.run(self.async_retrieve(
+        return asyncio.run(self._run_and_close_clients(self.async_retrieve(
             original_query,
             files=files,
             urls=urls,
@@ -548,7 +1251,16 @@ class DeepSearch(RAGAgent):
             qanything_upload_num_split_pdf=qanything_upload_num_split_pdf,
             qanything_upload_chunk_size=qanything_upload_chunk_size,
             **kwargs
-        ))
+        )))
+
+    async def _run_and_close_clients(self, coro):
+        """Runs `coro` and closes the QAnything and LLM clients bound to this event loop afterwards."""
+        try:
+            return await coro
+        finally:
+            self._release_kb_pins()
+            await self.async_qanything_handler.aclose()
+            await self.llm.aclose()
 
     async def async_retrieve(
         self,
@@ -561,17 +1273,24 @@ class DeepSearch(RAGAgent):
         **kwargs
     ) -> Tuple[List[RetrievalResult], int, dict]:
         max_iter_actual = kwargs.pop("max_iter", self.max_iter)
+        self.on_upload_progress = kwargs.pop("on_upload_progress", None)
         search_internet_actual = search_web if search_web is not None else self.search_internet
 
         log.color_print(f"<query> Original Query: {original_query} </query>\n")
         log.color_print(f"<params> Files: {files}, URLs: {urls}, Search Web Active: {search_internet_actual}, PDF Split Pages: {qanything_upload_num_split_pdf}, QA Chunk Size: {qanything_upload_chunk_size} </params>\n")
-        log.color_print(f"<params_limits> Max QA rerank: {self.max_qanything_chunks_to_rerank}, Max FC QA process: {self.max_firecrawl_qanything_chunks_to_process}, Min QA for web: {self.min_qanything_results_before_web_search}, Max for summary: {self.max_chunks_for_summary} </params_limits>\n")
+        log.color_print(f"<params_limits> Max QA rerank: {self.max_qanything_chunks_to_rerank} ({self.rerank_mode}), Max FC QA process: {self.max_firecrawl_qanything_chunks_to_process}, Min QA for web: {self.min_qanything_results_before_web_search}, Max for summary: {self.max_chunks_for_summary} </params_limits>\n")
 
         all_search_res: List[RetrievalResult] = []
         all_sub_queries: List[str] = []
         total_tokens: int = 0
+        self.usage_ledger = UsageLedger(self.token_budget)
+        self._release_kb_pins()
+        self.reused_kb_files = {}
 
-        processed_urls_in_session = set()
+        processed_urls_in_session: Dict[str, asyncio.Future] = {} # Canonical URL (see canonicalize_url) -> future resolving to whether the page got indexed
+        self.near_duplicates = NearDuplicateIndex()
+        self.markdown_cleaner = MarkdownCleaner(max_chars=self.max_page_chars)
+        self.speculation_stats = self._new_speculation_stats()
 
         if not self.qanything_kb_ids:
             log.color_print("<error> No QAnything KB IDs configured for DeepSearch.</error>\n")
@@ -596,24 +1315,39 @@ class DeepSearch(RAGAgent):
                 if not firecrawl_scrape:
                     log.color_print("<error> 'firecrawl_scrape' is not available (import failed). Skipping processing of direct URLs.</error>\n")
                 else:
-                    unique_input_urls = list(set(urls or []))
+                    # One URL per canonical URL, so tracking-parameter and http/www variants are scraped once
+                    unique_input_urls = list({canonicalize_url(url): url for url in reversed(urls or [])}.values())[::-1]
                     if not unique_input_urls:
                         log.color_print(f"<preprocess_urls> No unique URLs provided. Skipping direct URL processing.</preprocess_urls>\n")
                     else:
                         log.color_print(f"<preprocess_urls> Scraping and uploading content from {len(unique_input_urls)} unique URLs to QAnything KB: {target_kb_id}...</preprocess_urls>\n")
                         temp_url_md_dir = tempfile.mkdtemp(prefix="direct_urls_md_")
+                        md_path_to_url = {}
+                        md_path_to_hash = {}
+                        statuses = {}
+                        ingest_tasks = []
+                        pending_md_paths = []
+
+                        def start_ingest(md_paths):
+                            # Uploads start while the remaining URLs are still being scraped
+                            ingest_tasks.append(asyncio.create_task(self._ingest_files(
+                                md_paths,
+                                kb_id=target_kb_id,
+                                mode="strong",
+                                chunk_size=qanything_upload_chunk_size,
+                                content_hashes=md_path_to_hash,
+                                sources=md_path_to_url,
+                            )))
+
+                        urls_to_scrape = []
                         for url_to_scrape in unique_input_urls:
-                            if url_to_scrape in processed_urls_in_session:
+                            if canonicalize_url(url_to_scrape) in processed_urls_in_session:
                                 log.color_print(f"<preprocess_url_skip> Content for URL '{url_to_scrape}' already processed in this session. Skipping.</preprocess_url_skip>\n")
                                 continue
+                            urls_to_scrape.append(url_to_scrape)
+                        log.color_print(f"<preprocess_url_scrape> Scraping {len(urls_to_scrape)} URL(s) using API {self.firecrawl_api_url}...</preprocess_url_scrape>\n")
+                        async for url_to_scrape, fc_page_data in self._scrape_urls(urls_to_scrape, {"formats": ["markdown"]}):
                             try:
-                                log.color_print(f"<preprocess_url_scrape> Scraping URL: {url_to_scrape} using API {self.firecrawl_api_url}...</preprocess_url_scrape>\n")
-                                scrape_opts = {"formats": ["markdown"]}
-                                fc_page_data = await asyncio.to_thread(
-                                    firecrawl_scrape,
-                                    url_to_scrape=url_to_scrape,
-                                    scrape_options=scrape_opts,
-                                )
                                 fc_page_data = fc_page_data.get("data", {})
 
                                 if fc_page_data and (fc_page_data.get("markdown") or fc_page_data.get("content")):
@@ -621,34 +1355,48 @@ class DeepSearch(RAGAgent):
                                     if not content:
                                         log.color_print(f"<preprocess_url_warn> No content extracted from URL: {url_to_scrape}. Skipping.</preprocess_url_warn>\n")
                                         continue
+                                    if self.clean_scraped_markdown:
+                                        content = await asyncio.to_thread(
+                                            self.markdown_cleaner.clean, content, query=original_query, page_key=canonicalize_url(url_to_scrape)
+                                        )
+                                    if await asyncio.to_thread(self._is_near_duplicate, url_to_scrape, content, "direct URL"):
+                                        continue
 
                                     safe_name = "".join(c if c.isalnum() else "_" for c in url_to_scrape.replace("https://", "").replace("http://", ""))[:100]
                                     md_path = os.path.join(temp_url_md_dir, f"{safe_name}.md")
 
                                     with open(md_path, "w", encoding="utf-8") as f:
                                         f.write(f"# Content from URL: {url_to_scrape}\n\n{content}")
-
-                                    log.color_print(f"<preprocess_url_upload> Uploading scraped content from {url_to_scrape} (as {md_path}) to QAnything...</preprocess_url_upload>\n")
-                                    upload_resp = self.qanything_handler.upload_file(
-                                        file=md_path,
-                                        kb_id=target_kb_id,
-                                        mode="strong",
-                                        chunk_size=qanything_upload_chunk_size,
-                                    )
-                                    if upload_resp.get("code") == 200 and upload_resp.get("data"):
-                                        file_id = upload_resp["data"][0]["file_id"]
-                                        status = self.qanything_handler.wait_status_to_end(target_kb_id, file_id)
-                                        if status == "green":
-                                            log.color_print(f"<preprocess_url_success> QAnything indexed successfully: {url_to_scrape}</preprocess_url_success>\n")
-                                            processed_urls_in_session.add(url_to_scrape)
-                                        else:
-                                            log.color_print(f"<preprocess_url_error> QAnything indexing FAILED for: {url_to_scrape} (status: {status})</preprocess_url_error>\n")
-                                    else:
-                                        log.color_print(f"<preprocess_url_error> QAnything upload FAILED for scraped content of {url_to_scrape}. Response: {upload_resp}</preprocess_url_error>\n")
+                                    md_path_to_url[md_path] = url_to_scrape
+                                    md_path_to_hash[md_path] = hash_markdown(content)
+                                    pending_md_paths.append(md_path)
+                                    if len(pending_md_paths) >= self.async_qanything_handler.upload_batch_size:
+                                        start_ingest(pending_md_paths)
+                                        pending_md_paths = []
                                 else:
                                     log.color_print(f"<preprocess_url_error> Could not scrape meaningful content for URL: {url_to_scrape}. Response: {fc_page_data}</preprocess_url_error>\n")
                             except Exception as e:
                                 log.color_print(f"<preprocess_url_exception> Error processing URL {url_to_scrape}: {e}</preprocess_url_exception>\n")
+
+                        if pending_md_paths:
+                            start_ingest(pending_md_paths)
+                        if md_path_to_url:
+                            log.color_print(f"<preprocess_url_upload> Waiting for QAnything to index the scraped content of {len(md_path_to_url)} URL(s)...</preprocess_url_upload>\n")
+                            for ingest_result in await asyncio.gather(*ingest_tasks, return_exceptions=True):
+                                if isinstance(ingest_result, Exception):
+                                    log.color_print(f"<preprocess_url_exception> Error uploading scraped URLs: {ingest_result}</preprocess_url_exception>\n")
+                                else:
+                                    statuses.update(ingest_result)
+                            for md_path, url_to_scrape in md_path_to_url.items():
+                                status = statuses.get(md_path)
+                                if status == "green":
+                                    log.color_print(f"<preprocess_url_success> QAnything indexed successfully: {url_to_scrape}</preprocess_url_success>\n")
+                                    processed_urls_in_session[canonicalize_url(url_to_scrape)] = indexed_claim = asyncio.get_running_loop().create_future()
+                                    indexed_claim.set_result(True)
+                                elif status is None:
+                                    log.color_print(f"<preprocess_url_error> QAnything upload FAILED for scraped content of {url_to_scrape}</preprocess_url_error>\n")
+                                else:
+                                    log.color_print(f"<preprocess_url_error> QAnything indexing FAILED for: {url_to_scrape} (status: {status})</preprocess_url_error>\n")
                         try:
                             if os.path.exists(temp_url_md_dir):
                                 shutil.rmtree(temp_url_md_dir)
@@ -656,7 +1404,7 @@ class DeepSearch(RAGAgent):
                             log.color_print(f"<preprocess_url_cleanup_error> Error removing temp URL MD directory {temp_url_md_dir}: {e}</preprocess_url_cleanup_error>\n")
                         log.color_print(f"<preprocess_urls> Finished processing specified URLs.</preprocess_urls>\n")
 
-        sub_queries, used_token = self._generate_sub_queries(original_query)
+        sub_queries, used_token = await self._generate_sub_queries(original_query)
         total_tokens += used_token
         if not sub_queries:
             log.color_print("<think> No sub queries were generated. Using original query.</think>\n")
@@ -673,10 +1421,19 @@ class DeepSearch(RAGAgent):
                 log.color_print("<think> No gap queries to process. Exiting loop.</think>\n")
                 break
 
+            if self._budget_nearly_exhausted():
+                log.color_print(f"<think_budget> Token budget nearly exhausted ({self.usage_ledger.total_tokens}/{self.token_budget}). Skipping to summarization.</think_budget>\n")
+                break
+
             current_iteration_chunks: List[RetrievalResult] = []
             qanything_results_for_current_iter: Dict[str, List[RetrievalResult]] = {}
 
 
+            # Speculative web searches run while QAnything is searched and are dropped if QAnything finds enough
+            speculative_web_searches: Dict[str, asyncio.Task] = {}
+            if self.speculative_web_search and search_internet_actual and target_kb_id:
+                speculative_web_searches = self._start_speculative_web_searches(sub_gap_queries, **kwargs)
+
             # --- QAnything Search Phase for current sub_gap_queries ---
             if target_kb_id: # Only search QAnything if a KB is configured
                 qanything_search_tasks = []
@@ -709,10 +1466,13 @@ class DeepSearch(RAGAgent):
                             all_sub_queries,
                             processed_urls_in_session,
                             chunk_size=qanything_upload_chunk_size,
+                            prefetched_pages=speculative_web_searches.pop(s_query, None),
                             **kwargs
                         ))
                     else:
                         log.color_print(f"<think_skip_web_search> QAnything found sufficient results ({len(qanything_results_for_current_iter.get(s_query, []))}) for '{s_query}'. Skipping web search for this sub-query.</think_skip_web_search>\n")
+            for s_query, task in speculative_web_searches.items():
+                self._discard_speculative_web_search(s_query, task)
 
             if firecrawl_search_tasks:
                 gathered_firecrawl_results = await asyncio.gather(*firecrawl_search_tasks)
@@ -728,10 +1488,14 @@ class DeepSearch(RAGAgent):
                 log.color_print("<think> Reached maximum iterations. Exiting search loop.</think>\n")
                 break
 
+            if self._budget_nearly_exhausted():
+                log.color_print(f"<think_budget> Token budget nearly exhausted ({self.usage_ledger.total_tokens}/{self.token_budget}). Skipping reflection and going to summarization.</think_budget>\n")
+                break
+
             log.color_print("<think> Reflecting on search results...</think>\n")
             reflection_chunks = sort_and_limit_results(all_search_res, self.max_chunks_for_summary + 10)
 
-            new_gap_queries, consumed_token_reflect = self._generate_gap_queries(
+            new_gap_queries, consumed_token_reflect = await self._generate_gap_queries(
                 original_query, list(set(all_sub_queries)), reflection_chunks
             )
             total_tokens += consumed_token_reflect
@@ -752,10 +1516,20 @@ class DeepSearch(RAGAgent):
         all_search_res = sort_and_limit_results(all_search_res, self.max_chunks_for_summary)
         log.color_print(f"<retrieve_summary> Total unique retrieved chunks after final limit: {len(all_search_res)} (max_chunks_for_summary={self.max_chunks_for_summary})</retrieve_summary>\n")
 
+        if self.markdown_cleaner.pages:
+            cleanup_stats = self.markdown_cleaner.stats()
+            log.color_print(f"<markdown_cleanup> Cleaned {cleanup_stats['pages']} scraped page(s): {cleanup_stats['bytes_in']} -> {cleanup_stats['bytes_out']} bytes ({cleanup_stats['bytes_saved']} saved).</markdown_cleanup>\n")
+        if self.speculation_stats["started"] or self.speculation_stats["skipped_by_cap"]:
+            log.color_print(f"<speculative_web_search> Speculative web searches: {self.speculation_stats}</speculative_web_search>\n")
         additional_info = {"all_sub_queries": list(set(all_sub_queries))}
         return all_search_res, total_tokens, additional_info
 
     def query(self, query: str, **kwargs) -> Tuple[str, List[RetrievalResult], int]:
+        return asyncio.run(self._run_and_close_clients(self.async_query(query, **kwargs)))
+
+    async def async_query(self, query: str, **kwargs) -> Tuple[str, List[RetrievalResult], int]:
+        # Optional callback receiving report text deltas as the summary is generated
+        on_token = kwargs.pop("on_token", None)
         files = kwargs.pop("files", None)
         urls = kwargs.pop("urls", None)
         search_web = kwargs.pop("search_web", None)
@@ -763,7 +1537,7 @@ class DeepSearch(RAGAgent):
         qanything_upload_chunk_size = kwargs.pop("qanything_upload_chunk_size", 800)
 
 
-        all_retrieved_results, n_token_retrieval, additional_info = self.retrieve(
+        all_retrieved_results, n_token_retrieval, additional_info = await self.async_retrieve(
             query,
             files=files,
             urls=urls,
@@ -789,16 +1563,41 @@ class DeepSearch(RAGAgent):
             mini_chunk_str=formatted_chunks_for_summary,
         )
 
-        chat_response = self.llm.chat([{"role": "user", "content": summary_prompt_content}])
-
-        final_answer = self.llm.remove_think(chat_response.content)
+        summary_messages = [{"role": "user", "content": summary_prompt_content}]
+        if on_token is None:
+            chat_response = await self._achat(summary_messages, phase="summary")
+            summary_content, summary_tokens = chat_response.content, chat_response.total_tokens
+        else:
+            summary_parts = []
+            summary_usage = ChatResponse(content="", total_tokens=0)
+            summary_llm = self.llm.for_role("summary")
+            think_filter = ThinkStreamFilter() # The reasoning of the model is not part of the answer
+            start_time = time.time()
+            async for delta in summary_llm.achat_stream(summary_messages):
+                if delta.content:
+                    summary_parts.append(delta.content)
+                    visible = think_filter.feed(delta.content)
+                    if visible:
+                        on_token(visible)
+                summary_usage.total_tokens += delta.total_tokens
+                summary_usage.prompt_tokens += delta.prompt_tokens
+                summary_usage.completion_tokens += delta.completion_tokens
+                summary_usage.cached_tokens += delta.cached_tokens
+            visible = think_filter.flush()
+            if visible:
+                on_token(visible)
+            self.usage_ledger.record("summary", summary_usage, time.time() - start_time, model=getattr(summary_llm, "model", None))
+            summary_content = "".join(summary_parts)
+            summary_tokens = summary_usage.total_tokens
+
+        final_answer = self.llm.remove_think(summary_content)
         log.color_print("\n==== FINAL ANSWER ====\n")
         log.color_print(final_answer)
 
         return (
             final_answer,
             all_retrieved_results,
-            n_token_retrieval + chat_response.total_tokens,
+            n_token_retrieval + summary_tokens,
         )
 
     def _format_chunk_texts_for_reflection(self, chunk_texts: List[str], references: List[str]) -> str:
@@ -816,7 +1615,7 @@ class DeepSearch(RAGAgent):
 
 
 if __name__ == "__main__":
-    from openai_llm import OpenAI
+    from openai_llm import OpenAI, RoutedLLM
 
     # --- Configuration ---
     # 1) 从环境读取
@@ -832,7 +1631,7 @@ if __name__ == "__main__":
     os.environ["OPENAI_BASE_URL"] = OPENAI_BASE_URL
 
     # ---- Instantiate LLM ----
-    llm_instance = OpenAI(model=OPENAI_MODEL_NAME)
+    llm_instance = RoutedLLM.from_env(OpenAI(model=OPENAI_MODEL_NAME))
 
 
     # --- QAnything Setup ---
@@ -884,6 +1683,8 @@ if __name__ == "__main__":
         search_internet= _bool("SEARCH_INTERNET", False),
         firecrawl_api_url= FIRECRAWL_API_URL,
         max_qanything_chunks_to_rerank      = _int("MAX_QANYTHING_CHUNKS_TO_RERANK", 10),
+        rerank_mode                         = os.getenv("RERANK_MODE", "per_chunk"),
+        reranker                            = os.getenv("RERANKER", "llm"),
         max_firecrawl_qanything_chunks_to_process = _int("MAX_FIRECRAWL_QANYTHING_CHUNKS_TO_PROCESS", 10),
         min_qanything_results_before_web_search   = _int("MIN_QANYTHING_RESULTS_BEFORE_WEB_SEARCH", 2),
         max_chunks_for_summary                 = _int("MAX_CHUNKS_FOR_SUMMARY", 25),
@@ -1,10 +1,714 @@
 import os
+import asyncio
+import hashlib
 import requests
 import json
+import sqlite3
+import threading
+import re
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
+import httpx
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 load_dotenv()
 
+_session = None
+_session_lock = threading.Lock()
+
+def _get_session() -> requests.Session:
+    """
+    Return the process-wide pooled session used for Firecrawl requests.
+
+    The pool holds FIRECRAWL_POOL_SIZE keep-alive connections (default 16), so concurrent
+    scrapes from worker threads reuse connections instead of opening one per request.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            pool_size = int(os.getenv("FIRECRAWL_POOL_SIZE", 16))
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=True)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session = session
+        return _session
+
+def _timeout() -> tuple:
+    return (10, float(os.getenv("FIRECRAWL_TIMEOUT_SECONDS", 120)))
+
+# Only parameters that never change the page: generic ones such as `ref` (a branch on GitHub) or `from` select content
+TRACKING_PARAMS = {
+    "fbclid", "gclid", "dclid", "gbraid", "wbraid", "msclkid", "yclid", "mc_cid", "mc_eid", "igshid", "ref_src",
+    "_hsenc", "_hsmi", "__twitter_impression",
+}
+TRACKING_PARAM_PREFIXES = ("utm_", "pk_", "mtm_")
+
+_redirects = OrderedDict()
+_redirects_lock = threading.Lock()
+_MAX_REDIRECTS = 10000
+
+def _normalize_url(url: str) -> str:
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    if (scheme == "http" and netloc.endswith(":80")) or (scheme == "https" and netloc.endswith(":443")):
+        netloc = netloc.rsplit(":", 1)[0]
+    if scheme in ("http", "https"):
+        # The http/https and www/bare variants of a site serve the same pages
+        scheme = "https"
+        if netloc.startswith("www."):
+            netloc = netloc[4:]
+    path = parts.path or "/"
+    if len(path) > 1 and path.endswith("/"):
+        path = path.rstrip("/") or "/"
+    query = urlencode(sorted(
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if key.lower() not in TRACKING_PARAMS and not key.lower().startswith(TRACKING_PARAM_PREFIXES)
+    ))
+    return urlunsplit((scheme, netloc, path, query, ""))
+
+def canonicalize_url(url: str) -> str:
+    """
+    Normalize a URL so that different spellings of the same page compare equal.
+
+    Lowercases the host, treats http/https and www/bare hosts alike, drops default ports, the fragment,
+    trailing slashes and tracking parameters (utm_*, fbclid, gclid, ...), sorts the remaining query
+    parameters, and follows redirects seen in earlier scrapes (see record_redirect).
+
+    Args:
+        url (str): The URL to normalize.
+
+    Returns:
+        str: The canonical URL.
+    """
+    canonical = _normalize_url(url)
+    with _redirects_lock:
+        return _redirects.get(canonical, canonical)
+
+def record_redirect(source_url: str, final_url: str) -> None:
+    """
+    Remember that `source_url` redirects to `final_url`, so both canonicalize to the same URL.
+
+    Args:
+        source_url (str): The requested URL.
+        final_url (str): The URL the request ended up at.
+    """
+    source, final = _normalize_url(source_url), canonicalize_url(final_url)
+    if source == final:
+        return
+    with _redirects_lock:
+        _redirects[source] = final
+        _redirects.move_to_end(source)
+        while len(_redirects) > _MAX_REDIRECTS:
+            _redirects.popitem(last=False)
+
+def _record_scrape_redirect(requested_url: str, result: dict) -> None:
+    data = result.get("data") if isinstance(result, dict) else None
+    final_url = ((data or {}).get("metadata") or {}).get("url")
+    if final_url:
+        record_redirect(requested_url, final_url)
+
+
+class PageCache:
+    """
+    On-disk cache of scraped pages, keyed by canonical URL and scrape options.
+
+    Entries younger than `ttl_seconds` are served without any request. Older entries that carry an
+    ETag or Last-Modified validator are revalidated with a conditional request to the origin and
+    served again on "304 Not Modified"; everything else is scraped anew. The least recently used
+    entries are evicted once the cache grows past `max_bytes`.
+
+    It also remembers the result URLs of recent searches, so firecrawl_search can tell when all
+    pages of a search are cached and skip scraping them.
+
+    Attributes:
+        hits (int): Lookups served from a fresh entry.
+        revalidated (int): Lookups served from a stale entry the origin confirmed unchanged.
+        misses (int): Lookups that needed a new scrape.
+        evictions (int): Entries evicted to stay under `max_bytes`.
+    """
+
+    def __init__(self, path: str, ttl_seconds: float = 86400, max_bytes: int = 512 * 1024 * 1024,
+                 revalidate: bool = True):
+        """
+        Initialize a PageCache.
+
+        Args:
+            path (str): Path of the SQLite database holding the pages.
+            ttl_seconds (float): Age after which an entry is revalidated or scraped again.
+            max_bytes (int): Maximum total size of the cached responses.
+            revalidate (bool): Whether to keep ETag/Last-Modified validators of stored pages and use them to
+                               revalidate stale entries. Validators missing from the scrape metadata are
+                               fetched from the origin in the background.
+        """
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.revalidate = revalidate
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._validator_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="page-cache-validators")
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            "cache_key TEXT PRIMARY KEY, url TEXT NOT NULL, response TEXT NOT NULL, etag TEXT, last_modified TEXT, "
+            "fetched_at REAL NOT NULL, last_access REAL NOT NULL, size INTEGER NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_pages_last_access ON pages (last_access)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS search_urls (search_key TEXT PRIMARY KEY, urls TEXT NOT NULL, stored_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(url: str, scrape_options: dict = None) -> str:
+        options = json.dumps(scrape_options or {}, sort_keys=True)
+        return hashlib.sha256(f"{canonicalize_url(url)}\n{options}".encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _search_key(query: str, limit: int, scrape_options: dict = None) -> str:
+        payload = json.dumps([SearchCache.normalize_query(query), limit, scrape_options or {}], sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def remember_search(self, query: str, limit: int, scrape_options: dict, urls: list) -> None:
+        """
+        Record the result URLs of a search.
+        """
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO search_urls (search_key, urls, stored_at) VALUES (?, ?, ?)",
+                (self._search_key(query, limit, scrape_options), json.dumps(urls), time.time()),
+            )
+            # URLs remembered longer ago than the TTL are no longer cached as fresh pages anyway
+            self._conn.execute("DELETE FROM search_urls WHERE stored_at < ?", (time.time() - self.ttl_seconds,))
+            self._conn.commit()
+
+    def search_is_cached(self, query: str, limit: int, scrape_options: dict) -> bool:
+        """
+        Return whether the last search for `query` returned pages that are all fresh in the cache.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT urls FROM search_urls WHERE search_key = ?", (self._search_key(query, limit, scrape_options),)
+            ).fetchone()
+            if row is None or not json.loads(row[0]):
+                return False
+            keys = [self.make_key(url, scrape_options) for url in json.loads(row[0])]
+            fresh = self._conn.execute(
+                f"SELECT COUNT(*) FROM pages WHERE fetched_at >= ? AND cache_key IN ({','.join('?' * len(keys))})",
+                (time.time() - self.ttl_seconds, *keys),
+            ).fetchone()[0]
+        return fresh == len(set(keys))
+
+    def get(self, url: str, scrape_options: dict = None):
+        """
+        Return the cached scrape response for `url`, or None if it has to be scraped again.
+
+        Args:
+            url (str): The URL of the page.
+            scrape_options (dict): The scrape options the page was requested with.
+
+        Returns:
+            dict: A firecrawl_scrape response, or None.
+        """
+        key = self.make_key(url, scrape_options)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, etag, last_modified, fetched_at FROM pages WHERE cache_key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        response, etag, last_modified, fetched_at = row
+        now = time.time()
+        if now - fetched_at < self.ttl_seconds:
+            counter = "hits"
+        elif self.revalidate and (etag or last_modified) and self._not_modified(url, etag, last_modified):
+            counter = "revalidated"
+        else:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+            if counter == "revalidated":
+                self._conn.execute("UPDATE pages SET fetched_at = ?, last_access = ? WHERE cache_key = ?", (now, now, key))
+            else:
+                self._conn.execute("UPDATE pages SET last_access = ? WHERE cache_key = ?", (now, key))
+            self._conn.commit()
+        return json.loads(response)
+
+    def set(self, url: str, scrape_options: dict, response: dict) -> None:
+        """
+        Store a successful scrape response for `url` and evict old entries if the cache is too large.
+
+        Args:
+            url (str): The URL of the page.
+            scrape_options (dict): The scrape options the page was requested with.
+            response (dict): The firecrawl_scrape response.
+        """
+        if not isinstance(response, dict) or "error" in response or not response.get("data"):
+            return
+        etag, last_modified = None, None
+        if self.revalidate:
+            metadata = {key.lower(): value for key, value in (response["data"].get("metadata") or {}).items()}
+            etag = metadata.get("etag")
+            last_modified = metadata.get("last-modified") or metadata.get("lastmodified")
+        key = self.make_key(url, scrape_options)
+        payload = json.dumps(response, ensure_ascii=False)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO pages (cache_key, url, response, etag, last_modified, fetched_at, last_access, size) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, canonicalize_url(url), payload, etag, last_modified, now, now, len(payload.encode("utf-8"))),
+            )
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+            if total > self.max_bytes:
+                for key, size in self._conn.execute("SELECT cache_key, size FROM pages ORDER BY last_access").fetchall():
+                    if total <= self.max_bytes:
+                        break
+                    self._conn.execute("DELETE FROM pages WHERE cache_key = ?", (key,))
+                    total -= size
+                    self.evictions += 1
+            self._conn.commit()
+        if self.revalidate and not (etag or last_modified):
+            # Not needed before the entry goes stale, so the scrape does not wait for it
+            self._validator_executor.submit(self._store_validators, key, url, now)
+
+    def _store_validators(self, key: str, url: str, fetched_at: float) -> None:
+        try:
+            response = _get_session().head(url, allow_redirects=True, timeout=(5, 10))
+        except requests.exceptions.RequestException:
+            return
+        etag, last_modified = response.headers.get("ETag"), response.headers.get("Last-Modified")
+        if not (etag or last_modified):
+            return
+        with self._lock:
+            self._conn.execute(
+                "UPDATE pages SET etag = ?, last_modified = ? WHERE cache_key = ? AND fetched_at = ?",
+                (etag, last_modified, key, fetched_at),
+            )
+            self._conn.commit()
+
+    def _not_modified(self, url: str, etag: str, last_modified: str) -> bool:
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        try:
+            # stream=True: if the page did change, its body is not downloaded here
+            with _get_session().get(url, headers=headers, stream=True, allow_redirects=True, timeout=(5, 10)) as response:
+                return response.status_code == 304 or (bool(etag) and response.headers.get("ETag") == etag)
+        except requests.exceptions.RequestException:
+            return False
+
+    def stats(self) -> dict:
+        """
+        Return hit/revalidation/miss counters and the size of the cache.
+        """
+        with self._lock:
+            entries, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM pages").fetchone()
+        lookups = self.hits + self.revalidated + self.misses
+        return {
+            "hits": self.hits,
+            "revalidated": self.revalidated,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.revalidated) / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": entries,
+            "size_bytes": size,
+        }
+
+
+_page_cache = None
+_page_cache_lock = threading.Lock()
+
+def get_page_cache():
+    """
+    Return the process-wide PageCache configured by FIRECRAWL_PAGE_CACHE_PATH, FIRECRAWL_PAGE_CACHE_TTL_SECONDS,
+    FIRECRAWL_PAGE_CACHE_MAX_MB and FIRECRAWL_PAGE_CACHE_REVALIDATE, or None if no path is configured.
+    """
+    global _page_cache
+    path = os.getenv("FIRECRAWL_PAGE_CACHE_PATH")
+    if not path:
+        return None
+    with _page_cache_lock:
+        if _page_cache is None:
+            _page_cache = PageCache(
+                path,
+                ttl_seconds=float(os.getenv("FIRECRAWL_PAGE_CACHE_TTL_SECONDS", 86400)),
+                max_bytes=int(float(os.getenv("FIRECRAWL_PAGE_CACHE_MAX_MB", 512)) * 1024 * 1024),
+                revalidate=os.getenv("FIRECRAWL_PAGE_CACHE_REVALIDATE", "true").lower() == "true",
+            )
+        return _page_cache
+
+class SearchCache:
+    """
+    Short-lived LRU cache of firecrawl_search responses, keyed by normalized query, limit and scrape options.
+
+    Entries expire after `ttl_seconds`; at most `max_entries` are kept. With a `path`, entries are also
+    written to SQLite, so they survive restarts and are shared by processes using the same file.
+
+    Attributes:
+        hits (int): Lookups answered from the cache.
+        misses (int): Lookups that needed a search.
+        evictions (int): Entries dropped to stay within `max_entries`.
+    """
+
+    def __init__(self, ttl_seconds: float = 300, max_entries: int = 256, path: str = None):
+        """
+        Initialize a SearchCache.
+
+        Args:
+            ttl_seconds (float): Time after which a cached response is searched again.
+            max_entries (int): Maximum number of cached responses.
+            path (str): Optional path of a SQLite database persisting the cache.
+        """
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        if path:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS search_results (cache_key TEXT PRIMARY KEY, response TEXT NOT NULL, stored_at REAL NOT NULL)"
+            )
+            self._conn.commit()
+
+    @staticmethod
+    def normalize_query(query: str) -> str:
+        """
+        Casefold the query, collapse whitespace and drop surrounding punctuation, so slight rephrasings share an entry.
+        """
+        return re.sub(r"\s+", " ", query.casefold()).strip(" \t\n?!.,;:\"'")
+
+    def make_key(self, query: str, limit: int, scrape_options: dict = None) -> str:
+        payload = json.dumps([self.normalize_query(query), limit, scrape_options or {}], sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, query: str, limit: int, scrape_options: dict = None):
+        """
+        Return the cached search response, or None on a miss.
+
+        Returns:
+            dict: A copy of the cached firecrawl_search response, or None.
+        """
+        key = self.make_key(query, limit, scrape_options)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None and self._conn is not None:
+                entry = self._conn.execute(
+                    "SELECT stored_at, response FROM search_results WHERE cache_key = ?", (key,)
+                ).fetchone()
+                if entry is not None:
+                    self._remember(key, entry)
+            if entry is None or now - entry[0] >= self.ttl_seconds:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        # Callers get their own copy, they may modify the results
+        return json.loads(entry[1])
+
+    def set(self, query: str, limit: int, scrape_options: dict, response: dict) -> None:
+        """
+        Store a successful search response.
+        """
+        if not isinstance(response, dict) or "error" in response or response.get("success") is False:
+            return
+        key = self.make_key(query, limit, scrape_options)
+        entry = (time.time(), json.dumps(response, ensure_ascii=False))
+        with self._lock:
+            self._remember(key, entry)
+            if self._conn is not None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO search_results (cache_key, response, stored_at) VALUES (?, ?, ?)",
+                    (key, entry[1], entry[0]),
+                )
+                # Expired rows and rows beyond max_entries are not needed any more
+                self._conn.execute("DELETE FROM search_results WHERE stored_at < ?", (entry[0] - self.ttl_seconds,))
+                self._conn.execute(
+                    "DELETE FROM search_results WHERE cache_key NOT IN "
+                    "(SELECT cache_key FROM search_results ORDER BY stored_at DESC LIMIT ?)",
+                    (self.max_entries,),
+                )
+                self._conn.commit()
+
+    def _remember(self, key: str, entry: tuple) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        """
+        Return hit/miss counters and the number of cached responses.
+        """
+        with self._lock:
+            hits, misses, evictions, entries = self.hits, self.misses, self.evictions, len(self._entries)
+        lookups = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "evictions": evictions,
+            "entries": entries,
+        }
+
+
+_search_cache = None
+_search_cache_lock = threading.Lock()
+
+def get_search_cache():
+    """
+    Return the process-wide SearchCache configured by FIRECRAWL_SEARCH_CACHE_TTL_SECONDS,
+    FIRECRAWL_SEARCH_CACHE_MAX_ENTRIES and FIRECRAWL_SEARCH_CACHE_PATH, or None if the TTL is 0.
+    """
+    global _search_cache
+    ttl_seconds = float(os.getenv("FIRECRAWL_SEARCH_CACHE_TTL_SECONDS", 0))
+    if ttl_seconds <= 0:
+        return None
+    with _search_cache_lock:
+        if _search_cache is None:
+            _search_cache = SearchCache(
+                ttl_seconds=ttl_seconds,
+                max_entries=int(os.getenv("FIRECRAWL_SEARCH_CACHE_MAX_ENTRIES", 256)),
+                path=os.getenv("FIRECRAWL_SEARCH_CACHE_PATH") or None,
+            )
+        return _search_cache
+
+_LINK_RE = re.compile(r"!?\[([^\]]*)\]\([^)]*\)")
+_IMAGE_RE = re.compile(r"!\[[^\]]*\]\([^)]*\)")
+_BOILERPLATE_RE = re.compile(
+    r"cookie|accept all|privacy policy|terms of (use|service)|all rights reserved|subscribe to|newsletter|"
+    r"sign up|log in|skip to (main )?content|back to top|share this|©|copyright|"
+    r"版权所有|隐私政策|登录|注册|关注我们|分享到|返回顶部|扫码|免责声明",
+    re.IGNORECASE,
+)
+_QUERY_TERM_RE = re.compile(r"[a-z0-9]+|[\u4e00-\u9fff]")
+_LATIN_TERM_RE = re.compile(r"[a-z0-9]{3,}")
+_CJK_RUN_RE = re.compile(r"[\u4e00-\u9fff]+")
+_FENCE_RE = re.compile(r"^[ \t]{0,3}(`{3,}|~{3,})")
+
+def _iter_blocks(markdown: str):
+    """
+    Split markdown into blocks at blank lines. A fenced code block stays in one block with the text around it.
+    """
+    lines = []
+    fence = None
+    for line in markdown.split("\n"):
+        match = _FENCE_RE.match(line)
+        if match and fence is None:
+            fence = match.group(1)
+        elif match and match.group(1)[0] == fence[0] and len(match.group(1)) >= len(fence):
+            fence = None
+        elif fence is None and not line.strip():
+            yield "\n".join(lines)
+            lines = []
+            continue
+        lines.append(line)
+    yield "\n".join(lines)
+
+def _query_terms(query: str) -> set:
+    """
+    Words of 3+ characters and CJK character bigrams of `query`, which mark a block as relevant to it.
+    """
+    query = (query or "").casefold()
+    terms = set(_LATIN_TERM_RE.findall(query))
+    for run in _CJK_RUN_RE.findall(query):
+        terms.update(run[i:i + 2] for i in range(max(1, len(run) - 1)))
+    return terms
+
+def _has_query_term(text: str, terms: set) -> bool:
+    text = text.casefold()
+    return bool(terms & set(_LATIN_TERM_RE.findall(text))) or any(term in text for term in terms if not term.isascii())
+
+
+class MarkdownCleaner:
+    """
+    Removes boilerplate from scraped markdown and caps its size before it is uploaded.
+
+    Blocks (runs of text between blank lines) are dropped when they are link-dense (navigation
+    menus, link farms), image-only, short blocks that look like cookie banners, login prompts or
+    footers, or repeats of a block seen on another page (site-wide chrome). The last two rules only
+    apply to blocks with links that do not mention the query, and fenced code blocks are always
+    kept. Pages still longer than `max_chars` keep the blocks most relevant to the query, in their
+    original order.
+
+    One cleaner is meant to be used per job: it remembers blocks across the pages it cleans and
+    counts the bytes it removes.
+
+    Attributes:
+        pages (int): Number of pages cleaned.
+        bytes_in (int): UTF-8 size of the pages before cleaning.
+        bytes_out (int): UTF-8 size of the pages after cleaning.
+        blocks_dropped (int): Number of boilerplate blocks removed.
+        pages_capped (int): Number of pages shortened to `max_chars`.
+    """
+
+    def __init__(self, max_chars: int = 50000, link_density: float = 0.6, boilerplate_max_chars: int = 200,
+                 repeat_max_chars: int = 1000):
+        """
+        Initialize a MarkdownCleaner.
+
+        Args:
+            max_chars (int): Maximum length of a cleaned page (0 = no cap).
+            link_density (float): Share of link text above which a block with 3+ links is dropped.
+            boilerplate_max_chars (int): Only blocks up to this length are checked for boilerplate phrases.
+            repeat_max_chars (int): Only blocks up to this length are dropped as repeats from other pages.
+        """
+        self.max_chars = max_chars
+        self.link_density = link_density
+        self.boilerplate_max_chars = boilerplate_max_chars
+        self.repeat_max_chars = repeat_max_chars
+        self.pages = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.blocks_dropped = 0
+        self.pages_capped = 0
+        self._block_pages = {}
+        self._lock = threading.Lock()
+
+    def _is_boilerplate(self, block: str, page_key: str, page_blocks: set, terms: set) -> bool:
+        stripped = block.strip()
+        if not stripped:
+            return True
+        if any(_FENCE_RE.match(line) for line in stripped.split("\n")):
+            return False # Code
+        if not _IMAGE_RE.sub("", stripped).strip():
+            return True # Image-only block
+        links = _LINK_RE.findall(stripped)
+        visible = _LINK_RE.sub(lambda m: m.group(1), stripped).strip()
+        if not visible:
+            return True
+        if len(links) >= 3 and sum(len(text) for text in links) / len(visible) > self.link_density:
+            return True
+        if not links or _has_query_term(visible, terms):
+            return False
+        if len(visible) <= self.boilerplate_max_chars and not stripped.startswith("#") and _BOILERPLATE_RE.search(visible):
+            return True
+
+        if len(stripped) <= self.repeat_max_chars:
+            fingerprint = hashlib.blake2b(" ".join(stripped.casefold().split()).encode("utf-8"), digest_size=8).digest()
+            if fingerprint in page_blocks:
+                return True
+            page_blocks.add(fingerprint)
+            with self._lock:
+                first_page = self._block_pages.setdefault(fingerprint, page_key)
+            if first_page != page_key:
+                return True
+        return False
+
+    def _cap(self, blocks: list, query: str) -> list:
+        terms = set(_QUERY_TERM_RE.findall((query or "").casefold()))
+
+        def relevance(block):
+            tokens = _QUERY_TERM_RE.findall(block.casefold())
+            if not tokens or not terms:
+                return 0.0
+            return sum(1 for token in tokens if token in terms) / len(tokens) ** 0.5
+
+        order = sorted(range(len(blocks)), key=lambda i: (-relevance(blocks[i]), i))
+        selected = set()
+        remaining = self.max_chars
+        for i in order:
+            if len(blocks[i]) + 2 <= remaining:
+                selected.add(i)
+                remaining -= len(blocks[i]) + 2
+        if not selected:
+            return [blocks[order[0]][:self.max_chars]]
+        return [blocks[i] for i in sorted(selected)]
+
+    def clean(self, markdown: str, query: str = None, page_key: str = None) -> str:
+        """
+        Return `markdown` without boilerplate blocks, capped to `max_chars` by relevance to `query`.
+
+        Args:
+            markdown (str): The scraped markdown.
+            query (str): The query the page was fetched for, used to pick blocks when capping.
+            page_key (str): Identifies the page (e.g. its canonical URL), so cleaning the same page
+                            again does not count its blocks as repeats from another page.
+
+        Returns:
+            str: The cleaned markdown.
+        """
+        page_key = page_key or hashlib.blake2b(markdown.encode("utf-8"), digest_size=8).hexdigest()
+        page_blocks = set()
+        terms = _query_terms(query)
+        blocks = []
+        dropped = 0
+        for block in _iter_blocks(markdown):
+            if self._is_boilerplate(block, page_key, page_blocks, terms):
+                dropped += block.strip() != ""
+            else:
+                blocks.append(block.strip("\n"))
+        capped = bool(self.max_chars) and sum(len(block) + 2 for block in blocks) > self.max_chars
+        if capped:
+            blocks = self._cap(blocks, query)
+        cleaned = "\n\n".join(blocks)
+        with self._lock:
+            self.pages += 1
+            self.bytes_in += len(markdown.encode("utf-8"))
+            self.bytes_out += len(cleaned.encode("utf-8"))
+            self.blocks_dropped += dropped
+            self.pages_capped += capped
+        return cleaned
+
+    def stats(self) -> dict:
+        """
+        Return the number of pages cleaned and the bytes removed from them.
+        """
+        return {
+            "pages": self.pages,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "bytes_saved": self.bytes_in - self.bytes_out,
+            "blocks_dropped": self.blocks_dropped,
+            "pages_capped": self.pages_capped,
+        }
+
+
+def _fill_search_results(results: dict, scrape_options: dict) -> None:
+    """
+    Add the scraped content of each search result in place, from the page cache where possible.
+    Results missing from the cache are scraped.
+    """
+    items = [item for item in results.get("data") or [] if item.get("url")]
+    if not items:
+        return
+    with ThreadPoolExecutor(max_workers=len(items), thread_name_prefix="firecrawl-search-scrape") as executor:
+        pages = executor.map(lambda item: firecrawl_scrape(item["url"], scrape_options), items)
+        for item, page in zip(items, pages):
+            data = page.get("data") if isinstance(page, dict) else None
+            if not data:
+                continue
+            metadata = {**(data.get("metadata") or {}), **(item.get("metadata") or {})}
+            item.update({k: v for k, v in data.items() if k != "metadata"})
+            item["metadata"] = metadata
+
 def firecrawl_search(query: str, limit: int = 5, scrape_options: dict = None) -> dict:
     """
     Perform a search using the Firecrawler API.
@@ -17,8 +721,14 @@ def firecrawl_search(query: str, limit: int = 5, scrape_options: dict = None) ->
 
     Returns:
         dict: The search results as a dictionary, or an error dictionary if the request fails.
+              Recent results of the same query are returned from the search cache (see get_search_cache).
     """
-    
+    search_cache = get_search_cache()
+    if search_cache is not None:
+        cached = search_cache.get(query, limit, scrape_options)
+        if cached is not None:
+            return cached
+
     FIRECRAWL_API_URL = os.getenv("FIRECRAWL_API_URL")
     FIRECRAWL_API_KEY = os.getenv("FIRECRAWL_API_KEY")
     url = f"{FIRECRAWL_API_URL}/v1/search"
@@ -33,13 +743,30 @@ def firecrawl_search(query: str, limit: int = 5, scrape_options: dict = None) ->
         "limit": limit
     }
 
-    if scrape_options:
+    # When all pages of the last search for this query are still cached, search without scraping and
+    # take the page contents from the page cache; otherwise let the search scrape and cache the pages
+    page_cache = get_page_cache() if scrape_options else None
+    from_page_cache = page_cache is not None and page_cache.search_is_cached(query, limit, scrape_options)
+    if scrape_options and not from_page_cache:
         payload["scrapeOptions"] = scrape_options
 
     try:
-        response = requests.post(url, headers=headers, data=json.dumps(payload))
+        response = _get_session().post(url, headers=headers, data=json.dumps(payload), timeout=_timeout())
         response.raise_for_status()  # Raise an exception for bad status codes (4xx or 5xx)
-        return response.json()
+        results = response.json()
+        if from_page_cache:
+            _fill_search_results(results, scrape_options)
+        elif page_cache is not None:
+            for item in results.get("data") or []:
+                if item.get("url") and (item.get("markdown") or item.get("content")):
+                    page = {"success": True, "data": item}
+                    _record_scrape_redirect(item["url"], page)
+                    page_cache.set(item["url"], scrape_options, page)
+        if page_cache is not None and isinstance(results.get("data"), list):
+            page_cache.remember_search(query, limit, scrape_options, [item["url"] for item in results["data"] if item.get("url")])
+        if search_cache is not None:
+            search_cache.set(query, limit, scrape_options, results)
+        return results
     except requests.exceptions.HTTPError as http_err:
         return {"error": "HTTP error occurred", "details": str(http_err), "status_code": response.status_code, "response_text": response.text}
     except requests.exceptions.ConnectionError as conn_err:
@@ -64,7 +791,13 @@ def firecrawl_scrape(url_to_scrape: str, scrape_options: dict = None) -> dict:
 
     Returns:
         dict: The scrape results as a dictionary, or an error dictionary if the request fails.
+              Pages served from the page cache (see get_page_cache) are returned without a request.
     """
+    page_cache = get_page_cache()
+    if page_cache is not None:
+        cached = page_cache.get(url_to_scrape, scrape_options)
+        if cached is not None:
+            return cached
 
     FIRECRAWL_API_URL = os.getenv("FIRECRAWL_API_URL")
     FIRECRAWL_API_KEY = os.getenv("FIRECRAWL_API_KEY")
@@ -83,9 +816,13 @@ def firecrawl_scrape(url_to_scrape: str, scrape_options: dict = None) -> dict:
         payload.update(scrape_options)
 
     try:
-        response = requests.post(scrape_api_endpoint, headers=headers, data=json.dumps(payload))
+        response = _get_session().post(scrape_api_endpoint, headers=headers, data=json.dumps(payload), timeout=_timeout())
         response.raise_for_status()  # Raise an exception for bad status codes (4xx or 5xx)
-        return response.json()
+        result = response.json()
+        _record_scrape_redirect(url_to_scrape, result)
+        if page_cache is not None:
+            page_cache.set(url_to_scrape, scrape_options, result)
+        return result
     except requests.exceptions.HTTPError as http_err:
         return {"error": "HTTP error occurred", "details": str(http_err), "status_code": response.status_code, "response_text": response.text}
     except requests.exceptions.ConnectionError as conn_err:
@@ -98,4 +835,136 @@ def firecrawl_scrape(url_to_scrape: str, scrape_options: dict = None) -> dict:
         response_text_content = ""
         if 'response' in locals() and hasattr(response, 'text'):
             response_text_content = response.text
-        return {"error": "Failed to decode JSON response", "response_text": response_text_content}
\ No newline at end of file
+        return {"error": "Failed to decode JSON response", "response_text": response_text_content}
+
+def firecrawl_scrape_many(urls: list, scrape_options: dict = None, max_workers: int = 8):
+    """
+    Scrape several URLs concurrently using the Firecrawler /v1/scrape endpoint.
+
+    Args:
+        urls (list): The URLs to scrape.
+        scrape_options (dict): Optional scraping options, passed to every firecrawl_scrape call.
+        max_workers (int): Maximum number of scrapes running at once.
+
+    Yields:
+        tuple: (url, result) as each scrape finishes, where result is what firecrawl_scrape
+               returns for that URL (including error dictionaries).
+
+    Closing the generator early cancels the scrapes that have not started and does not wait
+    for the running ones.
+    """
+    if not urls:
+        return
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(urls)), thread_name_prefix="firecrawl-scrape")
+    try:
+        futures = {executor.submit(firecrawl_scrape, url, scrape_options): url for url in urls}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {"error": "An unexpected error occurred", "details": str(e)}
+            yield futures[future], result
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+async def firecrawl_batch_scrape_async(urls: list, scrape_options: dict = None, poll_interval: float = 2,
+                                       max_wait_time: float = 300):
+    """
+    Scrape several URLs with one Firecrawler batch scrape job (/v1/batch/scrape).
+
+    The job status is polled every `poll_interval` seconds and pages are yielded as soon as the
+    job reports them, so callers can process early pages while later ones are still scraped.
+    Pages in the page cache are yielded first and left out of the job.
+
+    Args:
+        urls (list): The URLs to scrape.
+        scrape_options (dict): Optional scraping options for every URL.
+                               Example: {"formats": ["markdown"]}
+        poll_interval (float): Seconds between two status checks.
+        max_wait_time (float): Seconds after which the job is given up.
+
+    Yields:
+        tuple: (url, result) per URL, where result has the same shape as a firecrawl_scrape
+               response ({"success": True, "data": {...}}) or is an error dictionary.
+    """
+    page_cache = get_page_cache()
+    if page_cache is not None:
+        uncached = []
+        for url in urls:
+            cached = await asyncio.to_thread(page_cache.get, url, scrape_options)
+            if cached is None:
+                uncached.append(url)
+            else:
+                yield url, cached
+        urls = uncached
+    if not urls:
+        return
+
+    FIRECRAWL_API_URL = os.getenv("FIRECRAWL_API_URL")
+    FIRECRAWL_API_KEY = os.getenv("FIRECRAWL_API_KEY")
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {FIRECRAWL_API_KEY}"
+    }
+    payload = {"urls": list(urls)}
+    if scrape_options:
+        payload.update(scrape_options)
+
+    # Firecrawl may report a URL spelled differently than requested (e.g. with a trailing slash),
+    # so results are matched by canonical URL
+    pending = {}
+    for url in urls:
+        pending.setdefault(canonicalize_url(url), []).append(url)
+    connect_timeout, read_timeout = _timeout()
+    async with httpx.AsyncClient(headers=headers, timeout=httpx.Timeout(read_timeout, connect=connect_timeout)) as client:
+        try:
+            response = await client.post(f"{FIRECRAWL_API_URL}/v1/batch/scrape", json=payload)
+            response.raise_for_status()
+            job_id = response.json()["id"]
+        except Exception as e:
+            for url in urls:
+                yield url, {"error": "Failed to start batch scrape", "details": str(e)}
+            return
+
+        start_time = time.time()
+        seen = 0
+        status = "scraping"
+        error = None
+        while pending and status == "scraping":
+            await asyncio.sleep(poll_interval)
+            if time.time() - start_time > max_wait_time:
+                error = "Batch scrape timed out"
+                break
+            pages = []
+            next_url = f"{FIRECRAWL_API_URL}/v1/batch/scrape/{job_id}"
+            try:
+                # Large results are paginated through "next"
+                while next_url:
+                    response = await client.get(next_url)
+                    response.raise_for_status()
+                    body = response.json()
+                    status = body.get("status", status)
+                    pages.extend(body.get("data") or [])
+                    next_url = body.get("next")
+            except Exception as e:
+                # Transient polling errors are retried on the next tick
+                continue
+            # Completed pages are appended to the job's data, only the new ones need yielding
+            for page in pages[seen:]:
+                metadata = page.get("metadata") or {}
+                source_url = metadata.get("sourceURL") or metadata.get("url")
+                requested_urls = pending.pop(canonicalize_url(source_url), None) if source_url else None
+                if requested_urls is None:
+                    continue
+                for url in requested_urls:
+                    _record_scrape_redirect(url, {"data": page})
+                    if page_cache is not None:
+                        await asyncio.to_thread(page_cache.set, url, scrape_options, {"success": True, "data": page})
+                    yield url, {"success": True, "data": page}
+            seen = max(seen, len(pages))
+            if status == "failed":
+                error = "Batch scrape failed"
+
+    for requested_urls in pending.values():
+        for url in requested_urls:
+            yield url, {"error": error or "URL missing from batch scrape results"}
@@ -1,14 +1,20 @@
 import os
 import uuid
 
+import asyncio
+import json
 import logging
+import threading
 import time
 from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
 
 from deep_research import DeepSearch, QAnythingHandler
-from openai_llm import OpenAI
+from qanything_utils import AsyncQAnythingHandler, IngestionManifest, KnowledgeBasePins, KnowledgeBasePool, KnowledgeBaseReaper, SearchResultCache
+from firecrawl_utils import get_page_cache, get_search_cache
+from openai_llm import OpenAI, CachedLLM, LLMResponseCache, RoutedLLM
 import log
 
 from dotenv import load_dotenv
@@ -39,15 +45,103 @@ logging.getLogger("httpcore").setLevel(logging.WARNING)
 app = FastAPI()
 job_results: Dict[str, Dict[str, Any]] = {}  # Stores job status, results, errors
 
+
+class JobTokenStream:
+    """
+    Append-only buffer of report text deltas for one job.
+    Written from the job's worker thread and read by the SSE endpoint.
+    """
+    def __init__(self):
+        self._tokens: List[str] = []
+        self._lock = threading.Lock()
+
+    def append(self, token: str):
+        with self._lock:
+            self._tokens.append(token)
+
+    def read_from(self, index: int) -> List[str]:
+        with self._lock:
+            return self._tokens[index:]
+
+
+job_streams: Dict[str, JobTokenStream] = {}  # Stores streamed report tokens per job
+SSE_POLL_INTERVAL_SECONDS = 0.05
+SSE_KEEPALIVE_SECONDS = 15
+
 # --- Global Handlers ---
-# LLM can typically be global
-llm_instance = OpenAI(model=os.getenv("OPENAI_MODEL_NAME"))
+# LLM can typically be global. Calls are routed by role (sub_query, rerank, reflect, summary)
+# to OPENAI_MODEL_<ROLE> when configured, and to OPENAI_MODEL_NAME otherwise.
+llm_instance = RoutedLLM.from_env(OpenAI(model=os.getenv("OPENAI_MODEL_NAME")))
+
+# Optional persistent LLM response cache (disabled when LLM_CACHE_PATH is empty)
+llm_response_cache = None
+if os.getenv("LLM_CACHE_PATH"):
+    llm_response_cache = LLMResponseCache(
+        path=os.getenv("LLM_CACHE_PATH"),
+        max_size_bytes=int(os.getenv("LLM_CACHE_MAX_MB", 256)) * 1024 * 1024,
+        max_age_seconds=float(os.getenv("LLM_CACHE_MAX_AGE_SECONDS", 7 * 24 * 3600)),
+    )
+    llm_instance = CachedLLM(llm_instance, llm_response_cache)
+
+# Search-only QAnything results shared by all jobs; entries are invalidated when a KB's files change
+search_result_cache = None
+if int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", 0)) > 0:
+    search_result_cache = SearchResultCache(max_entries=int(os.getenv("SEARCH_CACHE_MAX_ENTRIES")))
 
-# QAnythingHandler can also be global
+# QAnythingHandler can also be global; its pooled keep-alive connections are shared by all jobs
 qanything_handler_global = QAnythingHandler(
     server_url=QANYTHING_SERVER_URL,
-    user_id=QANYTHING_USER_ID
+    user_id=QANYTHING_USER_ID,
+    pool_size=int(os.getenv("QANYTHING_POOL_SIZE", 20)),
+    timeout=float(os.getenv("QANYTHING_TIMEOUT_SECONDS", 600)),
+    upload_timeout=float(os.getenv("QANYTHING_UPLOAD_TIMEOUT_SECONDS", 6000)),
+    upload_deadline=float(os.getenv("QANYTHING_UPLOAD_DEADLINE_SECONDS", 0)) or None,
+    search_cache=search_result_cache,
 )
+async_qanything_handler_global = AsyncQAnythingHandler.from_handler(
+    qanything_handler_global,
+    upload_batch_size=int(os.getenv("QANYTHING_UPLOAD_BATCH_SIZE", 5)),
+    max_uploads_in_flight=int(os.getenv("QANYTHING_MAX_UPLOADS_IN_FLIGHT", 4)),
+)
+
+# Content-hash manifest shared by all jobs, so files and pages indexed by one job are not re-uploaded by the next
+ingestion_manifest = None
+if os.getenv("INGESTION_MANIFEST_PATH"):
+    ingestion_manifest = IngestionManifest(os.getenv("INGESTION_MANIFEST_PATH"))
+
+# KBs that running jobs search because they reuse content indexed by another job.
+# Pinned KBs are not emptied or deleted until the jobs searching them finish.
+kb_pins = KnowledgeBasePins()
+
+# Pool of pre-created empty KBs leased to jobs and emptied for reuse when they finish.
+# Recycled KBs lose their content, so their ingestion manifest entries are dropped.
+kb_pool = None
+if int(os.getenv("KB_POOL_SIZE", 0)) > 0:
+    kb_pool = KnowledgeBasePool(
+        qanything_handler_global,
+        size=int(os.getenv("KB_POOL_SIZE")),
+        max_idle=int(os.getenv("KB_POOL_MAX_IDLE", 2 * int(os.getenv("KB_POOL_SIZE")))),
+        name_prefix="api_job_pool",
+        on_recycle=ingestion_manifest.forget_kb if ingestion_manifest is not None else None,
+        pins=kb_pins,
+    )
+
+# Deletes the KBs of finished jobs (when they are not returned to the pool) after a TTL.
+# The queue is persisted, so KBs scheduled before a restart are still reclaimed.
+kb_reaper = None
+if float(os.getenv("KB_REAPER_TTL_SECONDS", 0)) > 0:
+    kb_reaper = KnowledgeBaseReaper(
+        qanything_handler_global,
+        path=os.getenv("KB_REAPER_DB_PATH") or os.path.join(os.getenv("TMP_FILE_PATH") or "/tmp", "deep_research_kb_reaper.sqlite"),
+        ttl_seconds=float(os.getenv("KB_REAPER_TTL_SECONDS")),
+        batch_size=int(os.getenv("KB_REAPER_BATCH_SIZE", 50)),
+        interval_seconds=float(os.getenv("KB_REAPER_INTERVAL_SECONDS", 10)),
+        on_delete=ingestion_manifest.forget_kb if ingestion_manifest is not None else None,
+        pins=kb_pins,
+    )
+
+# KBs of jobs marked stale while still running; the reaper deletes them as soon as their job ends
+stale_job_kb_ids = set()
 
 @app.on_event("startup")
 def startup():
@@ -55,8 +149,24 @@ def startup():
     log.color_print("<startup>FastAPI application starting up.</startup>")
     log.color_print(f"<startup_config>OPENAI_BASE_URL: {os.getenv('OPENAI_BASE_URL')}</startup_config>")
     log.color_print(f"<startup_config>OPENAI_MODEL_NAME: {os.getenv('OPENAI_MODEL_NAME')}</startup_config>")
+    for role in RoutedLLM.ROLES:
+        if os.getenv(f"OPENAI_MODEL_{role.upper()}"):
+            log.color_print(f"<startup_config>OPENAI_MODEL_{role.upper()}: {os.getenv(f'OPENAI_MODEL_{role.upper()}')}</startup_config>")
     log.color_print(f"<startup_config>QANYTHING_SERVER_URL: {QANYTHING_SERVER_URL}</startup_config>")
     log.color_print(f"<startup_config>FIRECRAWL_API_URL: {os.getenv('FIRECRAWL_API_URL')}</startup_config>")
+    if kb_pool is not None:
+        log.color_print(f"<startup_config>KB_POOL_SIZE: {kb_pool.size}</startup_config>")
+        kb_pool.start()
+    if kb_reaper is not None:
+        log.color_print(f"<startup_config>KB_REAPER_TTL_SECONDS: {kb_reaper.ttl_seconds}</startup_config>")
+        kb_reaper.start()
+
+@app.on_event("shutdown")
+def shutdown():
+    if kb_pool is not None:
+        kb_pool.stop()
+    if kb_reaper is not None:
+        kb_reaper.stop()
 
 def create_qanything_kb_for_job(job_id: str) -> Optional[str]:
     """
@@ -77,17 +187,35 @@ def create_qanything_kb_for_job(job_id: str) -> Optional[str]:
         log.color_print(f"<qanything_kb_exception> Job {job_id}: QAnything KB creation for '{kb_name}' failed: {e}</qanything_kb_exception>\n")
         return None
 
+def lease_qanything_kb_for_job(job_id: str) -> Optional[str]:
+    """
+    Returns an empty QAnything Knowledge Base for a job, from the KB pool if enabled.
+    Blocks on create_knowledge_base when no pooled KB is ready, so endpoints call it in a worker thread.
+    """
+    if kb_pool is None:
+        return create_qanything_kb_for_job(job_id)
+    kb_id = kb_pool.lease()
+    if kb_id:
+        log.color_print(f"<qanything_kb_lease> Job {job_id}: Leased QAnything KB {kb_id} from the pool.</qanything_kb_lease>\n")
+    return kb_id
+
 def cleanup_qanything_kb(kb_id: str):
     """
     Deletes a QAnything Knowledge Base.
     """
     if not kb_id:
         return
+    if kb_reaper is not None:
+        kb_reaper.schedule(kb_id, ttl_seconds=0)
+        log.color_print(f"<qanything_kb_cleanup> Queued QAnything KB ID {kb_id} for deletion.</qanything_kb_cleanup>\n")
+        return
     try:
         log.color_print(f"<qanything_kb_cleanup> Attempting to delete QAnything KB ID: {kb_id}</qanything_kb_cleanup>\n")
         response = qanything_handler_global.delete_knowledge_base(kb_ids=[kb_id]) # Corrected from deep_research example test
         if response.get("code") == 200:
             log.color_print(f"<qanything_kb_cleanup_success> Successfully deleted QAnything KB ID: {kb_id}</qanything_kb_cleanup_success>\n")
+            if ingestion_manifest is not None:
+                ingestion_manifest.forget_kb(kb_id)
         else:
             log.color_print(f"<qanything_kb_cleanup_error> Failed to delete QAnything KB ID: {kb_id}. Response: {response}</qanything_kb_cleanup_error>\n")
     except Exception as e:
@@ -99,20 +227,24 @@ class FilesQuery(BaseModel):
     file_paths: List[str]
     question: str
     search_web_flag: bool = False # Explicit flag for web search
+    token_budget: Optional[int] = None # Maximum LLM tokens for the job; None means unlimited
 
 class WebsQuery(BaseModel):
     urls: List[str]
     question: str
     search_web_flag: bool = True # Explicit flag for web search, default to True for web queries
+    token_budget: Optional[int] = None # Maximum LLM tokens for the job; None means unlimited
 
 class SearchQuery(BaseModel):
     question: str
+    token_budget: Optional[int] = None # Maximum LLM tokens for the job; None means unlimited
 
 class CombinedQuery(BaseModel):
     file_paths: Optional[List[str]] = None
     urls: Optional[List[str]] = None
     question: str
     search_web_flag: bool = False # Explicit flag for web search, default to False for combined queries
+    token_budget: Optional[int] = None # Maximum LLM tokens for the job; None means unlimited
 
 
 # --- Background Task Processors ---
@@ -125,13 +257,23 @@ def run_deep_search_task(
     search_web_flag: bool = False, # Explicit flag for web search
     max_iter_val: int = int(os.getenv('MAX_ITER', 3)),
     max_q_rerank: int = int(os.getenv("MAX_QANYTHING_CHUNKS_TO_RERANK", 5)),
+    rerank_mode: str = os.getenv("RERANK_MODE", "per_chunk"),
+    reranker: str = os.getenv("RERANKER", "llm"),
     max_fc_qa_proc: int = int(os.getenv("MAX_FIRECRAWL_QANYTHING_CHUNKS_TO_PROCESS", 5)),
     min_qa_web: int = int(os.getenv("MIN_QANYTHING_RESULTS_BEFORE_WEB_SEARCH", 1)),
     max_web_search_results: int = int(os.getenv("MAX_WEB_SEARCH_RESULTS", 5)),
     max_summary_chunks: int = int(os.getenv("MAX_CHUNKS_FOR_SUMMARY", 20)),
-    firecrawl_api_url: str = os.getenv('FIRECRAWL_API_URL')
+    firecrawl_api_url: str = os.getenv('FIRECRAWL_API_URL'),
+    token_budget: Optional[int] = None
 ):
     job_results[job_id]["status"] = "processing"
+    if token_budget is None and os.getenv("TOKEN_BUDGET"):
+        token_budget = int(os.getenv("TOKEN_BUDGET"))
+    token_stream = job_streams.setdefault(job_id, JobTokenStream())
+    upload_progress = job_results[job_id].setdefault("upload_progress", {})
+
+    def on_upload_progress(file_path: str, bytes_sent: int, file_size: int):
+        upload_progress[os.path.basename(file_path)] = {"bytes_sent": bytes_sent, "total_bytes": file_size}
     try:
         log.color_print(f"<job_start> Job {job_id} (KB: {kb_id}): Starting DeepSearch for query: '{original_query}'</job_start>\n")
         log.color_print(f"<job_params> Job {job_id}: files={files}, urls={urls}, search_web={search_web_flag}</job_params>\n")
@@ -139,14 +281,32 @@ def run_deep_search_task(
         agent = DeepSearch(
             llm=llm_instance,
             qanything_handler=qanything_handler_global,
+            async_qanything_handler=async_qanything_handler_global,
+            ingestion_manifest=ingestion_manifest,
+            kb_pins=kb_pins,
             qanything_kb_ids=[kb_id] if kb_id else [], # Must be a list
             max_iter=max_iter_val,
             search_internet=False, # Agent's default, will be overridden by query's search_web if needed
             firecrawl_api_url=firecrawl_api_url,
             max_qanything_chunks_to_rerank=max_q_rerank,
+            rerank_mode=rerank_mode,
+            reranker=reranker,
             max_firecrawl_qanything_chunks_to_process=max_fc_qa_proc,
             min_qanything_results_before_web_search=min_qa_web,
-            max_chunks_for_summary=max_summary_chunks
+            max_chunks_for_summary=max_summary_chunks,
+            token_budget=token_budget,
+            firecrawl_max_workers=int(os.getenv("FIRECRAWL_MAX_WORKERS", 8)),
+            firecrawl_batch_scrape=os.getenv("FIRECRAWL_BATCH_SCRAPE", "false").lower() == "true",
+            web_results_mode=os.getenv("WEB_RESULTS_MODE", "qanything"),
+            # Job KBs returned to the pool or reaped are emptied soon after the job, so pages are only
+            # ingested in the background into a persistent KB, or into job KBs that are kept
+            background_web_ingest=os.getenv("BACKGROUND_WEB_INGEST", "true").lower() == "true"
+                and bool(os.getenv("BACKGROUND_WEB_INGEST_KB_ID") or (kb_pool is None and kb_reaper is None)),
+            background_ingest_kb_id=os.getenv("BACKGROUND_WEB_INGEST_KB_ID") or None,
+            clean_scraped_markdown=os.getenv("CLEAN_SCRAPED_MARKDOWN", "true").lower() == "true",
+            max_page_chars=int(os.getenv("MAX_PAGE_CHARS", 50000)),
+            speculative_web_search=os.getenv("SPECULATIVE_WEB_SEARCH", "false").lower() == "true",
+            max_speculative_web_searches=int(os.getenv("MAX_SPECULATIVE_WEB_SEARCHES", 10)),
         )
 
         # The search_web parameter in agent.query() overrides the agent's instance search_internet default
@@ -156,6 +316,8 @@ def run_deep_search_task(
             urls=urls if urls else [],   # Ensure it's a list
             search_web=search_web_flag,  # This controls if web search is performed
             max_web_search_results=max_web_search_results,
+            on_token=token_stream.append,  # Relayed to /api/job/{job_id}/stream
+            on_upload_progress=on_upload_progress,  # Reported in /api/job/{job_id} as "upload_progress"
             # qanything_upload_num_split_pdf=0, # Default
             # qanything_upload_chunk_size=800   # Default
         )
@@ -172,7 +334,14 @@ def run_deep_search_task(
 
         job_results[job_id].update({
             "status": "completed",
-            "result": {"answer": final_report, "retrieved_results": serializable_docs, "consumed_tokens": consumed_tokens},
+            "result": {
+                "answer": final_report,
+                "retrieved_results": serializable_docs,
+                "consumed_tokens": consumed_tokens,
+                "usage": agent.usage_ledger.to_dict(),
+                "markdown_cleanup": agent.markdown_cleaner.stats(),
+                "speculative_web_search": agent.speculation_stats,
+            },
             "error": None
         })
         log.color_print(f"<job_complete> Job {job_id} (KB: {kb_id}): DeepSearch completed.</job_complete>\n")
@@ -187,7 +356,15 @@ def run_deep_search_task(
             "error": str(e)
         })
     finally:
-        if kb_id:
+        if kb_id and kb_pool is not None:
+            kb_pool.release(kb_id)
+            log.color_print(f"<job_cleanup_info> Job {job_id}: KB {kb_id} returned to the pool for recycling.</job_cleanup_info>\n")
+        elif kb_id and kb_reaper is not None:
+            ttl_seconds = 0 if kb_id in stale_job_kb_ids else kb_reaper.ttl_seconds
+            stale_job_kb_ids.discard(kb_id)
+            kb_reaper.schedule(kb_id, ttl_seconds=ttl_seconds)
+            log.color_print(f"<job_cleanup_info> Job {job_id}: KB {kb_id} will be deleted in {ttl_seconds}s.</job_cleanup_info>\n")
+        elif kb_id:
              log.color_print(f"<job_cleanup_info> Job {job_id}: KB {kb_id} cleanup is currently commented out. Consider manual cleanup or uncommenting cleanup_qanything_kb.</job_cleanup_info>\n")
 
 
@@ -195,7 +372,7 @@ def run_deep_search_task(
 @app.post("/api/files")
 async def deepsearch_files_async(query_data: FilesQuery, background_tasks: BackgroundTasks):
     job_id = str(uuid.uuid4())
-    kb_id = create_qanything_kb_for_job(job_id)
+    kb_id = await asyncio.to_thread(lease_qanything_kb_for_job, job_id)
     if not kb_id:
         raise HTTPException(status_code=500, detail="Failed to create QAnything Knowledge Base for the job.")
 
@@ -206,14 +383,15 @@ async def deepsearch_files_async(query_data: FilesQuery, background_tasks: Backg
         kb_id,
         query_data.question,
         files=query_data.file_paths,
-        search_web_flag=query_data.search_web_flag # This flag is now part of the query data
+        search_web_flag=query_data.search_web_flag, # This flag is now part of the query data
+        token_budget=query_data.token_budget
     )
     return {"job_id": job_id, "message": "File processing job started."}
 
 @app.post("/api/webs")
 async def deepsearch_webs_async(query_data: WebsQuery, background_tasks: BackgroundTasks):
     job_id = str(uuid.uuid4())
-    kb_id = create_qanything_kb_for_job(job_id)
+    kb_id = await asyncio.to_thread(lease_qanything_kb_for_job, job_id)
     if not kb_id:
         raise HTTPException(status_code=500, detail="Failed to create QAnything Knowledge Base for the job.")
 
@@ -224,7 +402,8 @@ async def deepsearch_webs_async(query_data: WebsQuery, background_tasks: Backgro
         kb_id,
         query_data.question,
         urls=query_data.urls,
-        search_web_flag=query_data.search_web_flag
+        search_web_flag=query_data.search_web_flag,
+        token_budget=query_data.token_budget
     )
     return {"job_id": job_id, "message": "Web content processing job started."}
 
@@ -232,7 +411,7 @@ async def deepsearch_webs_async(query_data: WebsQuery, background_tasks: Backgro
 async def deepsearch_search_async(query_data: SearchQuery, background_tasks: BackgroundTasks):
     job_id = str(uuid.uuid4())
     # For pure web search, a KB might still be needed by DeepSearch to store crawled content before summarization.
-    kb_id = create_qanything_kb_for_job(job_id)
+    kb_id = await asyncio.to_thread(lease_qanything_kb_for_job, job_id)
     if not kb_id: # If KB creation is mandatory even for web-only search by DeepSearch
         raise HTTPException(status_code=500, detail="Failed to create QAnything Knowledge Base for the search job.")
     
@@ -244,14 +423,15 @@ async def deepsearch_search_async(query_data: SearchQuery, background_tasks: Bac
         job_id,
         kb_id,
         query_data.question,
-        search_web_flag=True # Perform web search
+        search_web_flag=True, # Perform web search
+        token_budget=query_data.token_budget
     )
     return {"job_id": job_id, "message": "Web search and analysis job started."}
 
 @app.post("/api/combine")
 async def deepsearch_combine_async(query_data: CombinedQuery, background_tasks: BackgroundTasks):
     job_id = str(uuid.uuid4())
-    kb_id = create_qanything_kb_for_job(job_id)
+    kb_id = await asyncio.to_thread(lease_qanything_kb_for_job, job_id)
     if not kb_id:
         raise HTTPException(status_code=500, detail="Failed to create QAnything Knowledge Base for the job.")
 
@@ -264,7 +444,8 @@ async def deepsearch_combine_async(query_data: CombinedQuery, background_tasks:
         query_data.question,
         files=query_data.file_paths,
         urls=query_data.urls,
-        search_web_flag=query_data.search_web_flag
+        search_web_flag=query_data.search_web_flag,
+        token_budget=query_data.token_budget
     )
     return {"job_id": job_id, "message": "Combined processing job started."}
 
@@ -274,6 +455,98 @@ async def get_job_status(job_id: str):
         raise HTTPException(status_code=404, detail="Job not found")
     return job_results[job_id]
 
+@app.get("/api/job/{job_id}/stream")
+async def stream_job_report(job_id: str):
+    """
+    Relays the final report of a job as Server-Sent Events while it is being generated.
+
+    Events: `token` (JSON-encoded text delta), `done` (final job status) and `error`.
+    Comment lines are sent as keep-alives while the job is still retrieving.
+    """
+    if job_id not in job_results:
+        raise HTTPException(status_code=404, detail="Job not found")
+    token_stream = job_streams.setdefault(job_id, JobTokenStream())
+
+    async def event_generator():
+        sent = 0
+        last_event_time = time.time()
+        while True:
+            job = job_results.get(job_id)
+            # Read the status before draining, so tokens appended before completion are not missed
+            status = job["status"] if job else "failed"
+            new_tokens = token_stream.read_from(sent)
+            for token in new_tokens:
+                yield f"event: token\ndata: {json.dumps(token, ensure_ascii=False)}\n\n"
+            sent += len(new_tokens)
+            if new_tokens:
+                last_event_time = time.time()
+
+            if status == "completed":
+                if sent == 0 and job.get("result"):
+                    # Nothing was streamed (e.g. no chunks were found), send the answer in one piece
+                    yield f"event: token\ndata: {json.dumps(job['result']['answer'], ensure_ascii=False)}\n\n"
+                yield f"event: done\ndata: {json.dumps({'status': status})}\n\n"
+                return
+            if status == "failed":
+                error = job.get("error") if job else "Job not found"
+                yield f"event: error\ndata: {json.dumps({'status': status, 'error': error}, ensure_ascii=False)}\n\n"
+                return
+
+            if time.time() - last_event_time > SSE_KEEPALIVE_SECONDS:
+                yield ": keep-alive\n\n"
+                last_event_time = time.time()
+            await asyncio.sleep(SSE_POLL_INTERVAL_SECONDS)
+
+    return StreamingResponse(
+        event_generator(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.get("/api/llm_cache/stats")
+async def get_llm_cache_stats():
+    if llm_response_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **llm_response_cache.stats()}
+
+@app.get("/api/ingestion_manifest/stats")
+async def get_ingestion_manifest_stats():
+    if ingestion_manifest is None:
+        return {"enabled": False}
+    return {"enabled": True, **ingestion_manifest.stats()}
+
+@app.get("/api/search_cache/stats")
+async def get_search_cache_stats():
+    if search_result_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **search_result_cache.stats()}
+
+@app.get("/api/kb_pool/stats")
+async def get_kb_pool_stats():
+    if kb_pool is None:
+        return {"enabled": False}
+    return {"enabled": True, **kb_pool.stats()}
+
+@app.get("/api/kb_reaper/stats")
+async def get_kb_reaper_stats():
+    if kb_reaper is None:
+        return {"enabled": False}
+    return {"enabled": True, **kb_reaper.stats()}
+
+@app.get("/api/page_cache/stats")
+async def get_page_cache_stats():
+    page_cache = get_page_cache()
+    if page_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **page_cache.stats()}
+
+@app.get("/api/firecrawl_search_cache/stats")
+async def get_firecrawl_search_cache_stats():
+    search_cache = get_search_cache()
+    if search_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **search_cache.stats()}
+
 @app.get("/api/cleanup")
 def cleanup_stale_jobs(timeout_seconds: int = 1800): # Default timeout 30 minutes
     now = time.time()
@@ -292,7 +565,17 @@ def cleanup_stale_jobs(timeout_seconds: int = 1800): # Default timeout 30 minute
             
             # Try to clean up the KB if it exists
             kb_to_clean = job_data.get("kb_id")
-            if kb_to_clean:
+            if kb_to_clean and kb_pool is not None:
+                # The task still holds its pooled KB; it is deleted instead of reused once the task releases it
+                kb_pool.discard(kb_to_clean)
+                log.color_print(f"<qanything_kb_cleanup> KB {kb_to_clean} of stale job {job_id} will be deleted when the job releases it.</qanything_kb_cleanup>\n")
+                freed_kbs.append(kb_to_clean)
+            elif kb_to_clean and kb_reaper is not None:
+                # Deleting the KB now would pull it from under the running task; it is queued when the task ends
+                stale_job_kb_ids.add(kb_to_clean)
+                log.color_print(f"<qanything_kb_cleanup> KB {kb_to_clean} of stale job {job_id} will be deleted when the job ends.</qanything_kb_cleanup>\n")
+                freed_kbs.append(kb_to_clean)
+            elif kb_to_clean:
                 cleanup_qanything_kb(kb_to_clean)
                 freed_kbs.append(kb_to_clean)
 
@@ -300,6 +583,7 @@ def cleanup_stale_jobs(timeout_seconds: int = 1800): # Default timeout 30 minute
             log.color_print(f"<job_cleanup_old> Job {job_id} ({job_data['status']}) is old, removing from tracking. KB {job_data.get('kb_id')} might need manual cleanup if not done by task.</job_cleanup_old>\n")
 
             del job_results[job_id]
+            job_streams.pop(job_id, None)
             cleaned_jobs_count += 1
             
     return {"cleaned_jobs_count": cleaned_jobs_count, "message": f"{cleaned_jobs_count} jobs processed for cleanup.", "potentially_freed_kbs": list(set(freed_kbs))}
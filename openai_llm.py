@@ -15,8 +15,17 @@ License:
 import os
 import ast
 import re
+import asyncio
+import hashlib
+import json
+import random
+import sqlite3
+import threading
+import time
+import weakref
 from abc import ABC
-from typing import Dict, List
+from collections import deque
+from typing import AsyncIterator, Dict, Iterator, List
 
 
 class ChatResponse(ABC):
@@ -29,18 +38,34 @@ class ChatResponse(ABC):
     Attributes:
         content: The text content of the response.
         total_tokens: The total number of tokens used in the request and response.
+        prompt_tokens: The number of tokens in the request.
+        completion_tokens: The number of tokens in the response.
+        cached_tokens: The number of prompt tokens served from the provider's prompt cache.
     """
 
-    def __init__(self, content: str, total_tokens: int) -> None:
+    def __init__(
+        self,
+        content: str,
+        total_tokens: int,
+        prompt_tokens: int = 0,
+        completion_tokens: int = 0,
+        cached_tokens: int = 0,
+    ) -> None:
         """
         Initialize a ChatResponse object.
 
         Args:
             content: The text content of the response.
             total_tokens: The total number of tokens used in the request and response.
+            prompt_tokens: The number of tokens in the request.
+            completion_tokens: The number of tokens in the response.
+            cached_tokens: The number of prompt tokens served from the provider's prompt cache.
         """
         self.content = content
         self.total_tokens = total_tokens
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.cached_tokens = cached_tokens
 
     def __repr__(self) -> str:
         """
@@ -79,6 +104,60 @@ class BaseLLM(ABC):
         """
         pass
 
+    async def achat(self, messages: List[Dict]) -> ChatResponse:
+        """
+        Asynchronously send a chat message to the language model and get a response.
+
+        The default implementation runs the blocking `chat` in a worker thread, so
+        subclasses without a native async client can still be awaited concurrently.
+
+        Args:
+            messages: A list of message dictionaries, in the same format as `chat`.
+
+        Returns:
+            A ChatResponse object containing the model's response.
+        """
+        return await asyncio.to_thread(self.chat, messages)
+
+    async def achat_stream(self, messages: List[Dict]) -> AsyncIterator[ChatResponse]:
+        """
+        Asynchronously stream a chat response from the language model.
+
+        Each yielded ChatResponse carries a content delta. Token usage is reported on the
+        responses' `total_tokens` (usually once, at the end), so summing `total_tokens`
+        over the stream gives the usage of the whole call. The default implementation
+        yields the full `achat` response as a single delta.
+
+        Args:
+            messages: A list of message dictionaries, in the same format as `chat`.
+
+        Yields:
+            ChatResponse objects with content deltas.
+        """
+        yield await self.achat(messages)
+
+    async def aclose(self) -> None:
+        """
+        Close the async clients bound to the running event loop. Callers that run a loop per
+        task call it before the loop ends; the default implementation has nothing to close.
+        """
+        pass
+
+    def for_role(self, role: str) -> "BaseLLM":
+        """
+        Return the language model that should serve calls of the given role.
+
+        Roles used by DeepSearch are "sub_query", "rerank", "reflect" and "summary".
+        A plain model serves every role itself; see RoutedLLM.
+
+        Args:
+            role: The role of the call.
+
+        Returns:
+            The BaseLLM to use for that role.
+        """
+        return self
+
     @staticmethod
     def literal_eval(response_content: str):
         """
@@ -135,6 +214,233 @@ class BaseLLM(ABC):
         return response_content.strip()
 
 
+class ThinkStreamFilter:
+    """
+    Removes the <think>...</think> block of a reasoning model from streamed text, like
+    BaseLLM.remove_think does for a whole response.
+
+    Tags may be split across chunks: text that could be the start of a tag is held back
+    until the next chunk decides it. Leading whitespace of the visible text is dropped.
+    """
+
+    OPEN_TAG = "<think>"
+    CLOSE_TAG = "</think>"
+
+    def __init__(self):
+        self._buffer = ""
+        self._in_think = False
+        self._started = False
+
+    def feed(self, text: str) -> str:
+        """
+        Add a streamed chunk and return the text of it that can be shown.
+        """
+        self._buffer += text
+        visible = []
+        while True:
+            tag = self.CLOSE_TAG if self._in_think else self.OPEN_TAG
+            index = self._buffer.find(tag)
+            if index >= 0:
+                if not self._in_think:
+                    visible.append(self._buffer[:index])
+                self._buffer = self._buffer[index + len(tag):]
+                self._in_think = not self._in_think
+                continue
+            # Hold back a suffix that may be the start of the tag
+            keep = next(
+                (size for size in range(min(len(tag) - 1, len(self._buffer)), 0, -1) if tag.startswith(self._buffer[-size:])),
+                0,
+            )
+            if not self._in_think:
+                visible.append(self._buffer[:len(self._buffer) - keep])
+            self._buffer = self._buffer[len(self._buffer) - keep:]
+            return self._visible("".join(visible))
+
+    def flush(self) -> str:
+        """
+        Return the held-back text once the stream has ended.
+        """
+        text = "" if self._in_think else self._buffer
+        self._buffer = ""
+        return self._visible(text)
+
+    def _visible(self, text: str) -> str:
+        if not self._started:
+            text = text.lstrip()
+            self._started = bool(text)
+        return text
+
+
+class _TokenBucket:
+    """
+    A per-minute token bucket. A capacity of None means unlimited.
+    """
+
+    def __init__(self, capacity_per_minute=None):
+        self.capacity = capacity_per_minute
+        self.level = float(capacity_per_minute or 0)
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        if self.capacity:
+            self.level = min(float(self.capacity), self.level + (now - self.updated) * self.capacity / 60.0)
+        self.updated = now
+
+    def wait_time(self, cost: float) -> float:
+        """Seconds until `cost` can be taken from the bucket (0 if it can be taken now)."""
+        if not self.capacity:
+            return 0.0
+        needed = min(cost, float(self.capacity)) - self.level
+        return max(0.0, needed * 60.0 / self.capacity)
+
+
+def _parse_reset_duration(value: str) -> float:
+    """
+    Parse an `x-ratelimit-reset-*` / `retry-after` value such as "1s", "6m0s", "20ms" or "2.5" into seconds.
+    """
+    value = (value or "").strip()
+    if not value:
+        return 0.0
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    seconds = 0.0
+    for amount, unit in re.findall(r"([\d.]+)(ms|h|m|s)", value):
+        seconds += float(amount) * {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}[unit]
+    return seconds
+
+
+class RateLimiter:
+    """
+    Client-side limiter with requests-per-minute and tokens-per-minute buckets.
+
+    The buckets start from the configured limits and are corrected from the provider's
+    `x-ratelimit-*` response headers. It is thread-safe and can be awaited from any
+    event loop, so one instance can be shared by every LLM client of the same endpoint
+    and model (see get_shared_rate_limiter).
+
+    Attributes:
+        rpm (_TokenBucket): Requests-per-minute bucket.
+        tpm (_TokenBucket): Tokens-per-minute bucket.
+    """
+
+    def __init__(self, rpm_limit: int = None, tpm_limit: int = None):
+        """
+        Initialize a RateLimiter.
+
+        Args:
+            rpm_limit: Requests per minute, or None to rely on response headers only.
+            tpm_limit: Tokens per minute, or None to rely on response headers only.
+        """
+        self.rpm = _TokenBucket(rpm_limit)
+        self.tpm = _TokenBucket(tpm_limit)
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _reserve(self, estimated_tokens: int) -> float:
+        """
+        Take one request and `estimated_tokens` from the buckets, or return how long to wait.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if now < self._blocked_until:
+                return self._blocked_until - now
+            self.rpm.refill(now)
+            self.tpm.refill(now)
+            wait = max(self.rpm.wait_time(1), self.tpm.wait_time(estimated_tokens))
+            if wait > 0:
+                return wait
+            if self.rpm.capacity:
+                self.rpm.level -= 1
+            if self.tpm.capacity:
+                self.tpm.level -= estimated_tokens
+            return 0.0
+
+    def acquire(self, estimated_tokens: int) -> None:
+        """
+        Block until a request of `estimated_tokens` fits within the limits.
+        """
+        while True:
+            wait = self._reserve(estimated_tokens)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    async def aacquire(self, estimated_tokens: int) -> None:
+        """
+        Async variant of `acquire`.
+        """
+        while True:
+            wait = self._reserve(estimated_tokens)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    def record_usage(self, estimated_tokens: int, actual_tokens: int) -> None:
+        """
+        Correct the TPM bucket once the actual token usage of a request is known.
+        """
+        with self._lock:
+            if self.tpm.capacity:
+                self.tpm.level -= actual_tokens - estimated_tokens
+
+    def pause(self, seconds: float) -> None:
+        """
+        Hold back every caller for `seconds`, e.g. after the provider answered 429.
+        """
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+    def update_from_headers(self, headers) -> None:
+        """
+        Adopt the limits and remaining budget reported in `x-ratelimit-*` response headers.
+        """
+        if not headers:
+            return
+        with self._lock:
+            now = time.monotonic()
+            for bucket, kind in ((self.rpm, "requests"), (self.tpm, "tokens")):
+                limit = headers.get(f"x-ratelimit-limit-{kind}")
+                remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+                try:
+                    if limit is not None:
+                        bucket.refill(now)
+                        if not bucket.capacity:
+                            # First limit learned for an unlimited bucket: start it full
+                            bucket.level = float(limit)
+                        bucket.capacity = int(limit)
+                    if remaining is not None and bucket.capacity:
+                        bucket.level = min(bucket.level, float(remaining))
+                        bucket.updated = now
+                except ValueError:
+                    continue
+
+
+_shared_rate_limiters = {}
+_shared_rate_limiter_lock = threading.Lock()
+
+
+def get_shared_rate_limiter(base_url: str = None, model: str = None) -> RateLimiter:
+    """
+    Return the process-wide RateLimiter of an endpoint and model, created on first use from
+    OPENAI_RPM_LIMIT and OPENAI_TPM_LIMIT.
+
+    Providers report quotas per endpoint and model, so clients of different models do not
+    share buckets and the headers of one model never throttle another.
+    """
+    key = (base_url, model)
+    with _shared_rate_limiter_lock:
+        if key not in _shared_rate_limiters:
+            rpm_limit = os.getenv("OPENAI_RPM_LIMIT")
+            tpm_limit = os.getenv("OPENAI_TPM_LIMIT")
+            _shared_rate_limiters[key] = RateLimiter(
+                rpm_limit=int(rpm_limit) if rpm_limit else None,
+                tpm_limit=int(tpm_limit) if tpm_limit else None,
+            )
+        return _shared_rate_limiters[key]
+
+
 class OpenAI(BaseLLM):
     """
     OpenAI language model implementation.
@@ -142,11 +448,22 @@ class OpenAI(BaseLLM):
     This class provides an interface to interact with OpenAI's language models
     through their API.
 
+    Requests go through a RateLimiter shared by all instances of the same endpoint and model and are
+    retried with jittered exponential backoff on 429, 5xx and connection errors.
+
     Attributes:
         model (str): The OpenAI model identifier to use.
         client: The OpenAI client instance.
+        max_concurrency (int): Maximum number of in-flight `achat` requests per event loop.
+        max_retries (int): Maximum number of retries of a failed request.
+        rate_limiter (RateLimiter): The limiter requests are admitted through.
     """
 
+    # Rough completion size added to the prompt estimate when reserving TPM budget
+    COMPLETION_TOKENS_ESTIMATE = 256
+    BACKOFF_BASE_SECONDS = 1.0
+    BACKOFF_MAX_SECONDS = 60.0
+
     def __init__(self, model: str = "qwen3", **kwargs):
         """
         Initialize an OpenAI language model client.
@@ -156,6 +473,11 @@ class OpenAI(BaseLLM):
             **kwargs: Additional keyword arguments to pass to the OpenAI client.
                 - api_key: OpenAI API key. If not provided, uses OPENAI_API_KEY environment variable.
                 - base_url: OpenAI API base URL. If not provided, uses OPENAI_BASE_URL environment variable.
+                - max_concurrency: Maximum number of concurrent `achat` requests. If not provided,
+                  uses OPENAI_MAX_CONCURRENCY environment variable (default 8).
+                - max_retries: Maximum number of retries on 429/5xx/connection errors. If not provided,
+                  uses OPENAI_MAX_RETRIES environment variable (default 5).
+                - rate_limiter: RateLimiter to use. Defaults to the shared limiter of the endpoint and model.
         """
         from openai import OpenAI as OpenAI_
 
@@ -168,7 +490,146 @@ class OpenAI(BaseLLM):
             base_url = kwargs.pop("base_url")
         else:
             base_url = os.getenv("OPENAI_BASE_URL")
-        self.client = OpenAI_(api_key=api_key, base_url=base_url, **kwargs)
+        if "max_concurrency" in kwargs:
+            self.max_concurrency = int(kwargs.pop("max_concurrency"))
+        else:
+            self.max_concurrency = int(os.getenv("OPENAI_MAX_CONCURRENCY", 8))
+        if "max_retries" in kwargs:
+            self.max_retries = int(kwargs.pop("max_retries"))
+        else:
+            self.max_retries = int(os.getenv("OPENAI_MAX_RETRIES", 5))
+        self.rate_limiter = kwargs.pop("rate_limiter", None) or get_shared_rate_limiter(base_url, model)
+        self.temperature = 0.7
+        self.top_p = 0.8
+        # Retries are handled here so they go through the shared limiter
+        self.client = OpenAI_(api_key=api_key, base_url=base_url, max_retries=0, **kwargs)
+
+        # The async client and its semaphore are bound to the event loop they are first
+        # used on. DeepSearch runs a fresh loop per query (and main.py runs several jobs
+        # in parallel threads), so keep one pair per loop.
+        self._client_kwargs = dict(api_key=api_key, base_url=base_url, max_retries=0, **kwargs)
+        self._async_states = weakref.WeakKeyDictionary()
+        self._async_states_lock = threading.Lock()
+
+    def _get_async_state(self):
+        """
+        Return the (AsyncOpenAI client, semaphore) pair for the running event loop.
+        """
+        from openai import AsyncOpenAI
+
+        loop = asyncio.get_running_loop()
+        with self._async_states_lock:
+            state = self._async_states.get(loop)
+            if state is None:
+                state = (
+                    AsyncOpenAI(**self._client_kwargs),
+                    asyncio.Semaphore(max(1, self.max_concurrency)),
+                )
+                self._async_states[loop] = state
+        return state
+
+    async def aclose(self) -> None:
+        """
+        Close the AsyncOpenAI client of the running event loop and its connection pool.
+        """
+        with self._async_states_lock:
+            state = self._async_states.pop(asyncio.get_running_loop(), None)
+        if state is not None:
+            await state[0].close()
+
+    @staticmethod
+    def _usage_kwargs(usage) -> Dict:
+        """
+        Convert an OpenAI usage object into ChatResponse token keyword arguments.
+        """
+        prompt_tokens_details = getattr(usage, "prompt_tokens_details", None)
+        return {
+            "total_tokens": usage.total_tokens,
+            "prompt_tokens": getattr(usage, "prompt_tokens", 0) or 0,
+            "completion_tokens": getattr(usage, "completion_tokens", 0) or 0,
+            "cached_tokens": getattr(prompt_tokens_details, "cached_tokens", 0) or 0,
+        }
+
+    def _estimate_tokens(self, messages: List[Dict]) -> int:
+        """
+        Rough token estimate of a request (about 4 characters per token plus a completion allowance).
+        """
+        prompt_chars = sum(len(str(message.get("content", ""))) for message in messages)
+        return prompt_chars // 4 + self.COMPLETION_TOKENS_ESTIMATE
+
+    def _request_params(self, messages: List[Dict], stream: bool = False) -> Dict:
+        params = dict(
+            model=self.model,
+            messages=messages,
+            temperature=self.temperature,
+            top_p=self.top_p,
+        )
+        if stream:
+            params.update(stream=True, stream_options={"include_usage": True})
+        return params
+
+    def _retry_delay(self, error: Exception, attempt: int):
+        """
+        Return the backoff before retrying after `error`, or None if it should not be retried.
+        """
+        import openai
+
+        if attempt >= self.max_retries:
+            return None
+        if isinstance(error, openai.APIStatusError):
+            if error.status_code != 429 and error.status_code < 500:
+                return None
+        elif not isinstance(error, openai.APIConnectionError):
+            return None
+
+        backoff = min(self.BACKOFF_MAX_SECONDS, self.BACKOFF_BASE_SECONDS * (2 ** attempt))
+        delay = random.uniform(backoff / 2, backoff)
+        response = getattr(error, "response", None)
+        headers = getattr(response, "headers", None) or {}
+        retry_after = _parse_reset_duration(headers.get("retry-after", ""))
+        if isinstance(error, openai.APIStatusError) and error.status_code == 429:
+            delay = max(delay, retry_after, _parse_reset_duration(headers.get("x-ratelimit-reset-requests", "")))
+            # Hold back the other callers too instead of letting them hit the same 429
+            self.rate_limiter.pause(delay)
+        return max(delay, retry_after)
+
+    def _create(self, params: Dict, estimated_tokens: int):
+        """
+        Create a chat completion through the rate limiter, retrying retryable errors.
+        """
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire(estimated_tokens)
+            try:
+                raw_response = self.client.chat.completions.with_raw_response.create(**params)
+            except Exception as e:
+                delay = self._retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                attempt += 1
+                time.sleep(delay)
+                continue
+            self.rate_limiter.update_from_headers(raw_response.headers)
+            return raw_response.parse()
+
+    async def _acreate(self, async_client, params: Dict, estimated_tokens: int):
+        """
+        Async variant of `_create`.
+        """
+        attempt = 0
+        while True:
+            await self.rate_limiter.aacquire(estimated_tokens)
+            try:
+                raw_response = await async_client.chat.completions.with_raw_response.create(**params)
+            except Exception as e:
+                delay = self._retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            self.rate_limiter.update_from_headers(raw_response.headers)
+            return raw_response.parse()
 
     def chat(self, messages: List[Dict]) -> ChatResponse:
         """
@@ -182,13 +643,644 @@ class OpenAI(BaseLLM):
         Returns:
             ChatResponse: An object containing the model's response and token usage information.
         """
-        completion = self.client.chat.completions.create(
-            model=self.model,
-            messages=messages,
-            temperature=0.7,
-            top_p=0.8,
+        estimated_tokens = self._estimate_tokens(messages)
+        completion = self._create(self._request_params(messages), estimated_tokens)
+        self.rate_limiter.record_usage(estimated_tokens, completion.usage.total_tokens)
+        return ChatResponse(
+            content=completion.choices[0].message.content,
+            **self._usage_kwargs(completion.usage),
         )
+
+    async def achat(self, messages: List[Dict]) -> ChatResponse:
+        """
+        Asynchronously send a chat message to the OpenAI model and get a response.
+
+        At most `max_concurrency` requests are in flight at once on the running event loop.
+
+        Args:
+            messages (List[Dict]): A list of message dictionaries, in the same format as `chat`.
+
+        Returns:
+            ChatResponse: An object containing the model's response and token usage information.
+        """
+        async_client, semaphore = self._get_async_state()
+        estimated_tokens = self._estimate_tokens(messages)
+        async with semaphore:
+            completion = await self._acreate(async_client, self._request_params(messages), estimated_tokens)
+        self.rate_limiter.record_usage(estimated_tokens, completion.usage.total_tokens)
         return ChatResponse(
             content=completion.choices[0].message.content,
-            total_tokens=completion.usage.total_tokens,
-        )
\ No newline at end of file
+            **self._usage_kwargs(completion.usage),
+        )
+
+    def chat_stream(self, messages: List[Dict]) -> Iterator[ChatResponse]:
+        """
+        Send a chat message to the OpenAI model and stream the response.
+
+        Args:
+            messages (List[Dict]): A list of message dictionaries, in the same format as `chat`.
+
+        Yields:
+            ChatResponse: Content deltas; the final one carries the token usage of the call.
+        """
+        estimated_tokens = self._estimate_tokens(messages)
+        stream = self._create(self._request_params(messages, stream=True), estimated_tokens)
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield ChatResponse(content=chunk.choices[0].delta.content, total_tokens=0)
+            if getattr(chunk, "usage", None):
+                self.rate_limiter.record_usage(estimated_tokens, chunk.usage.total_tokens)
+                yield ChatResponse(content="", **self._usage_kwargs(chunk.usage))
+
+    async def achat_stream(self, messages: List[Dict]) -> AsyncIterator[ChatResponse]:
+        """
+        Async variant of `chat_stream`, bounded by the same concurrency limit as `achat`.
+
+        Args:
+            messages (List[Dict]): A list of message dictionaries, in the same format as `chat`.
+
+        Yields:
+            ChatResponse: Content deltas; the final one carries the token usage of the call.
+        """
+        async_client, semaphore = self._get_async_state()
+        estimated_tokens = self._estimate_tokens(messages)
+        async with semaphore:
+            stream = await self._acreate(async_client, self._request_params(messages, stream=True), estimated_tokens)
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield ChatResponse(content=chunk.choices[0].delta.content, total_tokens=0)
+                if getattr(chunk, "usage", None):
+                    self.rate_limiter.record_usage(estimated_tokens, chunk.usage.total_tokens)
+                    yield ChatResponse(content="", **self._usage_kwargs(chunk.usage))
+
+
+class LatencyHistogram:
+    """
+    Rolling window of recent call latencies with percentile lookups.
+
+    Attributes:
+        window (int): Number of most recent samples kept.
+    """
+
+    def __init__(self, window: int = 500):
+        self.window = window
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, latency_seconds: float) -> None:
+        with self._lock:
+            self._samples.append(latency_seconds)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def percentile(self, q: float):
+        """
+        Return the q-th percentile (0-100) of the recorded latencies, or None if there are none.
+        """
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        index = min(len(samples) - 1, max(0, int(round(q / 100.0 * (len(samples) - 1)))))
+        return samples[index]
+
+
+class HedgedLLM(BaseLLM):
+    """
+    Hedges slow requests of a wrapped model against tail latency.
+
+    If a call has not returned within the `percentile` latency observed so far, an
+    identical request is fired and whichever answers first wins; the other is cancelled.
+    Hedges are capped at `max_hedge_ratio` of all calls, which bounds the extra spend.
+    The tokens of the losing request are added to the returned response, so token totals
+    and budgets account for them: its own usage if it finished, otherwise the winner's
+    usage as an estimate, since the provider already received the identical request.
+
+    Attributes:
+        llm (BaseLLM): The wrapped language model.
+        histogram (LatencyHistogram): Latencies of the wrapped model's calls.
+        calls (int): Number of calls made through this wrapper.
+        hedges (int): Number of duplicate requests fired.
+        hedge_wins (int): Number of calls answered by the duplicate request.
+        hedge_tokens (int): Tokens spent (or estimated) on the losing requests of hedged calls.
+    """
+
+    def __init__(
+        self,
+        llm: BaseLLM,
+        percentile: float = 95.0,
+        max_hedge_ratio: float = 0.1,
+        min_samples: int = 20,
+        min_delay_seconds: float = 0.2,
+    ):
+        """
+        Initialize a HedgedLLM.
+
+        Args:
+            llm: The language model whose requests are hedged.
+            percentile: Latency percentile after which a duplicate request is fired.
+            max_hedge_ratio: Maximum share of calls that may fire a duplicate request.
+            min_samples: Number of latency samples needed before hedging starts.
+            min_delay_seconds: Lower bound of the hedge delay.
+        """
+        self.llm = llm
+        self.percentile = percentile
+        self.max_hedge_ratio = max_hedge_ratio
+        self.min_samples = min_samples
+        self.min_delay_seconds = min_delay_seconds
+        self.histogram = LatencyHistogram()
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.hedge_tokens = 0
+        self._lock = threading.Lock()
+
+    @property
+    def model(self) -> str:
+        return getattr(self.llm, "model", None)
+
+    @property
+    def temperature(self):
+        return getattr(self.llm, "temperature", None)
+
+    @property
+    def top_p(self):
+        return getattr(self.llm, "top_p", None)
+
+    def chat(self, messages: List[Dict]) -> ChatResponse:
+        return self.llm.chat(messages)
+
+    async def achat_stream(self, messages: List[Dict]) -> AsyncIterator[ChatResponse]:
+        async for delta in self.llm.achat_stream(messages):
+            yield delta
+
+    async def aclose(self) -> None:
+        await self.llm.aclose()
+
+    def _hedge_delay(self):
+        """
+        Return the delay after which to hedge the next call, or None if it should not be hedged.
+        """
+        if len(self.histogram) < self.min_samples:
+            return None
+        with self._lock:
+            if self.hedges + 1 > self.max_hedge_ratio * self.calls:
+                return None
+        return max(self.min_delay_seconds, self.histogram.percentile(self.percentile))
+
+    async def _timed(self, messages: List[Dict]) -> ChatResponse:
+        start_time = time.monotonic()
+        try:
+            response = await self.llm.achat(messages)
+        except asyncio.CancelledError:
+            # Cancelled after losing the race: its latency was at least this long, and leaving it
+            # out would pull the percentile down and make hedging fire more and more often
+            self.histogram.record(time.monotonic() - start_time)
+            raise
+        self.histogram.record(time.monotonic() - start_time)
+        return response
+
+    async def achat(self, messages: List[Dict]) -> ChatResponse:
+        """
+        Send the request, firing one duplicate if it is slower than the hedge delay.
+        """
+        with self._lock:
+            self.calls += 1
+        delay = self._hedge_delay()
+        primary = asyncio.ensure_future(self._timed(messages))
+        if delay is None:
+            return await primary
+
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done:
+            return primary.result()
+        with self._lock:
+            # Re-check the cap: other calls may have hedged while this one waited
+            if self.hedges + 1 > self.max_hedge_ratio * self.calls:
+                return await primary
+            self.hedges += 1
+
+        hedge = asyncio.ensure_future(self._timed(messages))
+        pending = {primary, hedge}
+        winner = None
+        try:
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if winner is None and not task.cancelled() and task.exception() is None:
+                        winner = task
+        finally:
+            for task in pending:
+                task.cancel()
+        if winner is None:
+            # Both requests failed
+            return primary.result()
+        if winner is hedge:
+            with self._lock:
+                self.hedge_wins += 1
+        return self._add_loser_usage(winner.result(), primary if winner is hedge else hedge)
+
+    def _add_loser_usage(self, response: ChatResponse, loser: asyncio.Future) -> ChatResponse:
+        """
+        Return `response` with the tokens of the losing request of its hedged call added.
+        """
+        if not loser.done() or loser.cancelled():
+            spent = response # Cancelled in flight: estimated as the identical winning request
+        elif loser.exception() is not None:
+            return response
+        else:
+            spent = loser.result()
+        with self._lock:
+            self.hedge_tokens += spent.total_tokens
+        return ChatResponse(
+            content=response.content,
+            total_tokens=response.total_tokens + spent.total_tokens,
+            prompt_tokens=response.prompt_tokens + spent.prompt_tokens,
+            completion_tokens=response.completion_tokens + spent.completion_tokens,
+            cached_tokens=response.cached_tokens + spent.cached_tokens,
+        )
+
+    def stats(self) -> Dict:
+        """
+        Return call/hedge counters and the current hedge delay.
+        """
+        return {
+            "calls": self.calls,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "hedge_tokens": self.hedge_tokens,
+            "latency_p50": self.histogram.percentile(50),
+            "latency_p_hedge": self.histogram.percentile(self.percentile),
+        }
+
+
+class RoutedLLM(BaseLLM):
+    """
+    Routes calls to separately configured models by role.
+
+    Roles without a dedicated model are served by the default model, so a cheap model
+    can handle the short planning/rerank calls while a strong one writes the report.
+
+    Attributes:
+        default_llm (BaseLLM): The model serving roles without a route.
+        routes (Dict[str, BaseLLM]): The model serving each routed role.
+    """
+
+    ROLES = ("sub_query", "rerank", "reflect", "summary")
+
+    def __init__(self, default_llm: BaseLLM, routes: Dict[str, BaseLLM] = None):
+        """
+        Initialize a RoutedLLM.
+
+        Args:
+            default_llm: The model serving roles without a route.
+            routes: Mapping from role to the model serving it.
+        """
+        self.default_llm = default_llm
+        self.routes = dict(routes or {})
+
+    @classmethod
+    def from_env(cls, default_llm: BaseLLM) -> "RoutedLLM":
+        """
+        Build routes from OPENAI_MODEL_<ROLE>, OPENAI_BASE_URL_<ROLE> and OPENAI_API_KEY_<ROLE>
+        (e.g. OPENAI_MODEL_RERANK). Endpoint and key default to OPENAI_BASE_URL / OPENAI_API_KEY.
+        Roles with the same model, endpoint and key share one client, and each client gets the
+        rate limiter of its endpoint and model.
+
+        Roles listed in OPENAI_HEDGE_ROLES (comma-separated, e.g. "sub_query,rerank,reflect")
+        are wrapped in a HedgedLLM configured by OPENAI_HEDGE_PERCENTILE and OPENAI_HEDGE_MAX_RATIO.
+
+        Args:
+            default_llm: The model serving roles without a route.
+
+        Returns:
+            A RoutedLLM.
+        """
+        routes = {}
+        clients = {}
+        for role in cls.ROLES:
+            suffix = role.upper()
+            model = os.getenv(f"OPENAI_MODEL_{suffix}")
+            if not model:
+                continue
+            base_url = os.getenv(f"OPENAI_BASE_URL_{suffix}") or os.getenv("OPENAI_BASE_URL")
+            api_key = os.getenv(f"OPENAI_API_KEY_{suffix}") or os.getenv("OPENAI_API_KEY")
+            client_key = (model, base_url, api_key)
+            if client_key not in clients:
+                clients[client_key] = OpenAI(
+                    model=model, base_url=base_url, api_key=api_key, rate_limiter=get_shared_rate_limiter(base_url, model)
+                )
+            routes[role] = clients[client_key]
+
+        hedge_roles = [role.strip() for role in os.getenv("OPENAI_HEDGE_ROLES", "").split(",") if role.strip()]
+        for role in hedge_roles:
+            if role not in cls.ROLES:
+                raise ValueError(f"Unknown role in OPENAI_HEDGE_ROLES: {role}")
+            # One wrapper per role, so each role keeps its own latency histogram
+            routes[role] = HedgedLLM(
+                routes.get(role, default_llm),
+                percentile=float(os.getenv("OPENAI_HEDGE_PERCENTILE", 95)),
+                max_hedge_ratio=float(os.getenv("OPENAI_HEDGE_MAX_RATIO", 0.1)),
+            )
+        return cls(default_llm, routes)
+
+    @property
+    def model(self) -> str:
+        return getattr(self.default_llm, "model", None)
+
+    def for_role(self, role: str) -> BaseLLM:
+        return self.routes.get(role, self.default_llm).for_role(role)
+
+    async def aclose(self) -> None:
+        closed = []
+        for llm in [self.default_llm, *self.routes.values()]:
+            if not any(llm is other for other in closed):
+                closed.append(llm)
+                await llm.aclose()
+
+    def chat(self, messages: List[Dict]) -> ChatResponse:
+        return self.default_llm.chat(messages)
+
+    async def achat(self, messages: List[Dict]) -> ChatResponse:
+        return await self.default_llm.achat(messages)
+
+    async def achat_stream(self, messages: List[Dict]) -> AsyncIterator[ChatResponse]:
+        async for delta in self.default_llm.achat_stream(messages):
+            yield delta
+
+
+class UsageLedger:
+    """
+    Records token usage and latency of every LLM call of a job, tagged by phase.
+
+    Attributes:
+        token_budget (int): Optional maximum number of tokens the job may consume.
+        entries (List[Dict]): One record per LLM call.
+    """
+
+    def __init__(self, token_budget: int = None):
+        """
+        Initialize an empty ledger.
+
+        Args:
+            token_budget: Optional maximum number of tokens the job may consume.
+        """
+        self.token_budget = token_budget
+        self.entries: List[Dict] = []
+        self._lock = threading.Lock()
+
+    def record(self, phase: str, response: ChatResponse, latency_seconds: float, model: str = None) -> None:
+        """
+        Record one LLM call.
+
+        Args:
+            phase: The phase the call belongs to (e.g. "sub_query", "rerank", "reflect", "summary").
+            response: The response of the call, carrying its token usage.
+            latency_seconds: Wall time of the call.
+            model: The model that served the call, if known.
+        """
+        with self._lock:
+            self.entries.append({
+                "phase": phase,
+                "model": model,
+                "prompt_tokens": response.prompt_tokens,
+                "completion_tokens": response.completion_tokens,
+                "cached_tokens": response.cached_tokens,
+                "total_tokens": response.total_tokens,
+                "latency_seconds": round(latency_seconds, 3),
+            })
+
+    @property
+    def total_tokens(self) -> int:
+        with self._lock:
+            return sum(entry["total_tokens"] for entry in self.entries)
+
+    def remaining_tokens(self):
+        """
+        Return the number of tokens left in the budget, or None if there is no budget.
+        """
+        if self.token_budget is None:
+            return None
+        return max(0, self.token_budget - self.total_tokens)
+
+    def to_dict(self) -> Dict:
+        """
+        Return the ledger as a JSON-serializable dict with per-phase totals and all calls.
+        """
+        with self._lock:
+            entries = list(self.entries)
+        by_phase: Dict[str, Dict] = {}
+        for entry in entries:
+            phase_totals = by_phase.setdefault(entry["phase"], {
+                "calls": 0,
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "cached_tokens": 0,
+                "total_tokens": 0,
+                "latency_seconds": 0.0,
+            })
+            phase_totals["calls"] += 1
+            for field in ("prompt_tokens", "completion_tokens", "cached_tokens", "total_tokens", "latency_seconds"):
+                phase_totals[field] += entry[field]
+        for phase_totals in by_phase.values():
+            phase_totals["latency_seconds"] = round(phase_totals["latency_seconds"], 3)
+        return {
+            "token_budget": self.token_budget,
+            "total_tokens": sum(entry["total_tokens"] for entry in entries),
+            "by_phase": by_phase,
+            "calls": entries,
+        }
+
+
+class LLMResponseCache:
+    """
+    Persistent, content-addressed store for LLM responses backed by SQLite.
+
+    Entries expire after `max_age_seconds` and the least recently used entries are
+    evicted once the stored content exceeds `max_size_bytes`.
+
+    Attributes:
+        path (str): Path of the SQLite database file.
+        hits (int): Number of lookups served from the cache.
+        misses (int): Number of lookups that were not in the cache.
+    """
+
+    def __init__(self, path: str, max_size_bytes: int = 256 * 1024 * 1024, max_age_seconds: float = 7 * 24 * 3600):
+        """
+        Initialize (and create if needed) the cache database.
+
+        Args:
+            path: Path of the SQLite database file.
+            max_size_bytes: Maximum total size of cached content before LRU eviction.
+            max_age_seconds: Maximum age of an entry before it is discarded.
+        """
+        self.path = path
+        self.max_size_bytes = max_size_bytes
+        self.max_age_seconds = max_age_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            "key TEXT PRIMARY KEY, content TEXT NOT NULL, size INTEGER NOT NULL, "
+            "created_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_last_access ON llm_cache (last_access)")
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(model: str, messages: List[Dict], **params) -> str:
+        """
+        Build the content address of a request from its model, messages and sampling params.
+        """
+        payload = json.dumps({"model": model, "messages": messages, "params": params}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        """
+        Return the cached content for `key`, or None if missing or expired.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT content, created_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] > self.max_age_seconds:
+                if row is not None:
+                    self._conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                    self._conn.commit()
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE llm_cache SET last_access = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def set(self, key: str, content: str) -> None:
+        """
+        Store `content` under `key` and evict expired / least recently used entries.
+        """
+        now = time.time()
+        size = len(content.encode("utf-8"))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, content, size, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, content, size, now, now),
+            )
+            self._evict(now)
+            self._conn.commit()
+
+    def _evict(self, now: float) -> None:
+        self._conn.execute("DELETE FROM llm_cache WHERE created_at < ?", (now - self.max_age_seconds,))
+        total_size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()[0]
+        if total_size <= self.max_size_bytes:
+            return
+        for key, size in self._conn.execute("SELECT key, size FROM llm_cache ORDER BY last_access ASC").fetchall():
+            if total_size <= self.max_size_bytes:
+                break
+            self._conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+            total_size -= size
+
+    def stats(self) -> Dict:
+        """
+        Return hit/miss counters and the current number of entries and bytes stored.
+        """
+        with self._lock:
+            entries, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "size_bytes": size,
+        }
+
+
+class CachedLLM(BaseLLM):
+    """
+    Caching wrapper around another BaseLLM.
+
+    Responses are keyed on the wrapped model, the messages and the sampling params.
+    Cache hits report zero consumed tokens, since no tokens were spent on them.
+
+    Attributes:
+        llm (BaseLLM): The wrapped language model.
+        cache (LLMResponseCache): The response store.
+    """
+
+    def __init__(self, llm: BaseLLM, cache: LLMResponseCache):
+        """
+        Initialize a CachedLLM.
+
+        Args:
+            llm: The language model whose responses are cached.
+            cache: The response store to use.
+        """
+        self.llm = llm
+        self.cache = cache
+
+    @property
+    def model(self) -> str:
+        return getattr(self.llm, "model", None)
+
+    def for_role(self, role: str) -> BaseLLM:
+        """
+        Return a caching wrapper around the model serving `role`.
+        """
+        role_llm = self.llm.for_role(role)
+        if role_llm is self.llm:
+            return self
+        return CachedLLM(role_llm, self.cache)
+
+    async def aclose(self) -> None:
+        await self.llm.aclose()
+
+    def _key(self, messages: List[Dict]) -> str:
+        return self.cache.make_key(
+            getattr(self.llm, "model", type(self.llm).__name__),
+            messages,
+            temperature=getattr(self.llm, "temperature", None),
+            top_p=getattr(self.llm, "top_p", None),
+        )
+
+    def chat(self, messages: List[Dict]) -> ChatResponse:
+        """
+        Return the cached response for `messages`, or ask the wrapped model and cache its answer.
+        """
+        key = self._key(messages)
+        content = self.cache.get(key)
+        if content is not None:
+            return ChatResponse(content=content, total_tokens=0)
+        response = self.llm.chat(messages)
+        self.cache.set(key, response.content)
+        return response
+
+    async def achat(self, messages: List[Dict]) -> ChatResponse:
+        """
+        Async variant of `chat`.
+        """
+        key = self._key(messages)
+        content = self.cache.get(key)
+        if content is not None:
+            return ChatResponse(content=content, total_tokens=0)
+        response = await self.llm.achat(messages)
+        self.cache.set(key, response.content)
+        return response
+
+    async def achat_stream(self, messages: List[Dict]) -> AsyncIterator[ChatResponse]:
+        """
+        Stream the cached response as a single delta, or relay and cache the wrapped model's stream.
+        """
+        key = self._key(messages)
+        content = self.cache.get(key)
+        if content is not None:
+            yield ChatResponse(content=content, total_tokens=0)
+            return
+        parts = []
+        async for delta in self.llm.achat_stream(messages):
+            parts.append(delta.content)
+            yield delta
+        self.cache.set(key, "".join(parts))
@@ -1,9 +1,22 @@
 import os
+import re
+import asyncio
+import hashlib
+import mmap
 import requests
 import json
+import sqlite3
+import threading
 import time
+import uuid
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 
+import httpx
+import numpy as np
 import PyPDF2
+from requests.adapters import HTTPAdapter
 
 
 def save_pdf_around_page_range(input_path, output_path, page_start, page_end):
@@ -18,26 +31,515 @@ def save_pdf_around_page_range(input_path, output_path, page_start, page_end):
             pdf_writer.write(output_file)
 
 
-def split_pdf_and_update_file_to_qanything(pdf_file, output_path, qanything_handler, kb_id, num_split=10):
+def iter_pdf_page_ranges(pdf_file, output_path, prefix, num_split=10):
+    """
+    Write `pdf_file` out in parts of `num_split` pages, yielding the path of each part as soon as
+    it is written.
 
+    The file is re-opened for each part, so only the objects of one part are held in memory;
+    opening a reader only reads the cross-reference table.
+    """
     with open(pdf_file, 'rb') as file:
-        pdf_reader = PyPDF2.PdfReader(file)
-        num_pages = len(pdf_reader.pages)
+        num_pages = len(PyPDF2.PdfReader(file).pages)
 
     for i in range(0, num_pages, num_split):
-        save_pdf_around_page_range(pdf_file, f'{output_path}/{kb_id}_{i}.pdf', i, min(i+num_split, num_pages))
+        with open(pdf_file, 'rb') as file:
+            pdf_reader = PyPDF2.PdfReader(file)
+            pdf_writer = PyPDF2.PdfWriter()
+            for page_num in range(i, min(i+num_split, num_pages)):
+                pdf_writer.add_page(pdf_reader.pages[page_num])
+
+            part_path = f'{output_path}/{prefix}_{i}.pdf'
+            with open(part_path, 'wb') as output_file:
+                pdf_writer.write(output_file)
+        del pdf_writer, pdf_reader
+        yield part_path
+
+
+def _upload_and_wait(qanything_handler, file, kb_id):
+    file_status = qanything_handler.upload_file(file, kb_id=kb_id)
+    if not file_status.get('data'):
+        return 'red'
+    return qanything_handler.wait_status_to_end(kb_id, file_status['data'][0]['file_id'])
+
+
+def split_pdf_and_update_file_to_qanything(pdf_file, output_path, qanything_handler, kb_id, num_split=10, max_in_flight=4):
+    """
+    Split `pdf_file` into parts of `num_split` pages and upload them to the knowledge base.
+
+    Parts are uploaded and indexed by up to `max_in_flight` workers while the next parts are
+    being written; at most `max_in_flight` parts wait to be indexed at any time.
+    :return: Indexing status of each part, in page order
+    """
+    prefix = f"{kb_id}_{os.path.splitext(os.path.basename(pdf_file))[0]}"
+    slots = threading.BoundedSemaphore(max_in_flight)
+    futures = []
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        for part_path in iter_pdf_page_ranges(pdf_file, output_path, prefix, num_split):
+            slots.acquire()
+            future = executor.submit(_upload_and_wait, qanything_handler, part_path, kb_id)
+            future.add_done_callback(lambda f: slots.release())
+            futures.append(future)
+    return [future.result() for future in futures]
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    """
+    Return the SHA-256 hex digest of a file, read in chunks so memory stays flat for large files.
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def hash_markdown(text):
+    """
+    Return the SHA-256 hex digest of scraped markdown after normalizing line endings,
+    trailing whitespace and runs of blank lines, so re-scrapes of an unchanged page match.
+    """
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
+    text = '\n'.join(line.rstrip() for line in text.split('\n'))
+    text = re.sub(r'\n{3,}', '\n\n', text).strip()
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def simhash(text, shingle_size=5):
+    """
+    Return the 64-bit SimHash of `text` over character shingles.
+
+    Character shingles work for CJK text without word boundaries as well as for Latin text.
+    Near-identical texts get fingerprints that differ in only a few bits. Shingles are hashed
+    with a rolling polynomial hash and counted per bit with numpy, so a 50k-character page
+    takes milliseconds.
+    """
+    text = re.sub(r'\s+', ' ', text.casefold()).strip()
+    codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    size = min(shingle_size, len(codes))
+    if size == 0:
+        return 0
+    count = len(codes) - size + 1
+    with np.errstate(over='ignore'):
+        hashes = np.zeros(count, dtype=np.uint64)
+        for offset in range(size):
+            hashes = hashes * np.uint64(1000003) + codes[offset:offset + count]
+        # splitmix64 finalizer, so every bit depends on all characters of the shingle
+        hashes ^= hashes >> np.uint64(30)
+        hashes *= np.uint64(0xbf58476d1ce4e5b9)
+        hashes ^= hashes >> np.uint64(27)
+        hashes *= np.uint64(0x94d049bb133111eb)
+        hashes ^= hashes >> np.uint64(31)
+    hashes = np.unique(hashes)
+    bits = np.unpackbits(hashes.astype('<u8').view(np.uint8).reshape(-1, 8), axis=1, bitorder='little')
+    ones = bits.sum(axis=0, dtype=np.int64)
+    return sum(1 << bit for bit in range(64) if 2 * ones[bit] > len(hashes))
+
+
+class NearDuplicateIndex():
+    """
+    Finds pages whose content nearly matches an earlier page, by SimHash fingerprint.
+
+    Two pages are near-duplicates when their fingerprints differ in at most `max_distance` bits.
+    Fingerprints are split into `max_distance + 1` bands, and any two fingerprints within the
+    distance share at least one band exactly, so lookups only compare against pages sharing a band.
+    Texts shorter than `min_length` are never treated as duplicates: a few changed characters
+    already decide whether two short pages say the same thing.
+    """
+    def __init__(self, max_distance=3, min_length=200):
+        """
+        :param max_distance: Maximum number of differing fingerprint bits of near-duplicates
+        :param min_length: Minimum text length (in characters) for near-duplicate detection
+        """
+        self.max_distance = max_distance
+        self.min_length = min_length
+        self._num_bands = max_distance + 1
+        self._band_bits = 64 // self._num_bands
+        self._bands = {}
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def _band_keys(self, fingerprint):
+        mask = (1 << self._band_bits) - 1
+        return [(band, fingerprint >> (band * self._band_bits) & mask) for band in range(self._num_bands)]
+
+    def add(self, key, text):
+        """
+        Register `text` under `key` (e.g. its canonical URL) unless it nearly matches an earlier text.
+        :return: The key of the earlier near-duplicate (which may be `key` itself), or None if the text is new
+        """
+        if len(text) < self.min_length:
+            return None
+        fingerprint = simhash(text)
+        with self._lock:
+            for band_key in self._band_keys(fingerprint):
+                for other in self._bands.get(band_key, ()):
+                    if bin(fingerprint ^ other).count('1') <= self.max_distance:
+                        return self._keys[other]
+            self._keys.setdefault(fingerprint, key)
+            for band_key in self._band_keys(fingerprint):
+                self._bands.setdefault(band_key, []).append(fingerprint)
+            return None
+
+    def __len__(self):
+        return len(self._keys)
+
+
+class IngestionManifest():
+    """
+    Persistent record of which content has been indexed where, backed by SQLite.
+
+    Entries are keyed by the SHA-256 of file bytes (hash_file) or normalized scraped markdown
+    (hash_markdown) and map to the kb_id/file_id/status of the upload, so content indexed by
+    an earlier job can be searched in its KB instead of being uploaded again.
+    """
+    def __init__(self, path):
+        """
+        Initialize (and create if needed) the manifest database.
+        :param path: Path of the SQLite database file
+        """
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS ingestion_manifest ("
+            "content_hash TEXT PRIMARY KEY, kb_id TEXT NOT NULL, file_id TEXT, status TEXT NOT NULL, "
+            "source TEXT, updated_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_ingestion_manifest_kb_id ON ingestion_manifest (kb_id)")
+        self._conn.commit()
+
+    def lookup(self, content_hash):
+        """
+        Return {"kb_id", "file_id", "status", "source"} of content that was indexed successfully, or None.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT kb_id, file_id, status, source FROM ingestion_manifest WHERE content_hash = ? AND status = 'green'",
+                (content_hash,),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return {"kb_id": row[0], "file_id": row[1], "status": row[2], "source": row[3]}
+
+    def record(self, content_hash, kb_id, file_id, status, source=None):
+        """
+        Record the outcome of an upload. A failed upload never replaces a successful one.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT status FROM ingestion_manifest WHERE content_hash = ?", (content_hash,)
+            ).fetchone()
+            if row is not None and row[0] == 'green' and status != 'green':
+                return
+            self._conn.execute(
+                "INSERT OR REPLACE INTO ingestion_manifest (content_hash, kb_id, file_id, status, source, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (content_hash, kb_id, file_id, status, source, time.time()),
+            )
+            self._conn.commit()
+
+    def forget_kb(self, kb_id):
+        """
+        Drop all entries of a deleted knowledge base.
+        :return: Number of entries removed
+        """
+        with self._lock:
+            removed = self._conn.execute("DELETE FROM ingestion_manifest WHERE kb_id = ?", (kb_id,)).rowcount
+            self._conn.commit()
+        return removed
+
+    def forget_files(self, kb_id, file_ids):
+        """
+        Drop the entries of files deleted from a knowledge base.
+        """
+        with self._lock:
+            self._conn.executemany(
+                "DELETE FROM ingestion_manifest WHERE kb_id = ? AND file_id = ?",
+                [(kb_id, file_id) for file_id in file_ids],
+            )
+            self._conn.commit()
+
+    def stats(self):
+        """
+        Return hit/miss counters and the number of entries and KBs recorded.
+        """
+        with self._lock:
+            entries, kbs = self._conn.execute(
+                "SELECT COUNT(*), COUNT(DISTINCT kb_id) FROM ingestion_manifest WHERE status = 'green'"
+            ).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "knowledge_bases": kbs,
+        }
+
+class _ThreadedIterator():
+    """
+    Advances a blocking iterator (e.g. a generator reading files) in worker threads.
+
+    `close` closes the generator in a worker thread, after a `next` that may still be running
+    there because the task awaiting it was cancelled, so the event loop never blocks on it and
+    the generator is never closed while it is executing.
+    """
+    def __init__(self, iterator):
+        self._iterator = iterator
+        self._lock = threading.Lock()
+
+    def _next(self, default):
+        with self._lock:
+            return next(self._iterator, default)
+
+    def _close(self):
+        with self._lock:
+            self._iterator.close()
+
+    async def next(self, default=None):
+        return await asyncio.to_thread(self._next, default)
+
+    def close(self):
+        asyncio.get_running_loop().run_in_executor(None, self._close)
+
+
+class UploadDeadlineExceeded(TimeoutError):
+    """
+    Raised while streaming an upload whose deadline has passed.
+    """
+
+
+class MultipartFileStream():
+    """
+    multipart/form-data request body of form fields and files, streamed in fixed-size blocks.
+
+    Files are memory-mapped when possible (read in blocks otherwise) and opened only while their
+    part is being sent, so an upload buffers at most one block and holds at most one file
+    descriptor, which is always closed. The body length is known upfront, so it is sent with a
+    Content-Length instead of chunked encoding. Pass it as `data` to requests, or its
+    `aiter_blocks()` as `content` to httpx.
+    """
+    def __init__(self, fields, files, field_name="files", block_size=1024 * 1024, progress_callback=None, deadline=None):
+        """
+        :param fields: Dict of form fields
+        :param files: List of file paths
+        :param field_name: Form field name of the files
+        :param block_size: Bytes read and sent per block
+        :param progress_callback: Optional callable invoked as progress_callback(file, bytes_sent, file_size)
+        :param deadline: Optional time.monotonic() value after which UploadDeadlineExceeded is raised
+        """
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={self.boundary}"
+        self.block_size = block_size
+        self.progress_callback = progress_callback
+        self.deadline = deadline
+        self.deadline_exceeded = False
+
+        self._fields = b"".join(
+            f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode("utf-8")
+            for name, value in fields.items()
+        )
+        self._files = []
+        for file in files:
+            file_name = os.path.basename(file).replace('"', '%22')
+            header = (
+                f'--{self.boundary}\r\nContent-Disposition: form-data; name="{field_name}"; filename="{file_name}"\r\n'
+                f'Content-Type: application/octet-stream\r\n\r\n'
+            ).encode("utf-8")
+            self._files.append((file, header, os.path.getsize(file)))
+        self._end = f'--{self.boundary}--\r\n'.encode("utf-8")
+
+    def __len__(self):
+        return len(self._fields) + sum(len(header) + size + 2 for _, header, size in self._files) + len(self._end)
+
+    def remaining_time(self, default):
+        """
+        Return `default`, capped by the time left until the deadline.
+        """
+        if self.deadline is None:
+            return default
+        return max(0.001, min(default, self.deadline - time.monotonic()))
+
+    def _read_blocks(self, file, size):
+        with open(file, "rb") as f:
+            if size > 0:
+                try:
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except (OSError, ValueError):
+                    mapped = None
+                if mapped is not None:
+                    try:
+                        for offset in range(0, size, self.block_size):
+                            yield mapped[offset:offset + self.block_size]
+                    finally:
+                        mapped.close()
+                    return
+            for block in iter(lambda: f.read(self.block_size), b""):
+                yield block
+
+    def __iter__(self):
+        yield self._fields
+        for file, header, size in self._files:
+            yield header
+            bytes_sent = 0
+            for block in self._read_blocks(file, size):
+                if self.deadline is not None and time.monotonic() > self.deadline:
+                    self.deadline_exceeded = True
+                    raise UploadDeadlineExceeded(f"Upload deadline exceeded while sending {file}")
+                yield block
+                bytes_sent += len(block)
+                if self.progress_callback is not None:
+                    self.progress_callback(file, bytes_sent, size)
+            yield b"\r\n"
+        yield self._end
+
+    async def aiter_blocks(self):
+        """
+        Async iterator over the body for httpx; blocks are read in a worker thread.
+        """
+        blocks = _ThreadedIterator(iter(self))
+        try:
+            while True:
+                block = await blocks.next()
+                if block is None:
+                    break
+                yield block
+        finally:
+            blocks.close()
+
+
+class SearchResultCache():
+    """
+    Bounded LRU cache of QAnything search-only results.
+
+    Keys include a content version per KB. Handlers sharing the cache bump the version of a KB
+    whenever its files change (uploads, deletions, finished indexing), so results cached before
+    the change can no longer be hit.
+    """
+    def __init__(self, max_entries=1024):
+        """
+        :param max_entries: Maximum number of cached results before the least recently used are evicted
+        """
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._epoch = 0  # Bumped by changes that may touch every KB of the user
+        self._lock = threading.Lock()
+
+    def bump(self, kb_ids=None):
+        """
+        Mark the content of `kb_ids` (or of all KBs if None) as changed.
+        """
+        with self._lock:
+            if kb_ids is None:
+                self._epoch += 1
+                return
+            for kb_id in kb_ids:
+                self._versions[kb_id] = self._versions.get(kb_id, 0) + 1
+
+    def make_key(self, kb_ids, question, **flags):
+        """
+        Return the cache key of a search for `question` in `kb_ids` at their current versions.
+        """
+        with self._lock:
+            versions = [[kb_id, self._versions.get(kb_id, 0)] for kb_id in sorted(set(kb_ids))]
+            epoch = self._epoch
+        payload = json.dumps(
+            {"kbs": versions, "epoch": epoch, "question": " ".join(question.split()), "flags": flags},
+            sort_keys=True, ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def make_chat_key(self, data):
+        """
+        Return the cache key of a local_doc_chat request body.
+        Only the fields that affect the retrieved chunks are part of the key.
+        """
+        return self.make_key(
+            data["kb_ids"],
+            data["question"],
+            **{field: data.get(field) for field in
+               ["rerank", "hybrid_search", "history", "networking", "web_chunk_size", "custom_prompt", "source"]},
+        )
+
+    def get(self, key):
+        with self._lock:
+            result = self._entries.get(key)
+            if result is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return result
+
+    def set(self, key, result):
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        """
+        Return hit/miss counters and the number of cached results.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "evictions": self.evictions,
+            }
 
-        file_status = qanything_handler.upload_file(f'{output_path}/{kb_id}_{i}.pdf', kb_id=kb_id)
-        qanything_handler.wait_status_to_end(kb_id, file_status['data'][0]['file_id'])
 
 class QAnythingHandler():
-    def __init__(self, server_url="http://localhost:8777", user_id="zzp"):
+    def __init__(self, server_url="http://localhost:8777", user_id="zzp",
+                 pool_size=20, connect_timeout=10, timeout=600, upload_timeout=6000, search_cache=None,
+                 upload_deadline=None):
         """
         Initialize the QAnythingHandler with the server URL.
         :param server_url: URL of the QAnything server
+        :param pool_size: Maximum number of pooled keep-alive connections to the server
+        :param connect_timeout: Connect timeout in seconds
+        :param timeout: Read timeout in seconds for API calls
+        :param upload_timeout: Read timeout in seconds for file uploads
+        :param search_cache: Optional SearchResultCache for chat calls with only_need_search_results
+        :param upload_deadline: Optional default limit in seconds on the whole duration of one upload request
+
+        The handler keeps one pooled session and can be shared between threads: the
+        session's headers and cookies are never modified after construction, and the
+        underlying urllib3 pool is thread-safe.
         """
         self.server_url = server_url
         self.user_id = user_id
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self.upload_timeout = upload_timeout
+        self.search_cache = search_cache
+        self.upload_deadline = upload_deadline
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _content_changed(self, kb_ids=None):
+        if self.search_cache is not None:
+            self.search_cache.bump(kb_ids)
 
     def create_knowledge_base(self, 
                               kb_name,
@@ -70,7 +572,7 @@ class QAnythingHandler():
         if kb_id:
             data["kb_id"] = kb_id
 
-        response = requests.post(url, headers=headers, data=json.dumps(data))
+        response = self.session.post(url, headers=headers, data=json.dumps(data), timeout=(self.connect_timeout, self.timeout))
 
         try:
             response.raise_for_status()
@@ -103,7 +605,7 @@ class QAnythingHandler():
             "kb_id": kb_id
         }
 
-        response = requests.post(url, headers=headers, data=json.dumps(data))
+        response = self.session.post(url, headers=headers, data=json.dumps(data), timeout=(self.connect_timeout, self.timeout))
 
         try:
             response.raise_for_status()
@@ -175,7 +677,8 @@ class QAnythingHandler():
             data["urls"] = urls
             data["titles"] = titles
 
-        response = requests.post(url, data=data)
+        response = self.session.post(url, data=data, timeout=(self.connect_timeout, self.timeout))
+        self._content_changed([kb_id])
 
         try:
             response.raise_for_status()
@@ -184,7 +687,7 @@ class QAnythingHandler():
             return {"error": str(e)}
 
 
-    def upload_file(self, file, kb_id, mode="strong", chunk_size=800):
+    def upload_file(self, file, kb_id, mode="strong", chunk_size=800, progress_callback=None, deadline=None):
         """
         Upload files to the knowledge base.
         :param files: List of files to upload
@@ -213,6 +716,20 @@ class QAnythingHandler():
             ]
         }
         """
+        return self.upload_files([file], kb_id, mode=mode, chunk_size=chunk_size, progress_callback=progress_callback, deadline=deadline)
+
+    def upload_files(self, files, kb_id, mode="strong", chunk_size=800, progress_callback=None, deadline=None):
+        """
+        Upload several files to the knowledge base in one request.
+        :param files: List of file paths to upload
+        :param kb_id: Knowledge base ID
+        :param mode: Mode of the knowledge base (strong or soft)
+        :param progress_callback: Optional callable invoked as progress_callback(file, bytes_sent, file_size)
+        :param deadline: Optional limit in seconds on the whole request (default: upload_deadline)
+
+        The files are streamed block by block (see MultipartFileStream). The response has the same
+        format as upload_file, with one entry in "data" per file, in the order of `files`.
+        """
         url = f"{self.server_url}/api/local_doc_qa/upload_files"
         data = {
             "user_id": self.user_id,
@@ -221,9 +738,25 @@ class QAnythingHandler():
             "chunk_size": chunk_size
         }
 
-        file_ = ("files", open(file, "rb"))
-
-        response = requests.post(url, files=[file_], data=data, timeout=6000)
+        deadline = deadline or self.upload_deadline
+        stream = MultipartFileStream(
+            data, files,
+            progress_callback=progress_callback,
+            deadline=time.monotonic() + deadline if deadline else None,
+        )
+        try:
+            response = self.session.post(
+                url,
+                data=stream,
+                headers={"Content-Type": stream.content_type},
+                timeout=(self.connect_timeout, stream.remaining_time(self.upload_timeout)),
+            )
+        except Exception as e:
+            if stream.deadline_exceeded:
+                return {"error": str(e)}
+            raise
+        finally:
+            self._content_changed([kb_id])
 
         try:
             response.raise_for_status()
@@ -253,7 +786,7 @@ class QAnythingHandler():
             "user_id": self.user_id
         }
 
-        response = requests.post(url, headers=headers, data=json.dumps(data))
+        response = self.session.post(url, headers=headers, data=json.dumps(data), timeout=(self.connect_timeout, self.timeout))
 
         try:
             response.raise_for_status()
@@ -318,7 +851,7 @@ class QAnythingHandler():
             "kb_id": kb_id,
         }
 
-        response = requests.post(url, headers=headers, data=json.dumps(data))
+        response = self.session.post(url, headers=headers, data=json.dumps(data), timeout=(self.connect_timeout, self.timeout))
 
         try:
             response.raise_for_status()
@@ -424,12 +957,23 @@ class QAnythingHandler():
         if source:
             data["source"] = source
 
+        cache_key = None
+        if only_need_search_results and self.search_cache is not None:
+            cache_key = self.search_cache.make_chat_key(data)
+        if cache_key is not None:
+            cached = self.search_cache.get(cache_key)
+            if cached is not None:
+                return cached
+
         try:
-            response = requests.post(url=url, headers=headers, json=data, timeout=600)
+            response = self.session.post(url=url, headers=headers, json=data, timeout=(self.connect_timeout, self.timeout))
             response.raise_for_status()
-            return response.json()
+            result = response.json()
         except Exception as e:
             return {"error": str(e)}
+        if cache_key is not None and result.get("code") == 200:
+            self.search_cache.set(cache_key, result)
+        return result
 
     def delete_knowledge_base(self, kb_ids):
         """
@@ -445,7 +989,8 @@ class QAnythingHandler():
             "kb_ids": kb_ids
         }
 
-        response = requests.post(url, headers=headers, data=json.dumps(data))
+        response = self.session.post(url, headers=headers, data=json.dumps(data), timeout=(self.connect_timeout, self.timeout))
+        self._content_changed(kb_ids)
 
         try:
             response.raise_for_status()
@@ -465,7 +1010,7 @@ class QAnythingHandler():
             "user_id": self.user_id
         }
 
-        response = requests.post(url, headers=headers, data=json.dumps(data))
+        response = self.session.post(url, headers=headers, data=json.dumps(data), timeout=(self.connect_timeout, self.timeout))
 
         try:
             response.raise_for_status()
@@ -488,7 +1033,8 @@ class QAnythingHandler():
             "status": status
         }
 
-        response = requests.post(url, headers=headers, data=json.dumps(data))
+        response = self.session.post(url, headers=headers, data=json.dumps(data), timeout=(self.connect_timeout, self.timeout))
+        self._content_changed()
 
         try:
             response.raise_for_status()
@@ -512,7 +1058,8 @@ class QAnythingHandler():
             "file_ids": file_ids
         }
 
-        response = requests.post(url, headers=headers, data=json.dumps(data))
+        response = self.session.post(url, headers=headers, data=json.dumps(data), timeout=(self.connect_timeout, self.timeout))
+        self._content_changed([kb_id])
 
         try:
             response.raise_for_status()
@@ -536,7 +1083,7 @@ class QAnythingHandler():
             "new_kb_name": new_kb_name
         }
 
-        response = requests.post(url, headers=headers, data=json.dumps(data))
+        response = self.session.post(url, headers=headers, data=json.dumps(data), timeout=(self.connect_timeout, self.timeout))
 
         try:
             response.raise_for_status()
@@ -582,11 +1129,12 @@ class QAnythingHandler():
     #             break
     #     return file_status
 
-    def wait_status_to_end(self, kb_id, file_id, wait_time=10, max_wait_time=40, max_elapsed_time=300):
-        increment = 0
+    def wait_status_to_end(self, kb_id, file_id, wait_time=0.5, max_wait_time=10, max_elapsed_time=300, backoff=1.5):
+        # Small files are usually indexed within a second or two, so start polling fast
+        # and back off geometrically for the long ones.
+        actual_wait_time = wait_time
         start_time = time.time()
         while True:
-            actual_wait_time = min(wait_time + increment, max_wait_time)
             time.sleep(actual_wait_time)
             elapsed_time = time.time() - start_time
             if elapsed_time > max_elapsed_time:  # default is 5 minutes
@@ -594,9 +1142,947 @@ class QAnythingHandler():
                 break
             file_status = self.check_status(kb_id=kb_id, file_id=file_id)
             if file_status in ['green', 'red']:
+                self._content_changed([kb_id])
                 if file_status == 'red':
-                    time.sleep(actual_wait_time)
                     self.clean_files_by_status(status='red')
                 break
-            increment += 2
-        return file_status
\ No newline at end of file
+            actual_wait_time = min(actual_wait_time * backoff, max_wait_time)
+        return file_status
+
+
+class AsyncQAnythingHandler():
+    """
+    Async counterpart of QAnythingHandler on a pooled httpx.AsyncClient.
+
+    Methods mirror QAnythingHandler (same arguments and return values) but must be awaited,
+    so uploads, searches and status checks can be fanned out with asyncio.gather.
+    """
+    def __init__(self, server_url="http://localhost:8777", user_id="zzp",
+                 pool_size=20, connect_timeout=10, timeout=600, upload_timeout=6000,
+                 status_poll_interval=0.3, status_max_poll_interval=5,
+                 upload_batch_size=5, max_uploads_in_flight=4, search_cache=None, upload_deadline=None):
+        """
+        Initialize the AsyncQAnythingHandler with the server URL.
+        :param server_url: URL of the QAnything server
+        :param pool_size: Maximum number of pooled keep-alive connections to the server
+        :param connect_timeout: Connect timeout in seconds
+        :param timeout: Read timeout in seconds for API calls
+        :param upload_timeout: Read timeout in seconds for file uploads
+        :param status_poll_interval: First interval in seconds between indexing-status polls
+        :param status_max_poll_interval: Longest interval in seconds between indexing-status polls
+        :param upload_batch_size: Files sent per upload request by ingest_files
+        :param max_uploads_in_flight: Upload requests ingest_files keeps in flight at once
+        :param search_cache: Optional SearchResultCache for chat calls with only_need_search_results
+        :param upload_deadline: Optional default limit in seconds on the whole duration of one upload request
+        """
+        self.server_url = server_url
+        self.user_id = user_id
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self.upload_timeout = upload_timeout
+        self.status_poll_interval = status_poll_interval
+        self.status_max_poll_interval = status_max_poll_interval
+        self.upload_batch_size = upload_batch_size
+        self.max_uploads_in_flight = max_uploads_in_flight
+        self.search_cache = search_cache
+        self.upload_deadline = upload_deadline
+        # httpx.AsyncClient and the status watchers are bound to the event loop they are used on, keep one per loop
+        self._clients = weakref.WeakKeyDictionary()
+        self._watchers = weakref.WeakKeyDictionary()
+        self._clients_lock = threading.Lock()
+
+    @classmethod
+    def from_handler(cls, handler, **kwargs):
+        """
+        Build an AsyncQAnythingHandler with the same server and settings as a QAnythingHandler.
+        :param kwargs: Further AsyncQAnythingHandler settings
+        """
+        return cls(
+            server_url=handler.server_url,
+            user_id=handler.user_id,
+            pool_size=getattr(handler, "pool_size", 20),
+            connect_timeout=getattr(handler, "connect_timeout", 10),
+            timeout=getattr(handler, "timeout", 600),
+            upload_timeout=getattr(handler, "upload_timeout", 6000),
+            search_cache=getattr(handler, "search_cache", None),
+            upload_deadline=getattr(handler, "upload_deadline", None),
+            **kwargs,
+        )
+
+    def _client(self):
+        loop = asyncio.get_running_loop()
+        with self._clients_lock:
+            client = self._clients.get(loop)
+            if client is None:
+                client = httpx.AsyncClient(
+                    limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+                    timeout=httpx.Timeout(self.timeout, connect=self.connect_timeout),
+                )
+                self._clients[loop] = client
+        return client
+
+    async def aclose(self):
+        """
+        Close the client of the running event loop.
+        """
+        loop = asyncio.get_running_loop()
+        with self._clients_lock:
+            client = self._clients.pop(loop, None)
+        if client is not None:
+            await client.aclose()
+
+    def _content_changed(self, kb_ids=None):
+        if self.search_cache is not None:
+            self.search_cache.bump(kb_ids)
+
+    async def _post_json(self, path, data):
+        response = await self._client().post(f"{self.server_url}{path}", json=data)
+        try:
+            response.raise_for_status()
+            return response.json()
+        except httpx.HTTPStatusError as e:
+            return {"error": str(e)}
+
+    async def create_knowledge_base(self, kb_name, kb_id=None, quick=False):
+        """
+        Create a new knowledge base for the user. See QAnythingHandler.create_knowledge_base.
+        """
+        data = {
+            "user_id": self.user_id,
+            "kb_name": kb_name,
+            "quick": quick
+        }
+        if kb_id:
+            data["kb_id"] = kb_id
+        return await self._post_json("/api/local_doc_qa/new_knowledge_base", data)
+
+    async def upload_weblink(self, url, kb_id, mode="strong", urls=[], titles=[], chunk_size=800):
+        """
+        Upload web links to the knowledge base. See QAnythingHandler.upload_weblink.
+        """
+        data = {
+            "user_id": self.user_id,
+            "kb_id": kb_id,
+            "mode": mode, # strong or soft
+            "chunk_size": chunk_size
+        }
+        if urls and titles and len(urls) == len(titles):
+            data["urls"] = urls
+            data["titles"] = titles
+
+        response = await self._client().post(f"{self.server_url}/api/local_doc_qa/upload_weblink", data=data)
+        self._content_changed([kb_id])
+        try:
+            response.raise_for_status()
+            return response.json()
+        except httpx.HTTPStatusError as e:
+            return {"error": str(e)}
+
+    async def upload_file(self, file, kb_id, mode="strong", chunk_size=800, progress_callback=None, deadline=None):
+        """
+        Upload files to the knowledge base. See QAnythingHandler.upload_file.
+        """
+        return await self.upload_files([file], kb_id, mode=mode, chunk_size=chunk_size, progress_callback=progress_callback, deadline=deadline)
+
+    async def upload_files(self, files, kb_id, mode="strong", chunk_size=800, progress_callback=None, deadline=None):
+        """
+        Upload several files to the knowledge base in one request. See QAnythingHandler.upload_files.
+        """
+        data = {
+            "user_id": self.user_id,
+            "kb_id": kb_id,
+            "mode": mode, # strong or soft
+            "chunk_size": chunk_size
+        }
+        deadline = deadline or self.upload_deadline
+        stream = MultipartFileStream(data, files, progress_callback=progress_callback)
+        try:
+            post = self._client().post(
+                f"{self.server_url}/api/local_doc_qa/upload_files",
+                content=stream.aiter_blocks(),
+                headers={"Content-Type": stream.content_type, "Content-Length": str(len(stream))},
+                timeout=httpx.Timeout(self.upload_timeout, connect=self.connect_timeout),
+            )
+            response = await (asyncio.wait_for(post, timeout=deadline) if deadline else post)
+        except asyncio.TimeoutError:
+            return {"error": f"Upload deadline of {deadline}s exceeded for {files}"}
+        finally:
+            self._content_changed([kb_id])
+        try:
+            response.raise_for_status()
+            return response.json()
+        except httpx.HTTPStatusError as e:
+            return {"error": str(e)}
+
+    async def ingest_files(self, files, kb_id, mode="strong", chunk_size=800,
+                           batch_size=None, max_in_flight=None, max_elapsed_time=300, callback=None,
+                           progress_callback=None):
+        """
+        Upload files in multi-file batches and wait until all of them are indexed.
+
+        At most `max_in_flight` upload requests run at once, and each batch starts being watched
+        for indexing as soon as its upload returns, so later uploads overlap earlier indexing.
+        :param files: List of file paths to upload
+        :param batch_size: Files per upload request (default: upload_batch_size)
+        :param max_in_flight: Concurrent upload requests (default: max_uploads_in_flight)
+        :param callback: Optional callable invoked as callback(file, file_id, status) when a file finishes
+        :param progress_callback: Optional callable invoked as progress_callback(file, bytes_sent, file_size)
+        :return: Dict mapping each file path to its final status ('green' or 'red'),
+                 or to None if its upload failed
+        """
+        batch_size = batch_size or self.upload_batch_size
+        semaphore = asyncio.Semaphore(max_in_flight or self.max_uploads_in_flight)
+
+        async def ingest_batch(batch):
+            async with semaphore:
+                try:
+                    response = await self.upload_files(batch, kb_id, mode=mode, chunk_size=chunk_size, progress_callback=progress_callback)
+                except Exception as e:
+                    response = {"error": str(e)}
+            uploaded = response.get("data") if response.get("code") == 200 else None
+            if not uploaded or len(uploaded) != len(batch):
+                return {file: None for file in batch}
+            statuses = await asyncio.gather(*[
+                self.watch_status(kb_id, item["file_id"], max_elapsed_time=max_elapsed_time) for item in uploaded
+            ])
+            if callback is not None:
+                for file, item, status in zip(batch, uploaded, statuses):
+                    callback(file, item["file_id"], status)
+            return dict(zip(batch, statuses))
+
+        results = {}
+        batches = [files[i:i + batch_size] for i in range(0, len(files), batch_size)]
+        for batch_result in await asyncio.gather(*[ingest_batch(batch) for batch in batches]):
+            results.update(batch_result)
+        return results
+
+    async def ingest_pdf(self, pdf_file, kb_id, output_path, num_split=10, mode="strong", chunk_size=800, max_in_flight=None,
+                         callback=None, progress_callback=None):
+        """
+        Split a PDF into parts of `num_split` pages and upload and index the parts.
+
+        The PDF is split in a worker thread; each part is ingested as soon as it is written,
+        with at most `max_in_flight` parts (default: max_uploads_in_flight) uploading or indexing at once.
+        :param callback: Optional callable invoked as callback(part_path, file_id, status) when a part finishes
+        :return: Status of each part in page order ('green' or 'red', None if its upload failed)
+        """
+        prefix = f"{kb_id}_{os.path.splitext(os.path.basename(pdf_file))[0]}"
+        parts = _ThreadedIterator(iter_pdf_page_ranges(pdf_file, output_path, prefix, num_split))
+        slots = asyncio.Semaphore(max_in_flight or self.max_uploads_in_flight)
+
+        async def ingest_part(part_path):
+            try:
+                return (await self.ingest_files(
+                    [part_path], kb_id, mode=mode, chunk_size=chunk_size, callback=callback, progress_callback=progress_callback
+                ))[part_path]
+            finally:
+                slots.release()
+
+        tasks = []
+        try:
+            while True:
+                await slots.acquire()
+                part_path = await parts.next()
+                if part_path is None:
+                    slots.release()
+                    break
+                tasks.append(asyncio.ensure_future(ingest_part(part_path)))
+        finally:
+            parts.close()
+        return list(await asyncio.gather(*tasks))
+
+    async def list_knowledge_base(self):
+        """
+        List all knowledge bases. See QAnythingHandler.list_knowledge_base.
+        """
+        kb = await self._post_json("/api/local_doc_qa/list_knowledge_base", {"user_id": self.user_id})
+        if "error" in kb:
+            return kb
+        return kb['data']
+
+    async def list_files(self, kb_id):
+        """
+        List all files in the knowledge base. See QAnythingHandler.list_files.
+        """
+        return await self._post_json("/api/local_doc_qa/list_files", {"user_id": self.user_id, "kb_id": kb_id})
+
+    async def chat(self,
+                   question,
+                   kb_ids,
+                   history=[],
+                   rerank=True,
+                   networking=False,
+                   custom_prompt=None,
+                   only_need_search_results=False,
+                   source=None,
+                   hybrid_search=True,
+                   max_token=8192,
+                   api_base='https://api.openai.com/v1',
+                   api_key='sk-xxxx',
+                   api_context_length=32768,
+                   model='gpt-3.5-turbo',
+                   top_p=0.99,
+                   temperature=0.5,
+                   web_chunk_size=800,):
+        """
+        Chat with the knowledge base. See QAnythingHandler.chat.
+        """
+        data = {
+            "user_id": self.user_id,
+            "kb_ids": kb_ids,
+            "question": question,
+            "rerank": rerank,
+            "api_base": api_base,
+            "api_key": api_key,
+            "model": model,
+            "hybrid_search": hybrid_search,
+            "top_p": top_p,
+            "temperature": temperature,
+            "api_context_length": api_context_length,
+            "max_token": max_token,
+        }
+        if history:
+            data["history"] = history
+        if networking:
+            data["networking"] = networking
+            data["web_chunk_size"] = web_chunk_size
+        if custom_prompt:
+            data["custom_prompt"] = custom_prompt
+        if only_need_search_results:
+            data["only_need_search_results"] = only_need_search_results
+        if source:
+            data["source"] = source
+
+        cache_key = None
+        if only_need_search_results and self.search_cache is not None:
+            cache_key = self.search_cache.make_chat_key(data)
+        if cache_key is not None:
+            cached = self.search_cache.get(cache_key)
+            if cached is not None:
+                return cached
+
+        try:
+            response = await self._client().post(f"{self.server_url}/api/local_doc_qa/local_doc_chat", json=data)
+            response.raise_for_status()
+            result = response.json()
+        except Exception as e:
+            return {"error": str(e)}
+        if cache_key is not None and result.get("code") == 200:
+            self.search_cache.set(cache_key, result)
+        return result
+
+    async def delete_knowledge_base(self, kb_ids):
+        """
+        Delete knowledge base. See QAnythingHandler.delete_knowledge_base.
+        """
+        response = await self._post_json("/api/local_doc_qa/delete_knowledge_base", {"user_id": self.user_id, "kb_ids": kb_ids})
+        self._content_changed(kb_ids)
+        return response
+
+    async def get_total_status(self):
+        """
+        Get the total status of the knowledge base. See QAnythingHandler.get_total_status.
+        """
+        return await self._post_json("/api/local_doc_qa/get_total_status", {"user_id": self.user_id})
+
+    async def clean_files_by_status(self, status='gray'):
+        """
+        Clean files by status. See QAnythingHandler.clean_files_by_status.
+        """
+        response = await self._post_json("/api/local_doc_qa/clean_files_by_status", {"user_id": self.user_id, "status": status})
+        self._content_changed()
+        return response
+
+    async def delete_files(self, kb_id, file_ids):
+        """
+        Delete files from the knowledge base. See QAnythingHandler.delete_files.
+        """
+        response = await self._post_json("/api/local_doc_qa/delete_files", {"user_id": self.user_id, "kb_id": kb_id, "file_ids": file_ids})
+        self._content_changed([kb_id])
+        return response
+
+    async def rename_knowledge_base(self, kb_id, new_kb_name):
+        """
+        Rename the knowledge base. See QAnythingHandler.rename_knowledge_base.
+        """
+        return await self._post_json("/api/local_doc_qa/rename_knowledge_base", {"user_id": self.user_id, "kb_id": kb_id, "new_kb_name": new_kb_name})
+
+    async def delete_kb_name(self, kb_name):
+        try:
+            kb_ids = []
+            for r in await self.list_knowledge_base():
+                if r['kb_name'] == kb_name:
+                    kb_ids.append(r['kb_id'])
+                if len(kb_ids) == 50:
+                    await self.delete_knowledge_base(kb_ids)
+                    kb_ids = []
+                    await asyncio.sleep(1)
+
+            await self.delete_knowledge_base(kb_ids)
+            return kb_ids
+        except Exception as e:
+            return {"error": str(e)}
+
+    async def check_status(self, kb_id, file_id):
+        try:
+            response = await self.list_files(kb_id)
+            file_dict = {file['file_id']: file['status'] for file in response['data']['details']}
+            file_status = file_dict[file_id]
+            return file_status
+        except Exception as e:
+            return 'yellow'
+
+    def status_watcher(self):
+        """
+        Return the IndexStatusWatcher of the running event loop.
+        """
+        loop = asyncio.get_running_loop()
+        with self._clients_lock:
+            watcher = self._watchers.get(loop)
+            if watcher is None:
+                watcher = IndexStatusWatcher(
+                    self,
+                    min_interval=self.status_poll_interval,
+                    max_interval=self.status_max_poll_interval,
+                )
+                self._watchers[loop] = watcher
+        return watcher
+
+    def watch_status(self, kb_id, file_id, callback=None, max_elapsed_time=300):
+        """
+        Start watching the indexing status of an uploaded file without blocking.
+        :return: asyncio.Future resolving to the final status ('green' or 'red')
+        """
+        return self.status_watcher().watch(kb_id, file_id, callback=callback, max_elapsed_time=max_elapsed_time)
+
+    async def wait_status_to_end(self, kb_id, file_id, max_elapsed_time=300):
+        return await self.watch_status(kb_id, file_id, max_elapsed_time=max_elapsed_time)
+
+
+class IndexStatusWatcher():
+    """
+    Watches the indexing status of many uploaded files at once.
+
+    Files are registered per KB with `watch`, which returns a future. One poller task per KB
+    calls `list_files` once per tick for all of its pending files and resolves their futures
+    when they turn green or red. Polling starts at `min_interval` and backs off by `backoff`
+    up to `max_interval` while nothing finishes; a newly registered file or a finished one
+    resets the interval.
+    """
+    def __init__(self, handler, min_interval=0.3, max_interval=5, backoff=1.5):
+        """
+        :param handler: AsyncQAnythingHandler used to poll the server
+        :param min_interval: First interval in seconds between polls
+        :param max_interval: Longest interval in seconds between polls
+        :param backoff: Factor by which the interval grows while no file finishes
+        """
+        self.handler = handler
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self._pending = {}  # kb_id -> {file_id: (future, deadline)}
+        self._pollers = {}  # kb_id -> poller task
+        self._wakeups = {}  # kb_id -> asyncio.Event set when a new file is registered
+        self.polls = 0
+
+    def watch(self, kb_id, file_id, callback=None, max_elapsed_time=300):
+        """
+        Register an uploaded file and return a future of its final status ('green' or 'red').
+        Files still not finished after `max_elapsed_time` seconds resolve to 'red'.
+        :param callback: Optional callable invoked as callback(file_id, status) when the file finishes
+        """
+        future = asyncio.get_running_loop().create_future()
+        if callback is not None:
+            future.add_done_callback(lambda f: f.cancelled() or callback(file_id, f.result()))
+        self._pending.setdefault(kb_id, {})[file_id] = (future, time.monotonic() + max_elapsed_time)
+
+        wakeup = self._wakeups.setdefault(kb_id, asyncio.Event())
+        wakeup.set()
+        poller = self._pollers.get(kb_id)
+        if poller is None or poller.done():
+            self._pollers[kb_id] = asyncio.ensure_future(self._poll(kb_id))
+        return future
+
+    async def _fetch_statuses(self, kb_id):
+        self.polls += 1
+        try:
+            response = await self.handler.list_files(kb_id)
+            return {file['file_id']: file['status'] for file in response['data']['details']}
+        except Exception as e:
+            return {}
+
+    async def _poll(self, kb_id):
+        interval = self.min_interval
+        wakeup = self._wakeups[kb_id]
+        try:
+            while self._pending.get(kb_id):
+                try:
+                    await asyncio.wait_for(wakeup.wait(), timeout=interval)
+                    wakeup.clear()
+                    interval = self.min_interval
+                    # A file was just registered: let the rest of the same upload burst join this tick
+                    await asyncio.sleep(self.min_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+                statuses = await self._fetch_statuses(kb_id)
+                pending = self._pending.get(kb_id, {})
+                now = time.monotonic()
+                finished = 0
+                failed = False
+                for file_id, (future, deadline) in list(pending.items()):
+                    if future.done():  # cancelled by the caller
+                        del pending[file_id]
+                        continue
+                    file_status = statuses.get(file_id, 'yellow')
+                    if file_status in ['green', 'red']:
+                        failed = failed or file_status == 'red'
+                    elif now > deadline:
+                        file_status = 'red'
+                    else:
+                        continue
+                    del pending[file_id]
+                    future.set_result(file_status)
+                    finished += 1
+
+                if finished:
+                    self.handler._content_changed([kb_id])
+                if failed:
+                    await self.handler.clean_files_by_status(status='red')
+                interval = self.min_interval if finished else min(interval * self.backoff, self.max_interval)
+        finally:
+            self._pollers.pop(kb_id, None)
+
+
+class KnowledgeBasePins():
+    """
+    Counts the running jobs that search a knowledge base they do not own (e.g. a KB whose files
+    they reuse through the ingestion manifest).
+
+    A pinned KB must not be emptied or deleted. Before doing so, owners call `retire`, which fails
+    while the KB is pinned and afterwards makes `pin` fail until `restore` is called, so a job can
+    never start searching a KB that is being emptied.
+    """
+    def __init__(self):
+        self._counts = {}
+        self._retired = set()
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    def add_listener(self, callback):
+        """
+        :param callback: Callable invoked as callback(kb_id) when the last pin of a KB is released
+        """
+        self._listeners.append(callback)
+
+    def pin(self, kb_id):
+        """
+        Pin a KB. Returns False if the KB is being emptied or deleted.
+        """
+        with self._lock:
+            if kb_id in self._retired:
+                return False
+            self._counts[kb_id] = self._counts.get(kb_id, 0) + 1
+            return True
+
+    def unpin(self, kb_id):
+        with self._lock:
+            count = self._counts.get(kb_id, 0) - 1
+            if count > 0:
+                self._counts[kb_id] = count
+                return
+            self._counts.pop(kb_id, None)
+        for callback in self._listeners:
+            callback(kb_id)
+
+    def retire(self, kb_id):
+        """
+        Mark a KB as about to be emptied or deleted. Returns False if it is pinned.
+        """
+        with self._lock:
+            if self._counts.get(kb_id, 0) > 0:
+                return False
+            self._retired.add(kb_id)
+            return True
+
+    def restore(self, kb_id):
+        """
+        Allow pinning a retired KB again, once it has been emptied and holds new content.
+        """
+        with self._lock:
+            self._retired.discard(kb_id)
+
+    def pinned(self, kb_id):
+        with self._lock:
+            return self._counts.get(kb_id, 0) > 0
+
+    def stats(self):
+        with self._lock:
+            return {"pinned_kbs": len(self._counts), "pins": sum(self._counts.values())}
+
+
+class KnowledgeBasePool():
+    """
+    Keeps a number of empty knowledge bases ready so jobs do not wait for create_knowledge_base.
+
+    `lease` hands out a ready KB (creating one only if the pool is empty) and `release` returns it.
+    Returned KBs are emptied with delete_files by a background thread and go back into the pool;
+    KBs beyond `max_idle` ready ones, or KBs that cannot be emptied, are deleted, so the number
+    of KBs stays bounded by the leased ones plus `max_idle`.
+
+    With `pins`, a returned KB that other jobs still search is kept untouched until its last pin
+    is released.
+    """
+    def __init__(self, handler, size=4, max_idle=None, name_prefix="kb_pool", on_recycle=None,
+                 check_interval=30, delete_batch_size=50, pins=None):
+        """
+        :param handler: QAnythingHandler used to manage the knowledge bases
+        :param size: Number of empty KBs kept ready
+        :param max_idle: Maximum number of empty KBs kept (default: 2 * size)
+        :param name_prefix: Prefix of the names of created KBs
+        :param on_recycle: Optional callable invoked as on_recycle(kb_id) after a KB is emptied or deleted
+        :param check_interval: Seconds between background checks when nothing is returned
+        :param delete_batch_size: Files removed per delete_files request
+        :param pins: Optional KnowledgeBasePins shared with the jobs that search other jobs' KBs
+        """
+        self.handler = handler
+        self.size = size
+        self.max_idle = max_idle if max_idle is not None else 2 * size
+        self.name_prefix = name_prefix
+        self.on_recycle = on_recycle
+        self.check_interval = check_interval
+        self.delete_batch_size = delete_batch_size
+        self.pins = pins
+
+        self._ready = deque()
+        self._leased = set()
+        self._returned = deque()
+        self._pinned = set()
+        self._discarded = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.created = 0
+        self.leases = 0
+        self.lease_misses = 0
+        self.recycled = 0
+        self.deleted = 0
+        self.deferred = 0
+
+        if pins is not None:
+            pins.add_listener(self._unpinned)
+
+    def start(self):
+        """
+        Start the background thread that fills the pool and recycles returned KBs.
+        """
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="kb-pool", daemon=True)
+            self._thread.start()
+        self._wakeup.set()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+    def lease(self):
+        """
+        Return the ID of an empty KB for exclusive use, or None if none could be created.
+        """
+        with self._lock:
+            kb_id = self._ready.popleft() if self._ready else None
+            self.leases += 1
+            if kb_id is None:
+                self.lease_misses += 1
+        if kb_id is None:
+            kb_id = self._create()
+        if kb_id is not None:
+            with self._lock:
+                self._leased.add(kb_id)
+        self._wakeup.set()
+        return kb_id
+
+    def release(self, kb_id):
+        """
+        Give a leased KB back. It is emptied and reused in the background.
+        """
+        with self._lock:
+            self._leased.discard(kb_id)
+            self._returned.append(kb_id)
+        self._wakeup.set()
+
+    def discard(self, kb_id):
+        """
+        Delete a leased KB when it is released instead of emptying it for reuse.
+        """
+        with self._lock:
+            if kb_id in self._leased:
+                self._discarded.add(kb_id)
+
+    def _create(self):
+        kb_name = f"{self.name_prefix}_{int(time.time() * 1000)}"
+        try:
+            response = self.handler.create_knowledge_base(kb_name)
+        except Exception as e:
+            return None
+        kb_id = response.get("data", {}).get("kb_id") if response.get("code") == 200 else None
+        if kb_id is not None:
+            with self._lock:
+                self.created += 1
+        return kb_id
+
+    def _empty(self, kb_id):
+        """
+        Delete all files of a KB. Returns False if the KB could not be listed or emptied.
+        """
+        response = self.handler.list_files(kb_id)
+        if response.get("code") != 200:
+            return False
+        file_ids = [file['file_id'] for file in response['data']['details']]
+        for i in range(0, len(file_ids), self.delete_batch_size):
+            response = self.handler.delete_files(kb_id, file_ids[i:i + self.delete_batch_size])
+            if response.get("code") != 200:
+                return False
+        return True
+
+    def _unpinned(self, kb_id):
+        with self._lock:
+            if kb_id not in self._pinned:
+                return
+            self._pinned.discard(kb_id)
+            self._returned.append(kb_id)
+        self._wakeup.set()
+
+    def _recycle(self, kb_id):
+        if self.pins is not None:
+            # Register first, so an unpin racing with retire() re-queues the KB
+            with self._lock:
+                self._pinned.add(kb_id)
+            if not self.pins.retire(kb_id):
+                with self._lock:
+                    self.deferred += 1
+                return
+            with self._lock:
+                if kb_id not in self._pinned:
+                    return  # already re-queued by _unpinned
+                self._pinned.discard(kb_id)
+        with self._lock:
+            discarded = kb_id in self._discarded
+            self._discarded.discard(kb_id)
+        try:
+            emptied = not discarded and self._empty(kb_id)
+        except Exception as e:
+            emptied = False
+        with self._lock:
+            keep = emptied and len(self._ready) < self.max_idle
+        if not keep:
+            try:
+                self.handler.delete_knowledge_base([kb_id])
+            except Exception as e:
+                pass
+        if self.on_recycle is not None:
+            self.on_recycle(kb_id)
+        if keep and self.pins is not None:
+            self.pins.restore(kb_id)
+        with self._lock:
+            if keep:
+                self._ready.append(kb_id)
+                self.recycled += 1
+            else:
+                self.deleted += 1
+
+    def _run(self):
+        while not self._stop.is_set():
+            while True:
+                with self._lock:
+                    kb_id = self._returned.popleft() if self._returned else None
+                if kb_id is None:
+                    break
+                self._recycle(kb_id)
+            while not self._stop.is_set():
+                with self._lock:
+                    missing = self.size - len(self._ready)
+                if missing <= 0:
+                    break
+                kb_id = self._create()
+                if kb_id is None:
+                    break  # QAnything unavailable, retry on the next check
+                with self._lock:
+                    self._ready.append(kb_id)
+            self._wakeup.wait(timeout=self.check_interval)
+            self._wakeup.clear()
+
+    def stats(self):
+        """
+        Return pool sizes and lease/recycle counters.
+        """
+        with self._lock:
+            return {
+                "ready": len(self._ready),
+                "leased": len(self._leased),
+                "returned": len(self._returned),
+                "pinned": len(self._pinned),
+                "created": self.created,
+                "leases": self.leases,
+                "lease_misses": self.lease_misses,
+                "recycled": self.recycled,
+                "deleted": self.deleted,
+                "deferred": self.deferred,
+            }
+
+
+class KnowledgeBaseReaper():
+    """
+    Deletes knowledge bases some time after they were scheduled, from a background thread.
+
+    The queue lives in SQLite, so KBs scheduled before a restart are still deleted after it.
+    Due KBs are deleted in batches of `batch_size` with at least `interval_seconds` between
+    batches; failed deletions are retried with a growing delay. With `pins`, due KBs that running
+    jobs still search are kept until they are unpinned.
+    """
+    def __init__(self, handler, path=":memory:", ttl_seconds=3600, batch_size=50, interval_seconds=10,
+                 on_delete=None, pins=None):
+        """
+        :param handler: QAnythingHandler used to delete the knowledge bases
+        :param path: Path of the SQLite database holding the queue (":memory:" to not persist it)
+        :param ttl_seconds: Default delay between scheduling a KB and deleting it
+        :param batch_size: Maximum number of KBs per delete_knowledge_base request
+        :param interval_seconds: Minimum time between two delete requests
+        :param on_delete: Optional callable invoked as on_delete(kb_id) after a KB is deleted
+        :param pins: Optional KnowledgeBasePins shared with the jobs that search other jobs' KBs
+        """
+        self.handler = handler
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.batch_size = batch_size
+        self.interval_seconds = interval_seconds
+        self.on_delete = on_delete
+        self.pins = pins
+        self.reclaimed = 0
+        self.failed = 0
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS kb_reaper_queue ("
+            "kb_id TEXT PRIMARY KEY, delete_after REAL NOT NULL, attempts INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_kb_reaper_queue_delete_after ON kb_reaper_queue (delete_after)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS kb_reaper_stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self._conn.commit()
+
+    def schedule(self, kb_id, ttl_seconds=None):
+        """
+        Queue a KB for deletion after `ttl_seconds` (default: ttl_seconds of the reaper).
+        """
+        ttl_seconds = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO kb_reaper_queue (kb_id, delete_after, attempts) VALUES (?, ?, 0)",
+                (kb_id, time.time() + ttl_seconds),
+            )
+            self._conn.commit()
+
+    def start(self):
+        """
+        Start the background thread that deletes due KBs.
+        """
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="kb-reaper", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def reap_once(self):
+        """
+        Delete one batch of due KBs. Returns the number of KBs deleted.
+        """
+        now = time.time()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT kb_id, attempts FROM kb_reaper_queue WHERE delete_after <= ? ORDER BY delete_after LIMIT ?",
+                (now, self.batch_size),
+            ).fetchall()
+        if not rows:
+            return 0
+
+        if self.pins is not None:
+            pinned = [kb_id for kb_id, _ in rows if not self.pins.retire(kb_id)]
+            if pinned:
+                with self._lock:
+                    self._conn.executemany(
+                        "UPDATE kb_reaper_queue SET delete_after = ? WHERE kb_id = ?",
+                        [(now + self.interval_seconds, kb_id) for kb_id in pinned],
+                    )
+                    self._conn.commit()
+                rows = [(kb_id, attempts) for kb_id, attempts in rows if kb_id not in pinned]
+                if not rows:
+                    return 0
+
+        kb_ids = [kb_id for kb_id, _ in rows]
+        try:
+            response = self.handler.delete_knowledge_base(kb_ids)
+            deleted = response.get("code") == 200
+        except Exception as e:
+            deleted = False
+
+        with self._lock:
+            if deleted:
+                self._conn.executemany("DELETE FROM kb_reaper_queue WHERE kb_id = ?", [(kb_id,) for kb_id in kb_ids])
+                self._conn.execute(
+                    "INSERT INTO kb_reaper_stats (name, value) VALUES ('reclaimed', ?) "
+                    "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                    (len(kb_ids),),
+                )
+                self.reclaimed += len(kb_ids)
+            else:
+                # Retry later, waiting longer after each failure (capped at one hour)
+                self._conn.executemany(
+                    "UPDATE kb_reaper_queue SET attempts = attempts + 1, delete_after = ? WHERE kb_id = ?",
+                    [(now + min(3600, self.interval_seconds * 2 ** (attempts + 1)), kb_id) for kb_id, attempts in rows],
+                )
+                self.failed += len(kb_ids)
+            self._conn.commit()
+
+        if not deleted:
+            return 0
+        if self.on_delete is not None:
+            for kb_id in kb_ids:
+                self.on_delete(kb_id)
+        return len(kb_ids)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.reap_once()
+            except Exception as e:
+                pass
+            self._stop.wait(self.interval_seconds)
+
+    def stats(self):
+        """
+        Return the queue size and the number of KBs reclaimed by this process and in total.
+        """
+        now = time.time()
+        with self._lock:
+            queued, due = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(delete_after <= ?), 0) FROM kb_reaper_queue", (now,)
+            ).fetchone()
+            row = self._conn.execute("SELECT value FROM kb_reaper_stats WHERE name = 'reclaimed'").fetchone()
+        return {
+            "queued": queued,
+            "due": due,
+            "reclaimed": self.reclaimed,
+            "reclaimed_total": row[0] if row else 0,
+            "failed_attempts": self.failed,
+        }
@@ -0,0 +1,101 @@
+import firecrawl_utils
+from firecrawl_utils import PageCache, canonicalize_url, record_redirect
+
+
+def scrape_response(markdown, **metadata):
+    return {"success": True, "data": {"markdown": markdown, "metadata": metadata}}
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class FakeSession:
+    """Answers conditional GETs with the given status and records their headers."""
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.requests = []
+
+    def get(self, url, headers=None, **kwargs):
+        self.requests.append((url, headers))
+        return FakeResponse(self.status_code)
+
+
+def age(cache, seconds):
+    cache._conn.execute("UPDATE pages SET fetched_at = fetched_at - ?", (seconds,))
+    cache._conn.commit()
+
+
+def test_canonicalize_url_merges_spellings_of_the_same_page():
+    canonical = canonicalize_url("https://example.com/docs?a=1&b=2")
+    assert canonical == "https://example.com/docs?a=1&b=2"
+    for url in (
+        "http://WWW.Example.com:80/docs/?a=1&b=2",
+        "https://example.com:443/docs?b=2&a=1",
+        "https://example.com/docs?a=1&utm_source=news&b=2&fbclid=abc#section",
+    ):
+        assert canonicalize_url(url) == canonical
+    assert canonicalize_url("https://example.com") == "https://example.com/"
+    assert canonicalize_url("https://example.com/Docs") != canonicalize_url("https://example.com/docs")
+
+
+def test_canonicalize_url_follows_recorded_redirects():
+    record_redirect("https://short.example/abc", "https://www.target.example/article/")
+    assert canonicalize_url("http://short.example/abc?utm_medium=x") == "https://target.example/article"
+
+
+def test_page_cache_serves_fresh_entries_by_canonical_url(tmp_path, monkeypatch):
+    session = FakeSession(304)
+    monkeypatch.setattr(firecrawl_utils, "_get_session", lambda: session)
+    cache = PageCache(str(tmp_path / "pages.sqlite"), ttl_seconds=60)
+    cache.set("https://example.com/page", {"formats": ["markdown"]}, scrape_response("# Page", etag='"v1"'))
+
+    assert cache.get("http://www.example.com/page/?utm_source=x", {"formats": ["markdown"]})["data"]["markdown"] == "# Page"
+    assert cache.get("https://example.com/page", {"formats": ["html"]}) is None # Other scrape options
+    assert session.requests == []
+    assert (cache.stats()["hits"], cache.stats()["misses"]) == (1, 1)
+
+
+def test_page_cache_revalidates_stale_entries_with_their_validators(tmp_path, monkeypatch):
+    session = FakeSession(304)
+    monkeypatch.setattr(firecrawl_utils, "_get_session", lambda: session)
+    cache = PageCache(str(tmp_path / "pages.sqlite"), ttl_seconds=60)
+    cache.set("https://example.com/page", None, scrape_response("# Page", ETag='"v1"', **{"Last-Modified": "Mon, 05 May 2025 10:00:00 GMT"}))
+    age(cache, 120)
+
+    assert cache.get("https://example.com/page")["data"]["markdown"] == "# Page"
+    assert session.requests == [("https://example.com/page", {
+        "If-None-Match": '"v1"',
+        "If-Modified-Since": "Mon, 05 May 2025 10:00:00 GMT",
+    })]
+    assert cache.stats()["revalidated"] == 1
+
+    # Revalidation renews the entry, so the next lookup needs no request
+    assert cache.get("https://example.com/page") is not None
+    assert len(session.requests) == 1
+    assert cache.stats()["hits"] == 1
+
+
+def test_page_cache_drops_stale_entries_that_changed_or_cannot_be_revalidated(tmp_path, monkeypatch):
+    session = FakeSession(200)
+    monkeypatch.setattr(firecrawl_utils, "_get_session", lambda: session)
+    cache = PageCache(str(tmp_path / "pages.sqlite"), ttl_seconds=60)
+    cache.set("https://example.com/changed", None, scrape_response("# Old", etag='"v1"'))
+    no_revalidation = PageCache(str(tmp_path / "other.sqlite"), ttl_seconds=60, revalidate=False)
+    no_revalidation.set("https://example.com/changed", None, scrape_response("# Old", etag='"v1"'))
+    age(cache, 120)
+    age(no_revalidation, 120)
+
+    assert cache.get("https://example.com/changed") is None
+    assert len(session.requests) == 1
+    assert no_revalidation.get("https://example.com/changed") is None
+    assert len(session.requests) == 1 # Scraped again without asking the origin
@@ -0,0 +1,51 @@
+from firecrawl_utils import MarkdownCleaner
+
+
+CODE_PAGE = """# Connect to Milvus
+
+[Docs](/docs) for the client.
+
+```python
+from pymilvus import MilvusClient
+
+client = MilvusClient("http://localhost:19530")
+
+client.create_collection("demo", dimension=8)
+```
+
+[Docs](/docs) for the client."""
+
+
+def test_fenced_code_is_one_block_and_kept():
+    cleaner = MarkdownCleaner()
+    cleaned = cleaner.clean(CODE_PAGE, query="connect", page_key="a")
+    assert 'client = MilvusClient("http://localhost:19530")\n\nclient.create_collection("demo", dimension=8)\n```' in cleaned
+
+
+def test_fenced_code_is_not_deduplicated_across_pages():
+    cleaner = MarkdownCleaner()
+    cleaner.clean(CODE_PAGE, query="connect", page_key="a")
+    cleaned = cleaner.clean(CODE_PAGE.replace("Connect to", "Insert into"), query="insert", page_key="b")
+    assert "from pymilvus import MilvusClient" in cleaned
+    assert cleaned.count("```") == 2
+
+
+def test_blocks_with_query_terms_or_without_links_are_kept():
+    page = "\n\n".join([
+        "# Authentication",
+        "To log in to the Milvus server, pass the user and password to the client.",
+        "Set the SameSite [cookie](/cookies) attribute when the proxy serves the web UI.",
+        "We use cookies to improve your experience. [Accept all](/consent)",
+    ])
+    cleaned = MarkdownCleaner().clean(page, query="milvus login cookie")
+    assert "To log in to the Milvus server" in cleaned
+    assert "Set the SameSite [cookie](/cookies) attribute" in cleaned
+    assert "Accept all" not in cleaned
+
+
+def test_repeated_link_blocks_are_dropped_across_pages():
+    footer = "Follow us on [GitHub](https://github.com/milvus-io)"
+    cleaner = MarkdownCleaner()
+    cleaner.clean(f"# Install\n\nRun the installer.\n\n{footer}", page_key="a")
+    cleaned = cleaner.clean(f"# Upgrade\n\nRun the upgrade.\n\n{footer}", page_key="b")
+    assert cleaned == "# Upgrade\n\nRun the upgrade."
@@ -0,0 +1,177 @@
+import asyncio
+
+from openai_llm import (
+    BaseLLM,
+    ChatResponse,
+    HedgedLLM,
+    LLMResponseCache,
+    OpenAI,
+    RateLimiter,
+    RoutedLLM,
+    ThinkStreamFilter,
+    _parse_reset_duration,
+)
+
+
+def stream(chunks):
+    think_filter = ThinkStreamFilter()
+    return [think_filter.feed(chunk) for chunk in chunks] + [think_filter.flush()]
+
+
+def test_think_stream_filter_handles_tags_split_across_chunks():
+    chunks = ["<th", "ink>The user asks", " about Milvus.</th", "ink>", "\n\nMilvus is ", "a vector <", "b>database</b>."]
+    emitted = stream(chunks)
+    assert "".join(emitted) == BaseLLM.remove_think("".join(chunks))
+    assert "The user asks" not in "".join(emitted)
+    assert emitted[-3:-1] == ["a vector ", "<b>database</b>."] # "<" is held back until it is not a tag
+
+
+def test_think_stream_filter_passes_text_without_think_block():
+    chunks = ["Milvus ", "supports ", "HNSW <", "3"]
+    assert "".join(stream(chunks)) == "Milvus supports HNSW <3"
+
+
+def test_routed_roles_get_rate_limiters_per_endpoint_and_model(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "key")
+    monkeypatch.setenv("OPENAI_BASE_URL", "http://llm.invalid/v1")
+    monkeypatch.setenv("OPENAI_MODEL_RERANK", "small")
+    monkeypatch.setenv("OPENAI_MODEL_REFLECT", "small")
+    monkeypatch.setenv("OPENAI_MODEL_SUMMARY", "large")
+    routed = RoutedLLM.from_env(OpenAI(model="large"))
+    rerank, reflect, summary = (routed.for_role(role) for role in ("rerank", "reflect", "summary"))
+    assert rerank.rate_limiter is reflect.rate_limiter
+    assert rerank.rate_limiter is not summary.rate_limiter
+    assert summary.rate_limiter is routed.default_llm.rate_limiter
+
+    rerank.rate_limiter.update_from_headers({"x-ratelimit-limit-requests": "10", "x-ratelimit-remaining-requests": "0"})
+    assert summary.rate_limiter.rpm.capacity is None
+
+
+def test_aclose_closes_the_client_of_the_running_loop(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "key")
+    llm = OpenAI(model="m", base_url="http://llm.invalid/v1")
+    routed = RoutedLLM(llm, {"summary": llm, "rerank": HedgedLLM(llm)})
+
+    async def run():
+        client, _ = llm._get_async_state()
+        await routed.aclose()
+        return client
+
+    client = asyncio.run(run())
+    assert client.is_closed()
+    assert len(llm._async_states) == 0
+
+
+def test_rate_limiter_waits_once_the_request_bucket_is_empty():
+    limiter = RateLimiter(rpm_limit=2)
+    assert limiter._reserve(0) == 0
+    assert limiter._reserve(0) == 0
+    wait = limiter._reserve(0)
+    assert 25 < wait <= 30 # One request refills every 30s
+
+
+def test_rate_limiter_corrects_token_estimates_with_actual_usage():
+    limiter = RateLimiter(tpm_limit=1000)
+    assert limiter._reserve(600) == 0
+    limiter.record_usage(estimated_tokens=600, actual_tokens=100)
+    assert limiter._reserve(800) == 0
+    assert limiter._reserve(500) > 0
+
+
+def test_rate_limiter_learns_limits_from_headers():
+    limiter = RateLimiter()
+    assert limiter._reserve(10_000) == 0 # Unlimited until the provider reports a limit
+
+    limiter.update_from_headers({
+        "x-ratelimit-limit-requests": "60",
+        "x-ratelimit-remaining-requests": "0",
+        "x-ratelimit-limit-tokens": "not-a-number",
+    })
+    assert limiter.rpm.capacity == 60
+    assert limiter.tpm.capacity is None
+    assert 0 < limiter._reserve(0) <= 1
+
+
+def test_rate_limiter_pause_holds_back_every_caller():
+    limiter = RateLimiter()
+    limiter.pause(5)
+    assert 4 < limiter._reserve(0) <= 5
+
+
+def test_parse_reset_duration():
+    assert _parse_reset_duration("6m0s") == 360
+    assert _parse_reset_duration("1s20ms") == 1.02
+    assert _parse_reset_duration("2.5") == 2.5
+    assert _parse_reset_duration("") == 0
+
+
+class ScriptedLLM(BaseLLM):
+    """Answers after the given delays, one per call, with responses of known usage."""
+
+    def __init__(self, delays):
+        self.delays = list(delays)
+        self.started = 0
+
+    async def achat(self, messages):
+        delay = self.delays[self.started]
+        self.started += 1
+        await asyncio.sleep(delay)
+        return ChatResponse(content=f"answer after {delay}s", total_tokens=15, prompt_tokens=10, completion_tokens=5)
+
+
+def run_calls(llm, count):
+    async def run():
+        return [await llm.achat([{"role": "user", "content": "hi"}]) for _ in range(count)]
+    return asyncio.run(run())
+
+
+def test_hedged_llm_fires_a_duplicate_for_slow_calls_and_counts_its_tokens():
+    scripted = ScriptedLLM([0.01] * 4 + [1.0, 0.01])
+    hedged = HedgedLLM(scripted, max_hedge_ratio=1.0, min_samples=4, min_delay_seconds=0.02)
+    responses = run_calls(hedged, 5)
+
+    assert scripted.started == 6
+    assert responses[-1].content == "answer after 0.01s"
+    # The cancelled loser is billed as much as the identical winning request
+    assert (responses[-1].total_tokens, responses[-1].prompt_tokens, responses[-1].completion_tokens) == (30, 20, 10)
+    assert all(response.total_tokens == 15 for response in responses[:-1])
+    assert hedged.stats()["hedges"] == 1
+    assert hedged.stats()["hedge_wins"] == 1
+    assert hedged.stats()["hedge_tokens"] == 15
+
+
+def test_hedged_llm_waits_for_samples_and_respects_the_hedge_cap():
+    scripted = ScriptedLLM([0.05] * 3)
+    hedged = HedgedLLM(scripted, max_hedge_ratio=1.0, min_samples=4, min_delay_seconds=0.01)
+    run_calls(hedged, 3)
+    assert hedged.hedges == 0 # Too few latency samples yet
+
+    scripted = ScriptedLLM([0.01] * 4 + [0.2])
+    hedged = HedgedLLM(scripted, max_hedge_ratio=0.1, min_samples=4, min_delay_seconds=0.02)
+    responses = run_calls(hedged, 5)
+    assert hedged.hedges == 0 # One hedge in five calls would exceed 10%
+    assert responses[-1].total_tokens == 15
+
+
+def test_llm_response_cache_key_covers_model_messages_and_params():
+    messages = [{"role": "user", "content": "hi"}]
+    key = LLMResponseCache.make_key("m", messages, temperature=0.1, top_p=None)
+    assert key == LLMResponseCache.make_key("m", [dict(messages[0])], top_p=None, temperature=0.1)
+    assert key != LLMResponseCache.make_key("other", messages, temperature=0.1, top_p=None)
+    assert key != LLMResponseCache.make_key("m", [{"role": "user", "content": "hello"}], temperature=0.1, top_p=None)
+    assert key != LLMResponseCache.make_key("m", messages, temperature=0.2, top_p=None)
+
+
+def test_llm_response_cache_expires_entries(tmp_path):
+    cache = LLMResponseCache(str(tmp_path / "llm_cache.sqlite"), max_age_seconds=60)
+    cache.set("fresh", "kept")
+    cache.set("old", "expired")
+    cache._conn.execute("UPDATE llm_cache SET created_at = created_at - 120 WHERE key = 'old'")
+    cache._conn.commit()
+
+    assert cache.get("fresh") == "kept"
+    assert cache.get("old") is None
+    assert cache.get("missing") is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 2
+    assert cache.stats()["entries"] == 1 # Expired entries are dropped on lookup
@@ -0,0 +1,181 @@
+from qanything_utils import (
+    IngestionManifest,
+    KnowledgeBasePins,
+    KnowledgeBasePool,
+    KnowledgeBaseReaper,
+    NearDuplicateIndex,
+    simhash,
+)
+
+
+PAGE = """Milvus is an open-source vector database built for embedding similarity search and AI applications.
+It stores, indexes and manages massive embedding vectors generated by deep neural networks and other
+machine learning models. Milvus supports several index types, such as IVF_FLAT, IVF_PQ, HNSW and DiskANN,
+and lets users trade accuracy for speed by tuning their parameters. Collections are split into shards and
+segments, so data can be ingested and queried at the same time, and query nodes scale out independently
+of data nodes. Scalar filtering, hybrid search over dense and sparse vectors, and partition keys for
+multi-tenancy are available in recent releases."""
+
+
+class FakeQAnything:
+    """In-memory stand-in for the QAnythingHandler calls made by the pool and the reaper."""
+
+    def __init__(self):
+        self.kbs = {}
+        self.delete_requests = []
+        self.fail_deletes = False
+
+    def create_knowledge_base(self, kb_name):
+        kb_id = f"KB{len(self.kbs) + len(self.delete_requests)}_{kb_name}"
+        self.kbs[kb_id] = []
+        return {"code": 200, "data": {"kb_id": kb_id}}
+
+    def list_files(self, kb_id):
+        return {"code": 200, "data": {"details": [{"file_id": file_id} for file_id in self.kbs[kb_id]]}}
+
+    def delete_files(self, kb_id, file_ids):
+        self.kbs[kb_id] = [file_id for file_id in self.kbs[kb_id] if file_id not in file_ids]
+        return {"code": 200}
+
+    def delete_knowledge_base(self, kb_ids):
+        self.delete_requests.append(list(kb_ids))
+        if self.fail_deletes:
+            return {"code": 500}
+        for kb_id in kb_ids:
+            self.kbs.pop(kb_id, None)
+        return {"code": 200}
+
+
+def test_ingestion_manifest_persists_successful_uploads(tmp_path):
+    path = str(tmp_path / "manifest.sqlite")
+    manifest = IngestionManifest(path)
+    manifest.record("hash-a", "kb1", "file1", "green", source="a.pdf")
+    manifest.record("hash-a", "kb2", "file2", "red") # A failure never replaces a success
+    manifest.record("hash-b", "kb1", "file3", "red")
+
+    reopened = IngestionManifest(path)
+    assert reopened.lookup("hash-a") == {"kb_id": "kb1", "file_id": "file1", "status": "green", "source": "a.pdf"}
+    assert reopened.lookup("hash-b") is None
+    assert reopened.stats()["hits"] == 1
+    assert reopened.stats()["entries"] == 1
+
+
+def test_ingestion_manifest_forgets_deleted_files_and_kbs(tmp_path):
+    manifest = IngestionManifest(str(tmp_path / "manifest.sqlite"))
+    manifest.record("hash-a", "kb1", "file1", "green")
+    manifest.record("hash-b", "kb1", "file2", "green")
+    manifest.record("hash-c", "kb2", "file3", "green")
+
+    manifest.forget_files("kb1", ["file1"])
+    assert manifest.lookup("hash-a") is None
+    assert manifest.forget_kb("kb1") == 1
+    assert manifest.lookup("hash-b") is None
+    assert manifest.lookup("hash-c")["kb_id"] == "kb2"
+
+
+def test_kb_pool_leases_and_recycles_returned_kbs():
+    handler = FakeQAnything()
+    recycled = []
+    pool = KnowledgeBasePool(handler, size=1, max_idle=1, on_recycle=recycled.append)
+
+    kb_id = pool.lease() # Nothing ready yet: created on the spot
+    assert pool.stats()["lease_misses"] == 1
+    handler.kbs[kb_id] = ["file1", "file2"]
+    pool.release(kb_id)
+    pool._recycle(pool._returned.popleft())
+
+    assert handler.kbs[kb_id] == []
+    assert recycled == [kb_id]
+    assert pool.lease() == kb_id
+    assert pool.stats()["recycled"] == 1
+    assert pool.stats()["lease_misses"] == 1
+
+
+def test_kb_pool_deletes_discarded_and_surplus_kbs():
+    handler = FakeQAnything()
+    pool = KnowledgeBasePool(handler, size=1, max_idle=1)
+    first, second, third = pool.lease(), pool.lease(), pool.lease()
+    pool.discard(first)
+    for kb_id in (first, second, third):
+        pool.release(kb_id)
+    while pool._returned:
+        pool._recycle(pool._returned.popleft())
+
+    assert first not in handler.kbs
+    assert second in handler.kbs # Kept ready, up to max_idle
+    assert third not in handler.kbs
+    assert pool.stats()["ready"] == 1
+    assert pool.stats()["deleted"] == 2
+
+
+def test_kb_pool_defers_recycling_pinned_kbs():
+    handler = FakeQAnything()
+    pins = KnowledgeBasePins()
+    pool = KnowledgeBasePool(handler, size=1, max_idle=1, pins=pins)
+    kb_id = pool.lease()
+    handler.kbs[kb_id] = ["file1"]
+    assert pins.pin(kb_id)
+    pool.release(kb_id)
+    pool._recycle(pool._returned.popleft())
+    assert handler.kbs[kb_id] == ["file1"]
+    assert pool.stats()["deferred"] == 1
+
+    pins.unpin(kb_id) # Re-queues the KB
+    pool._recycle(pool._returned.popleft())
+    assert handler.kbs[kb_id] == []
+    assert pins.pin(kb_id) # Restored once emptied
+
+
+def test_kb_reaper_queue_survives_a_restart(tmp_path):
+    path = str(tmp_path / "reaper.sqlite")
+    handler = FakeQAnything()
+    handler.kbs.update({"kb1": [], "kb2": [], "kb3": []})
+    reaper = KnowledgeBaseReaper(handler, path=path, ttl_seconds=3600)
+    reaper.schedule("kb1", ttl_seconds=0)
+    reaper.schedule("kb2", ttl_seconds=0)
+    reaper.schedule("kb3")
+
+    deleted = []
+    restarted = KnowledgeBaseReaper(handler, path=path, batch_size=10, on_delete=deleted.append)
+    assert restarted.stats()["queued"] == 3
+    assert restarted.reap_once() == 2
+    assert sorted(deleted) == ["kb1", "kb2"]
+    assert "kb3" in handler.kbs # Not due yet
+    assert KnowledgeBaseReaper(handler, path=path).stats()["reclaimed_total"] == 2
+
+
+def test_kb_reaper_retries_failed_deletions_and_skips_pinned_kbs():
+    handler = FakeQAnything()
+    handler.kbs.update({"kb1": [], "kb2": []})
+    pins = KnowledgeBasePins()
+    reaper = KnowledgeBaseReaper(handler, ttl_seconds=0, interval_seconds=60, pins=pins)
+    assert pins.pin("kb1")
+    reaper.schedule("kb1")
+    reaper.schedule("kb2")
+
+    handler.fail_deletes = True
+    assert reaper.reap_once() == 0
+    assert handler.delete_requests == [["kb2"]]
+    assert reaper.stats() == {"queued": 2, "due": 0, "reclaimed": 0, "reclaimed_total": 0, "failed_attempts": 1}
+
+
+def test_simhash_is_close_for_near_identical_text():
+    edited = PAGE.replace("massive", "huge", 1)
+    unrelated = """QAnything answers questions over local files such as PDF, Word, PowerPoint and Excel documents.
+It splits uploaded files into chunks, embeds them and retrieves the chunks relevant to a question before a
+large language model writes the answer, citing the files it used. Knowledge bases group the files of a
+user, and uploads are parsed in the background while their status moves from gray to green."""
+    assert simhash(PAGE) == simhash(PAGE.upper().replace(" ", "  "))
+    assert bin(simhash(PAGE) ^ simhash(edited)).count("1") <= 3
+    assert bin(simhash(PAGE) ^ simhash(unrelated)).count("1") > 10
+    assert simhash("") == 0
+
+
+def test_near_duplicate_index_reports_the_first_page_seen():
+    index = NearDuplicateIndex(max_distance=3, min_length=200)
+    assert index.add("https://milvus.io/docs", PAGE) is None
+    assert index.add("https://mirror.example/docs", PAGE + " Mirror.") == "https://milvus.io/docs"
+    assert index.add("https://example.com/other", PAGE.upper()[::-1]) is None
+    assert index.add("https://example.com/short", "short") is None # Below min_length
+    assert index.add("https://example.com/short-copy", "short") is None
+    assert len(index) == 2